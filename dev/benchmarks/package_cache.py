@@ -0,0 +1,87 @@
+"""Measures how much the shared package cache speeds up image builds.
+
+Builds a Django site and a Node site three times each, with Docker's layer cache
+disabled so every build installs its dependencies:
+
+1. without the package cache
+2. with the package cache, filling it (only cold the first time the benchmark runs)
+3. with the package cache, once it has the packages
+
+Usage (with the dev environment running, from the repository root):
+
+    uv run python dev/benchmarks/package_cache.py [http://172.17.0.1:3141]
+"""
+
+import io
+import sys
+import tarfile
+import time
+
+import docker
+
+DOCKERFILES = {
+    "django": """\
+FROM python:3.12-alpine
+ARG PIP_INDEX_URL
+ARG PIP_TRUSTED_HOST
+RUN pip install --no-cache-dir django==5.1.* gunicorn psycopg[binary] pillow
+""",
+    "node": """\
+FROM node:22-alpine
+ARG NPM_CONFIG_REGISTRY
+WORKDIR /site
+RUN npm install --no-audit --no-fund --cache /tmp/npm express@4 next@14 react@18 react-dom@18
+""",
+}
+
+
+def context(dockerfile: str) -> io.BytesIO:
+    fileobj = io.BytesIO()
+    with tarfile.open(fileobj=fileobj, mode="w") as tar:
+        data = dockerfile.encode()
+        info = tarfile.TarInfo("Dockerfile")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    fileobj.seek(0)
+    return fileobj
+
+
+def build(client: docker.DockerClient, dockerfile: str, build_args: dict[str, str]) -> float:
+    start = time.monotonic()
+    for chunk in client.api.build(
+        fileobj=context(dockerfile),
+        custom_context=True,
+        buildargs=build_args,
+        nocache=True,
+        rm=True,
+        decode=True,
+    ):
+        if "error" in chunk:
+            raise RuntimeError(chunk["error"])
+    return time.monotonic() - start
+
+
+def main() -> None:
+    url = (sys.argv[1] if len(sys.argv) > 1 else "http://172.17.0.1:3141").rstrip("/")
+    host = url.split("://", 1)[1].split(":", 1)[0]
+    cached_args = {
+        "PIP_INDEX_URL": f"{url}/pypi/simple/",
+        "PIP_TRUSTED_HOST": host,
+        "NPM_CONFIG_REGISTRY": f"{url}/npm/",
+    }
+
+    client = docker.from_env()
+    # pull the base images first, so they aren't part of the timings
+    for dockerfile in DOCKERFILES.values():
+        client.images.pull(dockerfile.split()[1])
+
+    print(f"{'site':<8} {'no cache':>10} {'cold cache':>12} {'warm cache':>12}")
+    for name, dockerfile in DOCKERFILES.items():
+        without = build(client, dockerfile, {})
+        cold = build(client, dockerfile, cached_args)
+        warm = build(client, dockerfile, cached_args)
+        print(f"{name:<8} {without:>9.1f}s {cold:>11.1f}s {warm:>11.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import pytest
+from django.core.cache import cache
 from django.utils.translation import activate
 
 
@@ -22,6 +23,12 @@ def disable_appservers(settings):
     settings.DIRECTOR_APPSERVER_HOSTS = ["mocked-appserver"]
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    yield
+    cache.clear()
+
+
 @pytest.fixture
 def student(django_user_model):
     return django_user_model.objects.create_user(
@@ -1 +1,27 @@
-# Register your models here.
+from django.contrib import admin, messages
+from django.db import transaction
+
+from . import tasks
+from .models import SiteTemplate
+
+
+@admin.register(SiteTemplate)
+class SiteTemplateAdmin(admin.ModelAdmin):
+    list_display = ("name", "slug", "repository", "version", "is_active")
+    list_filter = ("is_active",)
+    search_fields = ("name", "slug", "repository")
+    prepopulated_fields = {"slug": ("name",)}
+    actions = ("warm_images",)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # get a new version onto the appservers before sites are built from it
+        if obj.is_active:
+            transaction.on_commit(lambda: tasks.warm_template_images.delay([obj.id]))
+
+    @admin.action(description="Pull base images onto all appservers")
+    def warm_images(self, request, queryset):
+        tasks.warm_template_images.delay(list(queryset.values_list("id", flat=True)))
+        self.message_user(
+            request, "Pulling the base images of the selected templates.", messages.SUCCESS
+        )
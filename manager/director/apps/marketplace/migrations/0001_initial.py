@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-17 17:40
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(unique=True)),
+                ('name', models.CharField(max_length=100)),
+                ('description', models.TextField(blank=True)),
+                ('repository', models.CharField(help_text='The image repository the base images of the template are published to.', max_length=255, validators=[django.core.validators.RegexValidator(message='Enter a valid image repository, e.g. registry.example.com/django.', regex='^[a-z0-9]+([._/:-][a-z0-9]+)*$')])),
+                ('version', models.CharField(help_text='The tag of the current base image. Sites built after it changes use the new version.', max_length=128, validators=[django.core.validators.RegexValidator(message='Enter a valid image tag.', regex='^[A-Za-z0-9_][A-Za-z0-9_.-]*$')])),
+                ('is_active', models.BooleanField(default=True, help_text='Whether new sites can be created from the template.')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2 on 2026-10-17 17:42
+
+from django.db import migrations
+
+TEMPLATES = [
+    {
+        "slug": "python",
+        "name": "Python",
+        "description": "Python 3.12, for Django, Flask and FastAPI sites.",
+        "repository": "python",
+        "version": "3.12-alpine",
+    },
+    {
+        "slug": "node",
+        "name": "Node.js",
+        "description": "Node.js 22, for Express and Next.js sites.",
+        "repository": "node",
+        "version": "22-alpine",
+    },
+]
+
+
+def create_templates(apps, schema_editor):
+    SiteTemplate = apps.get_model("marketplace", "SiteTemplate")
+    db_alias = schema_editor.connection.alias
+    for template in TEMPLATES:
+        SiteTemplate.objects.using(db_alias).get_or_create(slug=template["slug"], defaults=template)
+
+def delete_templates(apps, schema_editor):
+    SiteTemplate = apps.get_model("marketplace", "SiteTemplate")
+    db_alias = schema_editor.connection.alias
+    SiteTemplate.objects.using(db_alias).filter(
+        slug__in=[template["slug"] for template in TEMPLATES]
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_templates, delete_templates),
+    ]
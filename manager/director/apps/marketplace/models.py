@@ -1 +1,63 @@
-# Create your models here.
+from typing import Self
+
+from django.core.validators import RegexValidator
+from django.db import models
+
+
+class SiteTemplateQuerySet(models.QuerySet):
+    def filter_active(self) -> Self:
+        """Only show the templates new sites can be created from."""
+        return self.filter(is_active=True)
+
+
+class SiteTemplate(models.Model):
+    """A starting point for dynamic sites, offered in the marketplace.
+
+    Each template has a prebuilt, versioned base image with the stack installed,
+    which is pulled onto every appserver ahead of time (see
+    :func:`.tasks.warm_template_images`). Sites created from a template are built
+    from its image, so their first build only adds a thin layer on top of it.
+    """
+
+    slug = models.SlugField(unique=True)
+    name = models.CharField(max_length=100)
+    description = models.TextField(blank=True)
+
+    repository = models.CharField(
+        max_length=255,
+        validators=[
+            RegexValidator(
+                regex=r"^[a-z0-9]+([._/:-][a-z0-9]+)*$",
+                message="Enter a valid image repository, e.g. registry.example.com/django.",
+            ),
+        ],
+        help_text="The image repository the base images of the template are published to.",
+    )
+    version = models.CharField(
+        max_length=128,
+        validators=[
+            RegexValidator(
+                regex=r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$",
+                message="Enter a valid image tag.",
+            ),
+        ],
+        help_text="The tag of the current base image. Sites built after it changes use the new version.",
+    )
+
+    is_active = models.BooleanField(
+        default=True,
+        help_text="Whether new sites can be created from the template.",
+    )
+
+    objects = SiteTemplateQuerySet.as_manager()
+
+    class Meta:
+        ordering = ["name"]
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def image(self) -> str:
+        """The current base image of the template."""
+        return f"{self.repository}:{self.version}"
@@ -0,0 +1,41 @@
+import logging
+
+import requests
+from celery import shared_task
+
+from ..sites.appserver import Appserver
+from .models import SiteTemplate
+
+logger = logging.getLogger(__name__)
+
+
+def warm_image(appserver: Appserver, image: str) -> bool:
+    """Pulls an image onto an appserver, returning whether it succeeded."""
+    try:
+        response = appserver.http_request(
+            "/api/docker/image/pull", method="POST", data={"image": image}, timeout="build"
+        )
+        response.raise_for_status()
+    except requests.RequestException:
+        logger.warning("Failed to pull %s onto %s", image, appserver, exc_info=True)
+        return False
+    return True
+
+
+@shared_task(ignore_result=True)
+def warm_template_images(template_ids: list[int] | None = None) -> None:
+    """Pulls the base images of the active templates onto every appserver.
+
+    This runs periodically, so appservers that join later (or lose their images)
+    are warmed too. Pulling an image an appserver already has is cheap.
+
+    Args:
+        template_ids: only pull the images of these templates
+    """
+    templates = SiteTemplate.objects.filter_active()
+    if template_ids is not None:
+        templates = templates.filter(id__in=template_ids)
+    images = {template.image for template in templates}
+    for appserver in Appserver.list_pingable():
+        for image in sorted(images):
+            warm_image(appserver, image)
@@ -1 +1,73 @@
-# Create your tests here.
+import json
+
+import pytest
+from django.urls import reverse
+
+from ..sites import tasks as sites_tasks
+from ..sites.appserver import Appserver
+from ..sites.models import Operation, Site
+from ..sites.tests import framework
+from . import tasks
+from .models import SiteTemplate
+
+
+@pytest.fixture
+def site(student) -> Site:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    site.users.add(student)
+    return site
+
+
+@pytest.fixture
+def template() -> SiteTemplate:
+    return SiteTemplate.objects.create(
+        slug="django", name="Django", repository="director/django", version="5.1"
+    )
+
+
+def test_default_templates() -> None:
+    assert set(SiteTemplate.objects.values_list("slug", flat=True)) == {"python", "node"}
+
+
+def test_site_is_built_from_template(site: Site, template: SiteTemplate) -> None:
+    assert "docker" not in site.serialize_for_appserver()
+    site.template = template
+    assert site.serialize_for_appserver()["docker"] == {"base": "director/django:5.1"}
+
+
+def test_use_template(client, monkeypatch, student, site: Site, template: SiteTemplate) -> None:
+    monkeypatch.setattr(sites_tasks, "queue_operation", lambda *_args, **_kwargs: None)
+    client.force_login(student)
+
+    response = client.get(reverse("marketplace:store_for_site", args=[site.id]))
+    assert response.status_code == 200
+    assert template in response.context["templates"]
+
+    response = client.post(
+        reverse("marketplace:use_template", args=[site.id]), {"template": "django"}
+    )
+    assert response.status_code == 302
+    site.refresh_from_db()
+    assert site.template == template
+    assert Operation.objects.get(site=site).ty == "create_site"
+
+
+def test_use_inactive_template(client, student, site: Site, template: SiteTemplate) -> None:
+    template.is_active = False
+    template.save()
+    client.force_login(student)
+
+    response = client.post(
+        reverse("marketplace:use_template", args=[site.id]), {"template": "django"}
+    )
+    assert response.status_code == 404
+
+
+def test_warm_template_images(template: SiteTemplate) -> None:
+    pull = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/pull"
+    with framework.mock() as rsps:
+        rsps.add("POST", pull, json={})
+        tasks.warm_template_images([template.id])
+
+        pulled = [json.loads(call.request.body)["image"] for call in rsps.calls[1:]]
+    assert pulled == ["director/django:5.1"]
@@ -6,4 +6,6 @@ app_name = "marketplace"
 
 urlpatterns = [
     path("store/", views.store, name="store"),
+    path("store/<int:site_id>/", views.store, name="store_for_site"),
+    path("store/<int:site_id>/use", views.use_template, name="use_template"),
 ]
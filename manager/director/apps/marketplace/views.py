@@ -2,16 +2,49 @@ import logging
 
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404, redirect, render
+from django.views.decorators.http import require_POST
 
 from director.djtypes import AuthenticatedHttpRequest
 
+from ..sites.models import Site
+from .models import SiteTemplate
+
 logger = logging.getLogger(__name__)
 
 
+def _get_dynamic_site(request: AuthenticatedHttpRequest, site_id: int) -> Site:
+    return get_object_or_404(
+        Site.objects.filter_editable(request.user).filter(mode="dynamic"), id=site_id
+    )
+
+
 @login_required
-def store(request: AuthenticatedHttpRequest) -> HttpResponse:
+def store(request: AuthenticatedHttpRequest, site_id: int | None = None) -> HttpResponse:
+    """Lists the templates dynamic sites can be created from.
+
+    If a site is given, the templates can be used to set it up.
+    """
+    site = _get_dynamic_site(request, site_id) if site_id is not None else None
+
     return render(
         request,
         "marketplace/store.html",
+        {"templates": SiteTemplate.objects.filter_active(), "site": site},
     )
+
+
+@login_required
+@require_POST
+def use_template(request: AuthenticatedHttpRequest, site_id: int) -> HttpResponse:
+    """Sets up a dynamic site from a template, or from scratch if no template is given."""
+    site = _get_dynamic_site(request, site_id)
+    template = None
+    if slug := request.POST.get("template"):
+        template = get_object_or_404(SiteTemplate.objects.filter_active(), slug=slug)
+
+    site.template = template
+    site.save(update_fields=["template"])
+    # creating the site's image and service also replaces them, if they already exist
+    site.start_operation("create_site")
+    return redirect("sites:index")
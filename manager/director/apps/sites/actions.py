@@ -1,15 +1,26 @@
-import random
+import json
 from collections.abc import Iterator
+from urllib.parse import urlencode
 
 import requests
+from django.conf import settings
+from django.core.cache import cache
 
 from .appserver import Appserver
-from .models import Site
-from .operations import UserFacingError
+from .models import Operation, Site
+from .operations import AppserverBusyError, UserFacingError
+from .selection import select_appserver
+
+# the build that is running for a site, so it can be cancelled
+_BUILD_KEY = "site-build:{}"
+# a request to cancel a site's build that came before the build was submitted
+_CANCEL_KEY = "site-build-cancel:{}"
+# longer than a build can run on an appserver
+_BUILD_KEY_TIMEOUT = 2 * 60 * 60
 
 
 def raise_by_recoverability(site: Site, response: requests.Response):
-    if response.status_code == 200:
+    if response.status_code in (200, 202):
         return
     if response.status_code == 422:
         raise RuntimeError(f"Invalid JSON: {response.json()}")
@@ -32,31 +43,244 @@ def update_docker_service(site: Site, appservers: list[Appserver]) -> Iterator[s
     Expects scope to be populated with ``pingable_appservers``.
     If scope has a :class:`.SiteConfig`, it will use the Docker base image from there.
     """
+    yield from _update_docker_service(site, appservers, restart=False)
+
+
+def restart_docker_service(site: Site, appservers: list[Appserver]) -> Iterator[str]:
+    """Like :func:`update_docker_service`, but always replaces the site's container."""
+    yield from _update_docker_service(site, appservers, restart=True)
+
+
+def _update_docker_service(
+    site: Site, appservers: list[Appserver], *, restart: bool
+) -> Iterator[str]:
     if site.availability == "disabled":
         yield from remove_docker_service(site, appservers)
         return
-    appserver = random.choice(appservers)
+    appserver = select_appserver(appservers, site)
     yield f"Connecting to {appserver} to create/update docker service."
 
     response = appserver.http_request(
-        "/api/docker/service/update",
+        "/api/docker/service/update" + ("?restart=true" if restart else ""),
         method="POST",
         data=site.serialize_for_appserver(),
+        timeout="deploy",
     )
     raise_by_recoverability(site, response)
-    yield "Created/updated Docker service"
+    result = response.json()
+    if result.get("status") == "unchanged":
+        yield "Docker service is up to date"
+        return
+    if result.get("rolled_back"):
+        raise UserFacingError(
+            "The site failed its health check after the update, so the previous version "
+            "was restored. Make sure it responds to HTTP requests on $PORT."
+        )
+    if result.get("status") == "restarted":
+        yield "Restarted Docker service"
+    else:
+        yield "Created/updated Docker service"
+    if result.get("startup_seconds") is not None:
+        yield f"Site started in {result['startup_seconds']:.1f}s"
+
+
+def update_docker_services(
+    sites: list[Site],
+    appservers: list[Appserver],
+    *,
+    concurrency: int | None = None,
+    restart: bool = False,
+) -> Iterator[tuple[Site, str | None]]:
+    """Updates the Docker services of many sites at once, like :func:`update_docker_service`.
+
+    The sites are sent to an appserver in one request, instead of one request each.
+    If ``concurrency`` is set, the appserver updates at most that many services at once.
+    If ``restart`` is set, their containers are replaced even if they are up to date
+    (like :func:`restart_docker_service`).
+
+    Yields:
+        Each site with why updating its service failed (or ``None`` if it didn't),
+        in the order the appserver finishes them.
+    """
+    by_id = {site.id: site for site in sites}
+    batches = (
+        (
+            "/api/docker/service/remove-many",
+            [site for site in sites if site.availability == "disabled"],
+        ),
+        (
+            "/api/docker/service/update-many",
+            [site for site in sites if site.availability != "disabled"],
+        ),
+    )
+    for path, batch in batches:
+        if not batch:
+            continue
+        appserver = select_appserver(appservers, batch[0])
+        params = {"concurrency": concurrency, "restart": "true" if restart else None}
+        query = urlencode({key: value for key, value in params.items() if value is not None})
+        response = appserver.http_request(
+            path + (f"?{query}" if query else ""),
+            method="POST",
+            data=[site.serialize_for_appserver() for site in batch],
+            timeout="deploy",
+            stream=True,
+        )
+        with response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if line.strip():
+                    result = json.loads(line)
+                    yield by_id[result["site"]], _batch_error(result)
+
+
+def _batch_error(result: dict) -> str | None:
+    if result["error"] is not None:
+        return result["error"]
+    if result["result"] is not None and result["result"].get("rolled_back"):
+        return "The site failed its health check after the update"
+    return None
 
 
 def build_docker_image(site: Site, appservers: list[Appserver]) -> Iterator[str]:
-    appserver = random.choice(appservers)
+    """Builds the site's image, unless its inputs haven't changed since the last build."""
+    yield from _build_image(site, appservers, force=False)
+
+
+def rebuild_docker_image(site: Site, appservers: list[Appserver]) -> Iterator[str]:
+    """Builds the site's image from scratch, pulling the newest base image."""
+    yield from _build_image(site, appservers, force=True)
+
+
+def _build_image(site: Site, appservers: list[Appserver], *, force: bool) -> Iterator[str]:
+    """Builds the site's image in the background on an appserver, following its output.
+
+    If the appserver is too busy, this raises :class:`.AppserverBusyError`, so the
+    operation is retried after the delay it asks for.
+    """
+    try:
+        yield from _submit_build(site, appservers, force=force)
+    finally:
+        # so it doesn't cancel the next build
+        cache.delete(_CANCEL_KEY.format(site.id))
+
+
+def _submit_build(site: Site, appservers: list[Appserver], *, force: bool) -> Iterator[str]:
+    appserver = select_appserver(appservers, site, kind="build")
     yield f"Connecting to appserver {appserver} to build docker image."
-    response = appserver.http_request(
-        "/api/docker/image/build",
-        method="POST",
-        data={"site": site.serialize_for_appserver()},
-    )
+    data = {
+        "site": site.serialize_for_appserver(),
+        "build_limits": site.serialize_build_limits(),
+        "force": force,
+    }
+
+    if cache.get(_CANCEL_KEY.format(site.id)) is not None:
+        raise UserFacingError("The build was cancelled")
+    response = appserver.http_request("/api/docker/image/builds", method="POST", data=data)
+    if response.status_code == 429:
+        raise _busy(appserver, response.headers.get("Retry-After"))
     raise_by_recoverability(site, response)
+
+    job_id = response.json()["id"]
+    build_key = _BUILD_KEY.format(site.id)
+    cache.set(build_key, {"host": appserver.host, "job": job_id}, _BUILD_KEY_TIMEOUT)
+    if cache.get(_CANCEL_KEY.format(site.id)) is not None:
+        # it was cancelled while it was being submitted
+        _cancel_job(appserver, job_id)
+    try:
+        yield from _follow_build_log(appserver, job_id)
+    finally:
+        cache.delete(build_key)
+    response = appserver.http_request(f"/api/docker/image/builds/{job_id}", method="GET")
+    raise_by_recoverability(site, response)
+    job = response.json()
+    if job["state"] == "succeeded":
+        yield from _describe_build(job)
+        return
+    if job["retry_after"] is not None:
+        raise _busy(appserver, job["retry_after"])
+    error = job["error"]
+    message = f"{error['description']}: {error['explanation']}"
+    if error["user_error"]:
+        raise UserFacingError(message)
+    raise RuntimeError(message)
+
+
+def _busy(appserver: Appserver, retry_after: str | int | None) -> AppserverBusyError:
+    delay = _retry_delay(retry_after)
+    return AppserverBusyError(
+        f"{appserver} is busy building other sites, retrying in {delay} seconds.",
+        retry_after=delay,
+    )
+
+
+def _describe_build(job: dict) -> Iterator[str]:
+    """Yields a summary of a build that succeeded."""
+    if job.get("up_to_date"):
+        yield "Docker image is up to date"
+        return
     yield "Docker image built"
+    if job.get("context_size") is not None:
+        yield (
+            f"Sent {job['context_size'] / 2**20:.1f} MiB build context "
+            f"in {job['context_upload_seconds']:.1f}s"
+        )
+    if job.get("cache_hit_ratio") is not None:
+        yield f"{job['cache_hit_ratio']:.0%} of build steps were cached"
+
+
+def cancel_build(site: Site) -> bool:
+    """Cancels the image build that is running for a site.
+
+    The operation building the image fails with the reason the build was cancelled.
+    If the build hasn't been submitted to an appserver yet, it's cancelled before
+    it is.
+
+    Returns:
+        Whether a build was running.
+    """
+    from .tasks import BUILD_OPERATION_TYPES
+
+    building = (
+        Operation.objects.filter(site=site, ty__in=BUILD_OPERATION_TYPES)
+        .exclude(started_time=None)
+        .exclude(id__in=Operation.objects.filter_failed().values("id"))
+    )
+    if not building.exists():
+        return False
+    # recorded before looking for the build, which is submitted before the request is
+    # checked for, so one of them sees the other
+    cache.set(_CANCEL_KEY.format(site.id), value=True, timeout=_BUILD_KEY_TIMEOUT)
+
+    build = cache.get(_BUILD_KEY.format(site.id))
+    if build is None:
+        return True
+    response = _cancel_job(Appserver(build["host"]), build["job"])
+    raise_by_recoverability(site, response)
+    return response.json()["state"] not in ("succeeded", "failed")
+
+
+def _cancel_job(appserver: Appserver, job_id: str) -> requests.Response:
+    return appserver.http_request(f"/api/docker/image/builds/{job_id}/cancel", method="POST")
+
+
+def _retry_delay(retry_after: str | int | None) -> int:
+    """How long to wait before retrying a build on a busy appserver."""
+    if retry_after is None:
+        return settings.DIRECTOR_BUILD_BUSY_MAX_DELAY
+    return min(int(retry_after), settings.DIRECTOR_BUILD_BUSY_MAX_DELAY)
+
+
+def _follow_build_log(appserver: Appserver, job_id: str) -> Iterator[str]:
+    """Yields the lines of a build's output as the appserver produces them."""
+    response = appserver.http_request(
+        f"/api/docker/image/builds/{job_id}/log", method="GET", timeout="build", stream=True
+    )
+    with response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line.strip():
+                yield line
 
 
 # For the following delete/remove actions, we don't really
@@ -64,7 +288,7 @@ def build_docker_image(site: Site, appservers: list[Appserver]) -> Iterator[str]
 
 
 def delete_site_files(site: Site, appservers: list[Appserver]) -> Iterator[str]:
-    appserver = random.choice(appservers)
+    appserver = select_appserver(appservers, site)
     yield f"Connecting to {appserver} to delete site files."
     appserver.http_request(
         "/api/files/delete-all",
@@ -75,7 +299,7 @@ def delete_site_files(site: Site, appservers: list[Appserver]) -> Iterator[str]:
 
 
 def delete_site_database(site: Site, appservers: list[Appserver]) -> Iterator[str]:
-    appserver = random.choice(appservers)
+    appserver = select_appserver(appservers, site)
     yield f"Connecting to {appserver} to delete site database."
     appserver.http_request(
         "/api/database/delete",
@@ -86,7 +310,7 @@ def delete_site_database(site: Site, appservers: list[Appserver]) -> Iterator[st
 
 
 def remove_docker_service(site: Site, appservers: list[Appserver]) -> Iterator[str]:
-    appserver = random.choice(appservers)
+    appserver = select_appserver(appservers, site)
     yield f"Removing Docker service on {appserver}"
     appserver.http_request(
         "/api/docker/service/remove",
@@ -97,7 +321,7 @@ def remove_docker_service(site: Site, appservers: list[Appserver]) -> Iterator[s
 
 
 def remove_docker_image(site: Site, appservers: list[Appserver]) -> Iterator[str]:
-    appserver = random.choice(appservers)
+    appserver = select_appserver(appservers, site)
     yield f"Removing Docker image on {appserver}"
     appserver.http_request(
         "/api/docker/image/delete",
@@ -1,5 +1,10 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.http import Http404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
 
+from . import fleet
 from .models import (
     Action,
     Database,
@@ -14,6 +19,56 @@ class SiteAdmin(admin.ModelAdmin):
     list_display = ("name", "mode", "purpose", "availability")
     list_filter = ("mode", "availability")
     search_fields = ("name",)
+    actions = ("rebuild_images", "update_resource_limits", "restart_sites")
+
+    def get_urls(self):
+        return [
+            path(
+                "fleet/<str:fleet_id>/",
+                self.admin_site.admin_view(self.fleet_progress_view),
+                name="sites_site_fleet_progress",
+            ),
+            *super().get_urls(),
+        ]
+
+    def fleet_progress_view(self, request, fleet_id: str):
+        """Shows the progress of a fleet operation started from the site list."""
+        progress = fleet.get_progress(fleet_id)
+        if progress is None:
+            raise Http404("Unknown fleet operation")
+        context = {
+            **self.admin_site.each_context(request),
+            "title": f"Fleet operation {fleet_id}",
+            "opts": self.model._meta,
+            "progress": progress,
+        }
+        return TemplateResponse(request, "admin/sites/site/fleet_progress.html", context)
+
+    def _start_fleet_operation(self, request, queryset, ty: str) -> None:
+        fleet_id = fleet.start_fleet_operation(ty, queryset)
+        self.message_user(
+            request,
+            format_html(
+                'Started {} on {} sites (<a href="{}">fleet operation {}</a>).',
+                ty,
+                queryset.count(),
+                reverse("admin:sites_site_fleet_progress", args=[fleet_id]),
+                fleet_id,
+            ),
+            messages.SUCCESS,
+        )
+
+    @admin.action(description="Rebuild Docker images of selected sites")
+    def rebuild_images(self, request, queryset):
+        self._start_fleet_operation(request, queryset, "update_docker_image")
+
+    @admin.action(description="Apply resource limits to selected sites")
+    def update_resource_limits(self, request, queryset):
+        self._start_fleet_operation(request, queryset, "update_resource_limits")
+
+    @admin.action(description="Restart selected sites")
+    def restart_sites(self, request, queryset):
+        self._start_fleet_operation(request, queryset, "restart_site")
 
 
 @admin.register(DatabaseHost)
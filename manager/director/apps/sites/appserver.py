@@ -1,9 +1,142 @@
 """A module for connecting to the appservers."""
 
-from typing import Any, Self
+import contextlib
+import os
+import threading
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from typing import Any, Literal, Self
 
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+from . import health, metrics
+
+type TimeoutClass = Literal["ping", "default", "deploy", "build"]
+"""The class of an appserver endpoint, used to look up its timeouts.
+
+See ``DIRECTOR_APPSERVER_TIMEOUTS`` in the settings.
+"""
+
+_OUTSTANDING_KEY = "appserver-outstanding:{}"
+_LOAD_KEY = "appserver-load:{}"
+_MISSING = object()
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+# the statistics of each pool when they were last added to the metrics
+_recorded_stats: dict[str, "ConnectionStats"] = {}
+_recorded_stats_lock = threading.Lock()
+
+# Celery forks its worker processes, and sockets must never be shared
+# between processes. Each child starts with an empty pool instead.
+os.register_at_fork(after_in_child=_sessions.clear)
+os.register_at_fork(after_in_child=_recorded_stats.clear)
+
+
+@dataclass(frozen=True, slots=True)
+class ConnectionStats:
+    """Connection reuse statistics for a single appserver in this process.
+
+    Args:
+        requests: the number of requests sent through the pool
+        connections: the number of new connections the pool had to open
+    """
+
+    requests: int
+    connections: int
+
+    @property
+    def reuse_ratio(self) -> float:
+        """The fraction of requests that were sent over an already open connection."""
+        if self.requests == 0:
+            return 0.0
+        return max(0.0, 1 - self.connections / self.requests)
+
+
+@dataclass(frozen=True, slots=True)
+class Load:
+    """How busy an appserver is, as reported by its ``/status/load`` endpoint.
+
+    Args:
+        running_builds: the number of Docker images being built
+        cpu: the 1-minute load average, divided by the number of CPUs
+        memory: the fraction of memory in use
+    """
+
+    running_builds: int
+    cpu: float
+    memory: float
+
+
+def get_session(host: str) -> requests.Session:
+    """Returns the pooled :class:`requests.Session` for an appserver.
+
+    Sessions are created lazily, once per host per worker process, and keep
+    connections (and TLS sessions) alive between requests.
+
+    Args:
+        host: the hostname of the appserver
+    """
+    if (session := _sessions.get(host)) is not None:
+        return session
+    with _sessions_lock:
+        if (session := _sessions.get(host)) is None:
+            session = _sessions[host] = _create_session(host)
+    return session
+
+
+def _create_session(host: str) -> requests.Session:
+    session = requests.Session()
+    session.hooks["response"].append(lambda _response, *_args, **_kwargs: _record_stats(host))
+    # each session only ever talks to one host, so we only need one pool
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.DIRECTOR_APPSERVER_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    if (ssl := settings.DIRECTOR_APPSERVER_SSL) is not None:
+        session.verify = str(ssl["cafile"])
+        if (client_cert := ssl.get("client_cert")) is not None:
+            session.cert = (str(client_cert["certfile"]), str(client_cert["keyfile"]))
+    return session
+
+
+def connection_stats() -> dict[str, ConnectionStats]:
+    """Returns the connection reuse statistics of every appserver this process has talked to."""
+    return {host: _pool_stats(host, session) for host, session in _sessions.copy().items()}
+
+
+def _pool_stats(host: str, session: requests.Session) -> ConnectionStats:
+    num_requests = num_connections = 0
+    adapter = session.get_adapter(f"{Appserver.protocol()}://{host}")
+    assert isinstance(adapter, HTTPAdapter)
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        if (pool := pools.get(key)) is not None:
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+    return ConnectionStats(requests=num_requests, connections=num_connections)
+
+
+def _record_stats(host: str) -> None:
+    """Adds the requests and connections since the last response to the metrics.
+
+    The pools only keep running totals for this process, so the metrics get the
+    difference, which lets them be combined across processes.
+    """
+    if (session := _sessions.get(host)) is None:
+        return
+    with _recorded_stats_lock:
+        stats = _pool_stats(host, session)
+        previous = _recorded_stats.get(host, ConnectionStats(requests=0, connections=0))
+        _recorded_stats[host] = stats
+    metrics.appserver_connections_used(
+        host,
+        requests=max(0, stats.requests - previous.requests),
+        connections=max(0, stats.connections - previous.connections),
+    )
 
 
 class Appserver:
@@ -27,7 +160,9 @@ class Appserver:
     @property
     def num(self) -> int:
         """Returns the index of the appserver in the list of appservers."""
-        return settings.DIRECTOR_APPSERVER_HOSTS.index(self.host) + 1
+        if self.host in settings.DIRECTOR_APPSERVER_HOSTS:
+            return settings.DIRECTOR_APPSERVER_HOSTS.index(self.host) + 1
+        return health.known_hosts().index(self.host) + 1
 
     def __str__(self) -> str:
         return f"{type(self).__name__} {self.num}"
@@ -37,13 +172,33 @@ class Appserver:
         """Returns the protocol to use for connecting to the appserver."""
         return "https" if settings.DIRECTOR_APPSERVER_SSL else "http"
 
+    @staticmethod
+    def timeout(timeout_class: TimeoutClass) -> tuple[float, float]:
+        """Returns the ``(connect, read)`` timeouts for a class of endpoints."""
+        return settings.DIRECTOR_APPSERVER_TIMEOUTS[timeout_class]
+
     @classmethod
     def list_pingable(cls) -> list[Self]:
-        """Return a list of all pingable appservers."""
-        hosts = [cls(host) for host in settings.DIRECTOR_APPSERVER_HOSTS if cls._can_ping(host)]
+        """Return a list of all pingable appservers.
+
+        This reads the shared health registry (see :mod:`.health`), and only
+        pings the appservers itself if the registry is empty.
+        """
+        hosts = health.healthy_hosts()
+        if hosts is None:
+            hosts = cls.refresh_health()
         if not hosts:
             raise RuntimeError("No pingable app servers found")
-        return hosts
+        return [cls(host) for host in hosts]
+
+    @classmethod
+    def refresh_health(cls) -> list[str]:
+        """Pings every known appserver concurrently, and updates the health registry.
+
+        Returns:
+            The hostnames of the healthy appservers.
+        """
+        return health.refresh(cls._can_ping)
 
     @classmethod
     def _can_ping(cls, host: str) -> bool:
@@ -53,38 +208,126 @@ class Appserver:
             Whether or not the host is pingable and responded correctly.
         """
         try:
-            response = requests.get(f"{cls.protocol()}://{host}/ping", {"message": f"pong-{host}"})
+            response = get_session(host).get(
+                f"{cls.protocol()}://{host}/ping",
+                params={"message": f"pong-{host}"},
+                timeout=cls.timeout("ping"),
+            )
             return response.status_code == 200 and response.json().get("message") == f"pong-{host}"
         except Exception:  # noqa: BLE001
             return False
 
+    @property
+    def outstanding_requests(self) -> int:
+        """The number of requests to this appserver that are in flight, across all workers."""
+        return max(0, cache.get(_OUTSTANDING_KEY.format(self.host), 0))
+
+    @contextlib.contextmanager
+    def _track_outstanding(self) -> Iterator[None]:
+        key = _OUTSTANDING_KEY.format(self.host)
+        # The counter expires, so that it eventually recovers from workers
+        # that were killed in the middle of a request.
+        cache.add(key, 0, timeout=60 * 60)
+        try:
+            cache.incr(key)
+        except ValueError:  # expired in between
+            cache.add(key, 1, timeout=60 * 60)
+        try:
+            yield
+        finally:
+            with contextlib.suppress(ValueError):
+                cache.decr(key)
+
+    def load(self) -> Load | None:
+        """Returns how busy the appserver is.
+
+        The result is cached for ``DIRECTOR_APPSERVER_LOAD_TTL`` seconds.
+
+        Returns:
+            The load of the appserver, or ``None`` if the appserver didn't report it.
+        """
+        key = _LOAD_KEY.format(self.host)
+        if (load := cache.get(key, _MISSING)) is not _MISSING:
+            return load
+
+        try:
+            response = get_session(self.host).get(
+                f"{self.protocol()}://{self.host}/status/load",
+                timeout=self.timeout("ping"),
+            )
+            response.raise_for_status()
+            content = response.json()
+            load = Load(
+                running_builds=int(content["running_builds"]),
+                cpu=float(content["cpu"]),
+                memory=float(content["memory"]),
+            )
+        except (requests.RequestException, KeyError, TypeError, ValueError):
+            load = None
+        cache.set(key, load, settings.DIRECTOR_APPSERVER_LOAD_TTL)
+        return load
+
     def http_request(
-        self, path: str, method: str, data: dict[str, Any] | None = None
+        self,
+        path: str,
+        method: str,
+        data: dict[str, Any] | list[Any] | None = None,
+        *,
+        timeout: TimeoutClass = "default",
+        stream: bool = False,
     ) -> requests.Response:
         """Makes an HTTP request to the appserver.
 
+        The request is sent over this worker's pooled connection to the appserver.
+
         Args:
             path: the api endpoint
             method: the HTTP verb to use
             data: the json-deserializable data to send
+            timeout: the class of endpoint, which determines the connect/read timeouts
+            stream: whether to read the response body as it arrives, instead of all at once.
+                The response must be closed once it's read, so the connection can be reused
+                (and the request stops counting towards :attr:`outstanding_requests`).
         """
         assert path.startswith("/")
-        try:
-            response = requests.request(
-                method.upper(), f"{self.protocol()}://{self.host}{path}", json=data
-            )
-        except (
-            requests.ConnectionError,
-            requests.ConnectTimeout,
-            requests.HTTPError,
-            requests.URLRequired,
-            requests.TooManyRedirects,
-            requests.ReadTimeout,
-            requests.Timeout,
-            requests.RequestException,
-            requests.JSONDecodeError,
-        ) as e:
-            e.add_note(f"Failed to connect to {path} ({method=}) on {self}: {data=}")
-            raise
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(self._track_outstanding())
+            try:
+                response = get_session(self.host).request(
+                    method.upper(),
+                    f"{self.protocol()}://{self.host}{path}",
+                    json=data,
+                    timeout=self.timeout(timeout),
+                    stream=stream,
+                )
+            except (
+                requests.ConnectionError,
+                requests.ConnectTimeout,
+                requests.HTTPError,
+                requests.URLRequired,
+                requests.TooManyRedirects,
+                requests.ReadTimeout,
+                requests.Timeout,
+                requests.RequestException,
+                requests.JSONDecodeError,
+            ) as e:
+                e.add_note(f"Failed to connect to {path} ({method=}) on {self}: {data=}")
+                raise
+            if stream:
+                # the request is still in flight until its body has been read
+                _call_on_close(response, stack.pop_all().close)
 
         return response
+
+
+def _call_on_close(response: requests.Response, callback: Callable[[], object]) -> None:
+    """Calls ``callback`` once the response is closed (e.g. by ``with response:``)."""
+    close = response.close
+
+    def close_and_call() -> None:
+        try:
+            close()
+        finally:
+            callback()
+
+    response.close = close_and_call  # type: ignore[method-assign]
@@ -0,0 +1,65 @@
+"""Websocket consumers that push updates about sites to the browser."""
+
+from __future__ import annotations
+
+from typing import Any
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .models import Site
+
+
+def site_group_name(site_id: int) -> str:
+    """Returns the name of the channel layer group receiving events for a site."""
+    return f"site-{site_id}"
+
+
+class SiteConsumer(AsyncJsonWebsocketConsumer):
+    """Pushes events about sites' operations to the users who can see the sites.
+
+    A page opens a single connection, and subscribes it to the sites it shows by
+    sending ``{"subscribe": [site ids]}``. Sites the user can't see are ignored.
+    Every event carries the ``site_id`` it is about.
+
+    Events are deltas (e.g. the newly added lines of an action's message), so
+    clients never need to poll for, or re-render, the whole operation.
+    The action messages are only sent to superusers, just like they are
+    only shown to superusers.
+    """
+
+    async def connect(self) -> None:
+        self.group_names: set[str] = set()
+        if not self.scope["user"].is_authenticated:
+            await self.close()
+            return
+        await self.accept()
+
+    async def disconnect(self, code: int) -> None:
+        for group_name in self.group_names:
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+
+    async def receive_json(self, content: Any, **kwargs: Any) -> None:
+        site_ids = content.get("subscribe") if isinstance(content, dict) else None
+        if not isinstance(site_ids, list):
+            return
+        site_ids = [site_id for site_id in site_ids if isinstance(site_id, int)]
+        for site_id in await self._visible(self.scope["user"], site_ids):
+            group_name = site_group_name(site_id)
+            if group_name not in self.group_names:
+                self.group_names.add(group_name)
+                await self.channel_layer.group_add(group_name, self.channel_name)
+
+    async def site_event(self, event: dict[str, Any]) -> None:
+        """Forwards an event sent to a site's group."""
+        data = event["data"]
+        if "message" in data and not self.scope["user"].is_superuser:
+            return
+        await self.send_json(data)
+
+    @staticmethod
+    @database_sync_to_async
+    def _visible(user, site_ids: list[int]) -> list[int]:
+        return list(
+            Site.objects.filter_visible(user).filter(id__in=site_ids).values_list("id", flat=True)
+        )
@@ -0,0 +1,297 @@
+"""Applying an operation to many sites at once.
+
+For example, rebuilding every dynamic site after its base image was patched.
+Fleet operations queue the operation on each site like a user would (see
+:meth:`.Site.start_operation`), but only keep a limited number of them in flight,
+so the appservers aren't overloaded:
+
+* at most ``DIRECTOR_FLEET_MAX_CONCURRENT`` operations at once, and
+* at most ``DIRECTOR_FLEET_MAX_PER_APPSERVER`` operations per healthy appserver.
+
+No new operations are started while any appserver is already busy with that many
+requests (from any source).
+
+Fleet operations that only update the sites' Docker services can instead be applied
+in batches, which update many services with a single request to an appserver (see
+:func:`.actions.update_docker_services`).
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+import uuid
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, field
+from typing import Any
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from . import actions
+from .appserver import Appserver
+from .models import Operation, Site
+
+_PROGRESS_KEY = "fleet-progress:{}"
+_PROGRESS_TIMEOUT = 24 * 60 * 60
+
+FLEET_OPERATION_TYPES = (
+    "fix_site",
+    "update_docker_image",
+    "update_resource_limits",
+    "restart_site",
+)
+"""The types of operations that can be applied to many sites at once."""
+
+BATCHED_OPERATION_TYPES = frozenset({"update_resource_limits", "restart_site"})
+"""The types of fleet operations that only update the sites' Docker services."""
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class FleetProgress:
+    """The progress of a fleet operation.
+
+    Args:
+        ty: the type of operation
+        total: the number of sites
+        succeeded: the number of sites the operation succeeded on
+        failed: the names of the sites the operation failed on
+        running: the number of operations in flight
+        elapsed: the number of seconds since the fleet operation started
+    """
+
+    ty: str
+    total: int
+    succeeded: int = 0
+    failed: tuple[str, ...] = ()
+    running: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def finished(self) -> int:
+        return self.succeeded + len(self.failed)
+
+    @property
+    def pending(self) -> int:
+        return self.total - self.finished - self.running
+
+    @property
+    def is_done(self) -> bool:
+        return self.finished == self.total
+
+    @property
+    def throughput(self) -> float:
+        """The number of sites finished per minute."""
+        return 60 * self.finished / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.ty}: {self.finished}/{self.total} finished "
+            f"({self.succeeded} succeeded, {len(self.failed)} failed, {self.running} running), "
+            f"{self.throughput:.1f} sites/min"
+        )
+
+
+@dataclass(slots=True)
+class FleetRunner:
+    """Runs an operation on many sites, with bounded concurrency.
+
+    Args:
+        ty: the type of operation, one of :data:`FLEET_OPERATION_TYPES`
+        site_ids: the sites to run the operation on
+        fleet_id: identifies the fleet operation, for :func:`get_progress`
+        max_concurrent: overrides ``DIRECTOR_FLEET_MAX_CONCURRENT``
+        max_per_appserver: overrides ``DIRECTOR_FLEET_MAX_PER_APPSERVER``
+        batch_size: if set, operations in :data:`BATCHED_OPERATION_TYPES` are applied
+            to this many sites at a time, with one request to an appserver
+    """
+
+    ty: str
+    site_ids: list[int]
+    fleet_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    max_concurrent: int | None = None
+    max_per_appserver: int | None = None
+    batch_size: int | None = None
+
+    _pending: list[int] = field(init=False)
+    # operation ids, mapped to the name of their site
+    _running: dict[int, str] = field(init=False, default_factory=dict)
+    _succeeded: int = field(init=False, default=0)
+    _failed: list[str] = field(init=False, default_factory=list)
+    # wall clock time, since a fleet operation's steps can run in different processes
+    _started_at: float = field(init=False, default_factory=time.time)
+
+    def __post_init__(self) -> None:
+        assert self.ty in FLEET_OPERATION_TYPES, f"{self.ty} can't be run as a fleet operation"
+        self._pending = list(reversed(self.site_ids))
+
+    @property
+    def progress(self) -> FleetProgress:
+        return FleetProgress(
+            ty=self.ty,
+            total=len(self.site_ids),
+            succeeded=self._succeeded,
+            failed=tuple(self._failed),
+            running=len(self._running),
+            elapsed=time.time() - self._started_at,
+        )
+
+    def state(self) -> dict[str, Any]:
+        """Returns the state of the fleet operation, for :meth:`restore` (as JSON)."""
+        return {
+            "pending": self._pending,
+            "running": list(self._running.items()),
+            "succeeded": self._succeeded,
+            "failed": self._failed,
+            "started_at": self._started_at,
+        }
+
+    def restore(self, state: dict[str, Any]) -> None:
+        """Carries on from the state returned by :meth:`state`, e.g. in another process."""
+        self._pending = list(state["pending"])
+        self._running = dict(state["running"])
+        self._succeeded = state["succeeded"]
+        self._failed = list(state["failed"])
+        self._started_at = state["started_at"]
+
+    def capacity(self) -> int:
+        """Returns how many more operations can be started right now.
+
+        Operations can all end up on the same appserver (e.g. builds prefer their
+        site's appserver), so this is throttled by the busiest appserver.
+        """
+        appservers = Appserver.list_pingable()
+        if not appservers:
+            return 0
+        max_per_appserver = self.max_per_appserver or settings.DIRECTOR_FLEET_MAX_PER_APPSERVER
+        max_concurrent = self.max_concurrent or settings.DIRECTOR_FLEET_MAX_CONCURRENT
+
+        busiest = max(appserver.outstanding_requests for appserver in appservers)
+        budget = min(max_concurrent, max_per_appserver * len(appservers)) - len(self._running)
+        return max(0, min(budget, max_per_appserver - busiest))
+
+    def step(self) -> FleetProgress:
+        """Collects the finished operations, and starts as many new ones as allowed."""
+        self._collect()
+        if self._pending:
+            capacity = self.capacity()
+            if self.batch_size and self.ty in BATCHED_OPERATION_TYPES:
+                if capacity:
+                    self._run_batch(self.batch_size, concurrency=capacity)
+            else:
+                for _ in range(min(capacity, len(self._pending))):
+                    self._start(self._pending.pop())
+
+        progress = self.progress
+        cache.set(_PROGRESS_KEY.format(self.fleet_id), progress, _PROGRESS_TIMEOUT)
+        return progress
+
+    def run(self, on_progress: Callable[[FleetProgress], object] | None = None) -> FleetProgress:
+        """Runs the operation on every site, blocking until they have all finished.
+
+        Args:
+            on_progress: called with the progress whenever an operation starts or finishes
+        """
+        last = None
+        while True:
+            progress = self.step()
+            if on_progress is not None and (last is None or progress.finished != last.finished):
+                on_progress(progress)
+            if progress.is_done:
+                return progress
+            last = progress
+            time.sleep(settings.DIRECTOR_FLEET_POLL_INTERVAL)
+
+    def _start(self, site_id: int) -> None:
+        site = Site.objects.filter(id=site_id).first()
+        if site is None:
+            # deleted since the fleet operation was queued
+            self._succeeded += 1
+            return
+        operation = site.start_operation(self.ty, interactive=False)
+        self._running[operation.id] = site.name
+
+    def _run_batch(self, batch_size: int, *, concurrency: int) -> None:
+        """Updates the services of the next sites directly, without queueing operations.
+
+        The appserver updates at most ``concurrency`` of them at once.
+        """
+        site_ids = [self._pending.pop() for _ in range(min(batch_size, len(self._pending)))]
+        # sites with queued operations get one too, so they run in order. Those count
+        # towards the capacity, so the rest wait for a later step.
+        busy = set(
+            Operation.objects.filter(site_id__in=site_ids)
+            .exclude(id__in=Operation.objects.filter_failed().values("id"))
+            .values_list("site_id", flat=True)
+        )
+        busy_ids = [site_id for site_id in site_ids if site_id in busy]
+        for site_id in busy_ids[:concurrency]:
+            self._start(site_id)
+        self._pending.extend(reversed(busy_ids[concurrency:]))
+        sites = {
+            site.id: site for site in Site.objects.filter(id__in=site_ids).exclude(id__in=busy)
+        }
+        # deleted since the fleet operation was queued
+        self._succeeded += len(site_ids) - len(busy) - len(sites)
+
+        try:
+            for site, error in actions.update_docker_services(
+                list(sites.values()),
+                Appserver.list_pingable(),
+                concurrency=concurrency,
+                restart=self.ty == "restart_site",
+            ):
+                del sites[site.id]
+                if error is None:
+                    self._succeeded += 1
+                else:
+                    logger.warning("Failed to update the service of %s: %s", site.name, error)
+                    self._failed.append(site.name)
+        except requests.RequestException:
+            logger.warning("Failed to update a batch of services", exc_info=True)
+        # the appserver didn't report back on these
+        self._failed.extend(site.name for site in sites.values())
+
+    def _collect(self) -> None:
+        if not self._running:
+            return
+        remaining = set(Operation.objects.filter(id__in=self._running).values_list("id", flat=True))
+        failed = set(
+            Operation.objects.filter_failed().filter(id__in=remaining).values_list("id", flat=True)
+        )
+        for operation_id in list(self._running):
+            # successful operations are deleted (or were coalesced into a later operation)
+            if operation_id not in remaining:
+                self._succeeded += 1
+            elif operation_id in failed:
+                self._failed.append(self._running[operation_id])
+            else:
+                continue
+            del self._running[operation_id]
+
+
+def get_progress(fleet_id: str) -> FleetProgress | None:
+    """Returns the last reported progress of a fleet operation, if it is known."""
+    return cache.get(_PROGRESS_KEY.format(fleet_id))
+
+
+def start_fleet_operation(ty: str, sites: Iterable[Site]) -> str:
+    """Runs an operation on many sites in the background.
+
+    Returns:
+        The id of the fleet operation, for :func:`get_progress`.
+    """
+    from . import tasks
+
+    fleet_id = uuid.uuid4().hex
+    site_ids = [site.id for site in sites]
+    cache.set(
+        _PROGRESS_KEY.format(fleet_id),
+        FleetProgress(ty=ty, total=len(site_ids)),
+        _PROGRESS_TIMEOUT,
+    )
+    tasks.run_fleet_operation.delay(fleet_id, ty, site_ids)
+    return fleet_id
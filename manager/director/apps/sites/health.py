@@ -0,0 +1,184 @@
+"""A shared registry of appserver health.
+
+The registry lives in the Django cache, so every worker sees the same view of
+which appservers are up. It is kept up to date by the ``ping_appservers``
+periodic task, which pings all known appservers concurrently.
+
+Appservers are either listed in ``DIRECTOR_APPSERVER_HOSTS``, or register
+themselves dynamically by sending heartbeats to the Manager.
+"""
+
+from __future__ import annotations
+
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+
+_HEALTH_KEY = "appserver-health:{}"
+_HEARTBEAT_KEY = "appserver-heartbeat:{}"
+_REGISTERED_KEY = "appserver-registered"
+_REGISTERED_LOCK_KEY = "appserver-registered:lock"
+_REGISTERED_LOCK_TIMEOUT = 5  # seconds
+_REGISTERED_LOCK_POLL_INTERVAL = 0.01  # seconds
+
+
+@dataclass(frozen=True, slots=True)
+class HostHealth:
+    """The last known health of an appserver.
+
+    Args:
+        healthy: whether the appserver should receive operations
+        successes: the number of consecutive successful pings
+        failures: the number of consecutive failed pings
+        checked_at: the unix timestamp of the last ping
+    """
+
+    healthy: bool
+    successes: int
+    failures: int
+    checked_at: float
+
+    def record(self, *, pingable: bool) -> HostHealth:
+        """Returns the health after another ping.
+
+        To avoid flapping, an appserver is only marked as down after
+        ``DIRECTOR_APPSERVER_HEALTH_FALL`` consecutive failed pings, and
+        back up after ``DIRECTOR_APPSERVER_HEALTH_RISE`` consecutive successful pings.
+        """
+        successes = self.successes + 1 if pingable else 0
+        failures = 0 if pingable else self.failures + 1
+
+        healthy = self.healthy
+        if healthy and failures >= settings.DIRECTOR_APPSERVER_HEALTH_FALL:
+            healthy = False
+        elif not healthy and successes >= settings.DIRECTOR_APPSERVER_HEALTH_RISE:
+            healthy = True
+
+        return HostHealth(
+            healthy=healthy, successes=successes, failures=failures, checked_at=time.time()
+        )
+
+    @classmethod
+    def first(cls, *, pingable: bool) -> HostHealth:
+        """The health of an appserver that has been pinged for the first time."""
+        return cls(
+            healthy=pingable,
+            successes=int(pingable),
+            failures=int(not pingable),
+            checked_at=time.time(),
+        )
+
+
+def known_hosts() -> list[str]:
+    """Returns the configured appservers, followed by any registered through heartbeats."""
+    hosts = list(settings.DIRECTOR_APPSERVER_HOSTS)
+    registered = cache.get(_REGISTERED_KEY, [])
+    alive = _alive(registered)
+    if len(alive) < len(registered):
+        # someone else may be updating the list, in which case the next call prunes it
+        _update_registered(_alive, wait=False)
+    return hosts + [host for host in alive if host not in hosts]
+
+
+def register_heartbeat(host: str) -> None:
+    """Records a heartbeat from an appserver, registering it if it was unknown.
+
+    A registered appserver is forgotten once it stops sending heartbeats for
+    ``DIRECTOR_APPSERVER_HEARTBEAT_TTL`` seconds.
+    """
+    cache.set(_HEARTBEAT_KEY.format(host), time.time(), settings.DIRECTOR_APPSERVER_HEARTBEAT_TTL)
+    if host not in cache.get(_REGISTERED_KEY, []):
+        # if this gives up waiting for the lock, the next heartbeat registers it
+        _update_registered(
+            lambda registered: _alive(registered) + ([] if host in registered else [host]),
+            wait=True,
+        )
+
+
+def _alive(hosts: list[str]) -> list[str]:
+    """Returns the registered appservers that are still sending heartbeats."""
+    heartbeats = cache.get_many([_HEARTBEAT_KEY.format(host) for host in hosts])
+    return [host for host in hosts if _HEARTBEAT_KEY.format(host) in heartbeats]
+
+
+def _update_registered(update: Callable[[list[str]], list[str]], *, wait: bool) -> None:
+    """Updates the list of registered appservers.
+
+    The cache can't add to a list atomically, so this holds a lock while it reads
+    and writes the list, so that concurrent heartbeats from different appservers
+    can't overwrite each other.
+
+    Args:
+        update: returns the new list, given the current one
+        wait: whether to wait for the lock (for up to ``_REGISTERED_LOCK_TIMEOUT``
+            seconds) if another worker holds it, instead of giving up right away
+    """
+    deadline = time.monotonic() + _REGISTERED_LOCK_TIMEOUT
+    # the lock expires, in case the worker holding it is killed
+    while not cache.add(_REGISTERED_LOCK_KEY, value=True, timeout=_REGISTERED_LOCK_TIMEOUT):
+        if not wait or time.monotonic() >= deadline:
+            return
+        time.sleep(_REGISTERED_LOCK_POLL_INTERVAL)
+    try:
+        cache.set(_REGISTERED_KEY, update(cache.get(_REGISTERED_KEY, [])), timeout=None)
+    finally:
+        cache.delete(_REGISTERED_LOCK_KEY)
+
+
+def get_health(hosts: Iterable[str]) -> dict[str, HostHealth]:
+    """Returns the last known health of the given appservers.
+
+    Appservers that have not been pinged within ``DIRECTOR_APPSERVER_HEALTH_TTL``
+    seconds are left out.
+    """
+    keys = {_HEALTH_KEY.format(host): host for host in hosts}
+    return {keys[key]: health for key, health in cache.get_many(keys).items()}
+
+
+def healthy_hosts() -> list[str] | None:
+    """Returns the known appservers that are healthy.
+
+    Returns:
+        The healthy appservers, or ``None`` if the registry has no (unexpired)
+        information on any appserver, e.g. because the pinger is not running.
+    """
+    hosts = known_hosts()
+    health = get_health(hosts)
+    if not health:
+        return None
+    return [host for host in hosts if host in health and health[host].healthy]
+
+
+def refresh(ping: Callable[[str], bool]) -> list[str]:
+    """Pings all known appservers concurrently, and updates the registry.
+
+    Args:
+        ping: a function that returns whether an appserver is pingable
+
+    Returns:
+        The appservers that are healthy after the update.
+    """
+    hosts = known_hosts()
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(max_workers=len(hosts)) as pool:
+        results = dict(zip(hosts, pool.map(ping, hosts), strict=True))
+
+    previous = get_health(hosts)
+    updated = {
+        host: (
+            previous[host].record(pingable=pingable)
+            if host in previous
+            else HostHealth.first(pingable=pingable)
+        )
+        for host, pingable in results.items()
+    }
+    cache.set_many(
+        {_HEALTH_KEY.format(host): health for host, health in updated.items()},
+        settings.DIRECTOR_APPSERVER_HEALTH_TTL,
+    )
+    return [host for host in hosts if updated[host].healthy]
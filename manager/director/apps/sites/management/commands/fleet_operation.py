@@ -0,0 +1,49 @@
+from director.apps.sites.fleet import FLEET_OPERATION_TYPES, FleetRunner
+from director.apps.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Run an operation on many sites, without overloading the appservers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("operation", choices=FLEET_OPERATION_TYPES, help="Operation to run")
+        parser.add_argument("sites", nargs="*", help="Names of the sites (default: all sites)")
+        parser.add_argument("--mode", choices=["static", "dynamic"], help="Only sites in this mode")
+        parser.add_argument("--purpose", help="Only sites with this purpose")
+        parser.add_argument(
+            "--max-concurrent", type=int, help="Maximum number of operations in flight"
+        )
+        parser.add_argument(
+            "--max-per-appserver", type=int, help="Maximum operations in flight per appserver"
+        )
+
+    def handle(self, *args, **options):
+        sites = Site.objects.all()
+        if options["sites"]:
+            sites = sites.filter(name__in=options["sites"])
+            missing = set(options["sites"]) - set(sites.values_list("name", flat=True))
+            if missing:
+                raise CommandError(f"Unknown sites: {', '.join(sorted(missing))}")
+        if options["mode"]:
+            sites = sites.filter(mode=options["mode"])
+        if options["purpose"]:
+            sites = sites.filter(purpose=options["purpose"])
+
+        runner = FleetRunner(
+            options["operation"],
+            list(sites.order_by("id").values_list("id", flat=True)),
+            max_concurrent=options["max_concurrent"],
+            max_per_appserver=options["max_per_appserver"],
+        )
+        verbose = options["verbosity"] > 0
+        progress = runner.run(
+            on_progress=(lambda progress: self.stdout.write(str(progress))) if verbose else None
+        )
+
+        if progress.failed:
+            raise CommandError(
+                f"Failed on {len(progress.failed)} sites: {', '.join(progress.failed)}"
+            )
+        if verbose:
+            self.stdout.write(self.style.SUCCESS(str(progress)))
@@ -0,0 +1,232 @@
+"""Prometheus metrics for operations and actions.
+
+The metrics are recorded in whichever process runs the operation (usually a Celery
+worker), and exported by :func:`render`. To combine the metrics from several
+processes, set the ``PROMETHEUS_MULTIPROC_DIR`` environment variable to a directory
+shared by all of them (see the `prometheus_client docs
+<https://prometheus.github.io/client_python/multiprocess/>`_).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import time
+from collections.abc import Iterator
+from typing import TYPE_CHECKING, Any
+
+from celery import current_app
+from celery.signals import before_task_publish, task_prerun
+from django.conf import settings
+from django.utils import timezone
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+if TYPE_CHECKING:
+    from .models import Action, Operation
+
+logger = logging.getLogger(__name__)
+
+_ENQUEUED_AT_HEADER = "director_enqueued_at"
+
+# site creation involves building an image, which can take several minutes
+_DURATION_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, float("inf"))
+
+OPERATION_DURATION = Histogram(
+    "director_operation_duration_seconds",
+    "Time taken to run an operation, from when it started",
+    ["type", "result"],
+    buckets=_DURATION_BUCKETS,
+)
+OPERATION_QUEUE_WAIT = Histogram(
+    "director_operation_queue_wait_seconds",
+    "Time an operation spent queued before it started",
+    ["type"],
+    buckets=_DURATION_BUCKETS,
+)
+OPERATIONS = Counter(
+    "director_operations",
+    "Operations that finished running",
+    ["type", "result"],
+)
+OPERATIONS_IN_PROGRESS = Gauge(
+    "director_operations_in_progress",
+    "Operations that are currently running",
+    ["type"],
+    multiprocess_mode="livesum",
+)
+
+ACTION_DURATION = Histogram(
+    "director_action_duration_seconds",
+    "Time taken to run an action",
+    ["slug", "result"],
+    buckets=_DURATION_BUCKETS,
+)
+ACTIONS = Counter(
+    "director_actions",
+    "Actions that finished running",
+    ["slug", "result", "user_recoverable"],
+)
+ACTIONS_IN_PROGRESS = Gauge(
+    "director_actions_in_progress",
+    "Actions that are currently running",
+    ["slug"],
+    multiprocess_mode="livesum",
+)
+
+APPSERVER_REQUESTS = Counter(
+    "director_appserver_requests",
+    "Requests sent over the pooled connections to each appserver",
+    ["host"],
+)
+APPSERVER_CONNECTIONS = Counter(
+    "director_appserver_connections",
+    "New connections opened to each appserver, instead of reusing a pooled one",
+    ["host"],
+)
+
+TASK_QUEUE_WAIT = Histogram(
+    "director_task_queue_wait_seconds",
+    "Time a Celery task spent in its queue before a worker started it",
+    ["queue"],
+    buckets=_DURATION_BUCKETS,
+)
+
+
+class QueueDepthCollector:
+    """Reports the number of messages waiting in each Celery queue when scraped."""
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        depth = GaugeMetricFamily(
+            "director_task_queue_depth", "Celery tasks waiting in each queue", labels=["queue"]
+        )
+        queues = (
+            current_app.conf.task_default_queue,
+            settings.DIRECTOR_OPERATION_QUEUE,
+            settings.DIRECTOR_BUILD_QUEUE,
+        )
+        try:
+            with current_app.connection_for_read() as connection:
+                connection.ensure_connection(max_retries=1)
+                channel = connection.default_channel
+                for queue in queues:
+                    try:
+                        message_count = channel.queue_declare(queue, passive=True).message_count
+                    except connection.channel_errors:
+                        # Redis forgets about queues once they're empty
+                        message_count = 0
+                    depth.add_metric([queue], message_count)
+        except Exception:  # noqa: BLE001
+            logger.warning("Failed to get the depth of the Celery queues", exc_info=True)
+            return
+        yield depth
+
+
+class BuildAffinityCollector:
+    """Reports how often builds ran on their site's preferred appserver when scraped.
+
+    The counts are kept in the cache (see :func:`.selection.affinity_stats`), so
+    they already cover every worker.
+    """
+
+    def collect(self) -> Iterator[CounterMetricFamily]:
+        from .selection import affinity_stats
+
+        try:
+            stats = affinity_stats()
+        except Exception:  # noqa: BLE001
+            logger.warning("Failed to get the build affinity statistics", exc_info=True)
+            return
+        builds = CounterMetricFamily(
+            "director_build_affinity",
+            "Builds sent to the appserver their site prefers (hit), or elsewhere (miss)",
+            labels=["result"],
+        )
+        builds.add_metric(["hit"], stats.hits)
+        builds.add_metric(["miss"], stats.misses)
+        yield builds
+
+
+# collectors that read shared state (not this process's), so they're only registered once
+_SHARED_REGISTRY = CollectorRegistry()
+_SHARED_REGISTRY.register(QueueDepthCollector())
+_SHARED_REGISTRY.register(BuildAffinityCollector())
+
+
+@before_task_publish.connect
+def _record_enqueued_at(headers: dict[str, Any] | None = None, **_kwargs: Any) -> None:
+    if headers is not None:
+        headers[_ENQUEUED_AT_HEADER] = time.time()
+
+
+@task_prerun.connect
+def _observe_queue_wait(task: Any = None, **_kwargs: Any) -> None:
+    enqueued_at = task.request.get(_ENQUEUED_AT_HEADER)
+    queue = (task.request.delivery_info or {}).get("routing_key")
+    # tasks run eagerly (e.g. in tests) never went through a queue
+    if enqueued_at is None or queue is None:
+        return
+    TASK_QUEUE_WAIT.labels(queue).observe(max(0.0, time.time() - enqueued_at))
+
+
+def _result(succeeded: bool | None) -> str:
+    return "success" if succeeded else "failure"
+
+
+def operation_started(operation: Operation) -> None:
+    if operation.started_time is not None:
+        wait = operation.started_time - operation.created_time
+        OPERATION_QUEUE_WAIT.labels(operation.ty).observe(wait.total_seconds())
+    OPERATIONS_IN_PROGRESS.labels(operation.ty).inc()
+
+
+def operation_finished(operation: Operation, *, succeeded: bool) -> None:
+    OPERATIONS_IN_PROGRESS.labels(operation.ty).dec()
+    result = _result(succeeded)
+    OPERATIONS.labels(operation.ty, result).inc()
+    if operation.started_time is not None:
+        duration = timezone.now() - operation.started_time
+        OPERATION_DURATION.labels(operation.ty, result).observe(duration.total_seconds())
+
+
+def action_started(action: Action) -> None:
+    ACTIONS_IN_PROGRESS.labels(action.slug).inc()
+
+
+def action_finished(action: Action) -> None:
+    """Records an action that finished, once its result has been set."""
+    ACTIONS_IN_PROGRESS.labels(action.slug).dec()
+    result = _result(action.result)
+    ACTIONS.labels(action.slug, result, str(action.user_recoverable).lower()).inc()
+    if action.started_time is not None:
+        duration = timezone.now() - action.started_time
+        ACTION_DURATION.labels(action.slug, result).observe(duration.total_seconds())
+
+
+def appserver_connections_used(host: str, *, requests: int, connections: int) -> None:
+    if requests:
+        APPSERVER_REQUESTS.labels(host).inc(requests)
+    if connections:
+        APPSERVER_CONNECTIONS.labels(host).inc(connections)
+
+
+def render() -> bytes:
+    """Returns the metrics from every process, in the Prometheus text format.
+
+    The depths of the Celery queues are read from the broker, and the build
+    affinity statistics from the cache.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_SHARED_REGISTRY)
@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-17 16:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0006_action_user_message'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='operation',
+            name='site',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='sites.site'),
+        ),
+    ]
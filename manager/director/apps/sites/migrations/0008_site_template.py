@@ -0,0 +1,20 @@
+# Generated by Django 5.2 on 2026-10-17 17:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0001_initial'),
+        ('sites', '0007_operation_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='template',
+            field=models.ForeignKey(blank=True, help_text='The marketplace template the site was created from.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='site_set', to='marketplace.sitetemplate'),
+        ),
+    ]
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Any, Self
+import itertools
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any, ClassVar, Self
 
 from django.conf import settings
 from django.core.validators import MinLengthValidator, RegexValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils import timezone
 
 if TYPE_CHECKING:
@@ -113,10 +116,20 @@ class Site(models.Model):
         help_text="Controls who can access the site",
     )
 
+    template = models.ForeignKey(
+        "marketplace.SiteTemplate",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="site_set",
+        help_text="The marketplace template the site was created from.",
+    )
+
     objects = SiteQuerySet.as_manager()
 
     id: int
     domain_set: models.QuerySet[Domain]
+    operation_set: models.QuerySet[Operation]
 
     def __str__(self):
         return self.name
@@ -131,10 +144,30 @@ class Site(models.Model):
         default = settings.SITE_URL_FORMATS[None]
         return settings.SITE_URL_FORMATS.get(self.purpose, default).format(self.name)
 
-    def start_operation(self, ty: str) -> Operation:
-        from . import operations
+    def start_operation(self, ty: str, *, interactive: bool = True) -> Operation:
+        """Queues an operation on the site, and runs it once the operations before it finish.
+
+        If the operation is made redundant by one that is queued (but hasn't started),
+        or vice versa, the two are coalesced into a single operation (see
+        :attr:`Operation.ABSORBS`), so a burst of changes only does the work once.
+
+        Args:
+            ty: the type of operation
+            interactive: whether a user is waiting on the operation. Interactive
+                operations take priority over bulk and background operations.
+
+        Returns:
+            The operation that will do the work, which may already have been queued.
+        """
+        from . import operations, tasks
+
+        with transaction.atomic():
+            # lock the site, so concurrent requests coalesce with each other
+            Site.objects.select_for_update().get(id=self.id)
+            op, created = Operation.objects.queue(self, ty)
 
-        op = Operation.objects.create(site=self, ty=ty)
+        if created:
+            transaction.on_commit(lambda: tasks.queue_operation(op, interactive=interactive))
         operations.send_operation_updated_message(self)
         return op
 
@@ -153,6 +186,13 @@ class Site(models.Model):
             "max_request_body_size": settings.DIRECTOR_RESOURCES_MAX_REQUEST_BODY,
         }
 
+    def serialize_build_limits(self) -> dict[str, float]:
+        """Serialize the resource limits for building the site's image."""
+        return {
+            "cpus": settings.DIRECTOR_BUILD_DEFAULT_CPUS,
+            "memory": settings.DIRECTOR_BUILD_DEFAULT_MEMORY_LIMIT,
+        }
+
     def serialize_for_appserver(self) -> dict[str, Any]:
         data = {
             "pk": self.id,
@@ -163,6 +203,8 @@ class Site(models.Model):
         }
         if self.database is not None:
             data["db"] = self.database.serialize_for_appserver()
+        if self.template is not None:
+            data["docker"] = {"base": self.template.image}
         return data
 
 
@@ -277,6 +319,52 @@ class Domain(models.Model):
         return f"{self.domain} ({self.site})"
 
 
+class OperationQuerySet(models.QuerySet):
+    def filter_pending(self) -> Self:
+        """Only show the operations that haven't started yet."""
+        return self.filter(started_time__isnull=True)
+
+    def filter_failed(self) -> Self:
+        """Only show the operations where an action failed."""
+        return self.filter(action__result=False).distinct()
+
+    def filter_stale(self) -> Self:
+        """Only show the operations that were lost along with the worker running them.
+
+        See ``DIRECTOR_OPERATION_CLAIM_TIMEOUT``.
+        """
+        cutoff = timezone.now() - timedelta(seconds=settings.DIRECTOR_OPERATION_CLAIM_TIMEOUT)
+        return self.filter(started_time__lt=cutoff).exclude(action__result=False)
+
+    def queue(self, site: Site, ty: str) -> tuple[Operation, bool]:
+        """Queues an operation on a site, coalescing it with the queued operations.
+
+        Only the operations at the end of the queue are coalesced, since reordering
+        an operation past another one could change the result.
+        This should be run in a transaction that has locked the site.
+
+        Returns:
+            A tuple of the operation that will do the work, and whether it was created.
+        """
+        pending = list(self.filter(site=site).filter_pending().order_by("-id"))
+        # nothing else matters once the site is going to be deleted. A deletion that has
+        # already started (or failed) may not get that far, so it's queued behind it.
+        if (deleting := next((op for op in pending if op.ty == "delete_site"), None)) is not None:
+            return deleting, False
+
+        if pending and pending[0].absorbs(ty):
+            return pending[0], False
+
+        if ty == "delete_site":
+            absorbed = pending
+        else:
+            absorbed = list(itertools.takewhile(lambda op: Operation.covers(ty, op.ty), pending))
+        # their tasks see that the operation no longer exists and do nothing. Only the
+        # ones that are still pending are deleted, in case one was claimed meanwhile.
+        self.filter(id__in=[op.id for op in absorbed]).filter_pending().delete()
+        return self.create(site=site, ty=ty), True
+
+
 class Operation(models.Model):
     """A series of actions being performed on a site.
 
@@ -319,11 +407,27 @@ class Operation(models.Model):
         ("fix_site", "Attempting to fix site"),
     ]
 
-    site = models.OneToOneField(Site, null=False, on_delete=models.PROTECT)
+    # The types of operations each type of operation makes redundant, if it runs after them.
+    # Deleting a site makes every other operation redundant. Only operations that replace
+    # the site's container make restarting it redundant.
+    ABSORBS: ClassVar[dict[str, frozenset[str]]] = {
+        "create_site": frozenset(
+            {"fix_site", "update_docker_image", "update_resource_limits", "restart_site"}
+        ),
+        "fix_site": frozenset({"update_docker_image", "update_resource_limits", "restart_site"}),
+    }
+
+    site = models.ForeignKey(Site, null=False, on_delete=models.PROTECT)
     ty = models.CharField(max_length=24, choices=OPERATION_TYPES, verbose_name="type")
     created_time = models.DateTimeField(auto_now_add=True, null=False)
     started_time = models.DateTimeField(null=True)
 
+    objects = OperationQuerySet.as_manager()
+
+    id: int
+    site_id: int
+    action_set: models.QuerySet[Action]
+
     def __str__(self) -> str:
         return f"{type(self).__name__}: {self.ty}"
 
@@ -331,6 +435,80 @@ class Operation(models.Model):
     def has_started(self) -> bool:
         return self.started_time is not None
 
+    @classmethod
+    def covers(cls, ty: str, other: str) -> bool:
+        """Whether running an operation of type ``ty`` makes an earlier ``other`` redundant."""
+        return ty in (other, "delete_site") or other in cls.ABSORBS.get(ty, ())
+
+    def absorbs(self, ty: str) -> bool:
+        """Whether this (pending) operation also does the work of an operation of type ``ty``."""
+        return self.covers(self.ty, ty)
+
+    def is_waiting(self) -> bool:
+        """Whether an earlier operation on the site still has to finish.
+
+        Operations that failed are left in the database for inspection,
+        but they don't hold up the queue. Earlier operations that are stale
+        are failed, so they don't either.
+        """
+        earlier = Operation.objects.filter(site_id=self.site_id, id__lt=self.id).exclude(
+            id__in=Operation.objects.filter_failed().values("id")
+        )
+        for stale in earlier.filter_stale():
+            stale.fail("The operation was lost along with the worker running it")
+        return earlier.exists()
+
+    def claim(self) -> bool:
+        """Marks the operation as started.
+
+        Stale operations can be claimed again, e.g. by their task when it's
+        redelivered after the worker running it died.
+
+        This locks the site like :meth:`Site.start_operation`, so an operation can't
+        start while another one is being coalesced into it.
+
+        Returns:
+            Whether the operation was claimed, i.e. it wasn't already started or
+            coalesced into another operation.
+        """
+        started_time = timezone.localtime()
+        with transaction.atomic():
+            Site.objects.select_for_update().get(id=self.site_id)
+            claimed = (
+                Operation.objects.filter(id=self.id)
+                .filter(
+                    Q(started_time__isnull=True)
+                    | Q(id__in=Operation.objects.filter_stale().values("id"))
+                )
+                .update(started_time=started_time)
+            )
+        if claimed:
+            self.started_time = started_time
+        return bool(claimed)
+
+    def fail(self, message: str) -> None:
+        """Marks the operation as failed, when it couldn't run (or finish) its actions.
+
+        Args:
+            message: what went wrong, which is only shown to superusers
+        """
+        from . import operations
+
+        if self.started_time is None:
+            # so it can't absorb operations queued after it
+            self.started_time = timezone.localtime()
+            self.save(update_fields=["started_time"])
+        Action.objects.create(
+            operation=self,
+            slug="run_operation",
+            name="Running operation",
+            started_time=self.started_time,
+            result=False,
+            message=message,
+        )
+        # it's no longer the site's current operation
+        operations.send_operation_updated_message(self.site)
+
 
 class Action(models.Model):
     """An individual task in an operation.
@@ -1,12 +1,26 @@
 import contextlib
+import logging
+import queue
+import threading
+import time
 import traceback
-from collections.abc import Callable, Iterator
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from typing import overload
+from typing import Any, NamedTuple, overload
 
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
 from .appserver import Appserver
+from .consumers import site_group_name
 from .models import Action, Operation, Site
 
+logger = logging.getLogger(__name__)
+
 type ActionCallback = Callable[[Site, list[Appserver]], Iterator[str]]
 """A callback that runs an action on a site.
 
@@ -25,17 +39,120 @@ class UserFacingError(Exception):
     """
 
 
+class AppserverBusyError(Exception):
+    """Raised by an action when the appserver it needs is too busy to take the work.
+
+    Instead of failing, the operation is sent back to the queue, and run again from
+    the start (on whichever appserver is chosen then) after ``retry_after`` seconds.
+    See :func:`.tasks.run_operation`.
+    """
+
+    def __init__(self, message: str, *, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProgressWriter:
+    """Buffers the progress messages of an :class:`.Action`, and saves them in batches.
+
+    Saving the action after every message would rewrite the whole (growing) message
+    each time. Instead, the buffered messages are saved once
+    ``DIRECTOR_ACTION_PROGRESS_FLUSH_INTERVAL`` seconds have passed since the last
+    save, or once ``DIRECTOR_ACTION_PROGRESS_FLUSH_SIZE`` characters are buffered.
+    If no more messages arrive in the meantime (e.g. during a slow build step), they
+    are saved in the background once the interval has passed.
+    """
+
+    def __init__(self, action: Action) -> None:
+        self.action = action
+        self._buffer: list[str] = []
+        self._buffered_size = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+        self._timer: threading.Timer | None = None
+
+    def write(self, message: str) -> None:
+        """Adds a line to the action's message, saving it if a threshold was reached."""
+        line = f"{message}\n"
+        with self._lock:
+            self._buffer.append(line)
+            self._buffered_size += len(line)
+
+            remaining = settings.DIRECTOR_ACTION_PROGRESS_FLUSH_INTERVAL - (
+                time.monotonic() - self._last_flush
+            )
+            if (
+                self._buffered_size >= settings.DIRECTOR_ACTION_PROGRESS_FLUSH_SIZE
+                or remaining <= 0
+            ):
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(remaining, self._flush_in_background)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """Saves the buffered messages."""
+        with self._lock:
+            if not self._buffer:
+                return
+            self.close()
+            self.action.save(update_fields=["message"])
+            self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """Moves the buffered messages onto the action without saving it.
+
+        The caller is responsible for saving the action (e.g. along with its result).
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._buffer:
+                return
+            chunk = "".join(self._buffer)
+            self.action.message += chunk
+            self._buffer.clear()
+            self._buffered_size = 0
+        send_action_progress_message(self.action, chunk)
+
+    def _flush_in_background(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to save the progress of action %d", self.action.id)
+        finally:
+            # the save opened a database connection in the timer's thread
+            connections.close_all()
+
+
+class _ActionEvent(NamedTuple):
+    """Sent from the thread running an action's callback to the thread saving its progress."""
+
+    index: int
+    message: str | None = None
+    done: bool = False
+    error: Exception | None = None
+
+
 class OperationWrapper:
     """A wrapper around an :class:`.Operation` for registering actions to execute.
 
     Given an instance, register a specific action with :meth:`register_action`.
-    Then, execute the actions sequentially by running :meth:`execute_operation`.
+    Then, execute the actions by running :meth:`execute_operation`. By default,
+    actions run sequentially, but actions that don't depend on each other can run
+    in parallel.
     """
 
     def __init__(self, operation: Operation) -> None:
         self.operation = operation
         self.site = operation.site
         self.actions: list[tuple[Action, ActionCallback]] = []
+        # the indices (in self.actions) of the actions each action depends on
+        self.dependencies: list[set[int]] = []
+        # set if an action couldn't run because its appserver was too busy
+        self.busy: AppserverBusyError | None = None
 
     @overload
     def register_action(
@@ -44,6 +161,7 @@ class OperationWrapper:
         callback: None = None,
         *,
         user_recoverable: bool = ...,
+        depends_on: Sequence[ActionCallback] | None = ...,
     ) -> Callable[[ActionCallback], ActionCallback]: ...
 
     @overload
@@ -53,6 +171,7 @@ class OperationWrapper:
         callback: ActionCallback,
         *,
         user_recoverable: bool = ...,
+        depends_on: Sequence[ActionCallback] | None = ...,
     ) -> ActionCallback: ...
 
     def register_action(
@@ -61,6 +180,7 @@ class OperationWrapper:
         callback: ActionCallback | None = None,
         *,
         user_recoverable: bool = False,
+        depends_on: Sequence[ActionCallback] | None = None,
     ) -> ActionCallback | Callable[[ActionCallback], ActionCallback]:
         """Schedules an action on the operation.
 
@@ -71,6 +191,10 @@ class OperationWrapper:
             callback: The function to call when the action is executed.
                 It can yield messages to update the status of the action.
             user_recoverable: Whether the action is recoverable by the user.
+            depends_on: The (already registered) callbacks of the actions that must
+                succeed before this action can start. Defaults to every action
+                registered so far. Pass an empty list to allow the action to run in
+                parallel with the actions registered before it.
 
         Returns:
             The callback if it was provided, or a decorator that takes a callback.
@@ -82,6 +206,7 @@ class OperationWrapper:
             assert not created, "Cannot decorate multiple actions"
             created = True
 
+            dependencies = self._resolve_dependencies(depends_on)
             action = Action.objects.create(
                 operation=self.operation,
                 slug=callback.__name__,
@@ -89,6 +214,7 @@ class OperationWrapper:
                 user_recoverable=user_recoverable,
             )
             self.actions.append((action, callback))
+            self.dependencies.append(dependencies)
             return callback
 
         if callback is None:
@@ -96,32 +222,121 @@ class OperationWrapper:
         decorator = wraps(callback)(decorator)
         return decorator(callback)
 
+    def _resolve_dependencies(self, depends_on: Sequence[ActionCallback] | None) -> set[int]:
+        if depends_on is None:
+            return set(range(len(self.actions)))
+
+        callbacks = [callback for _action, callback in self.actions]
+        dependencies = set()
+        for dependency in depends_on:
+            assert dependency in callbacks, (
+                f"{dependency.__name__} must be registered before it can be depended on"
+            )
+            # if it was registered multiple times, depend on the latest one
+            dependencies.add(len(callbacks) - 1 - callbacks[::-1].index(dependency))
+        return dependencies
+
     def execute_operation(
         self, *, new_action_callback: Callable[[Action], object] | None = None
     ) -> bool:
         """Executes the actions on the operation.
 
+        Each action starts once all of the actions it depends on have succeeded,
+        with at most ``DIRECTOR_OPERATION_MAX_PARALLEL_ACTIONS`` actions running at once.
+        If an action fails, no more actions are started, but the actions that are
+        already running are allowed to finish.
+
         Returns:
             Whether the operation was successful.
         """
         appservers = Appserver.list_pingable()
-        for action, callback in self.actions:
-            try:
-                action.start_action()
-                if new_action_callback:
-                    new_action_callback(action)
-
-                self._run_action(action, callback, appservers)
-            except UserFacingError as e:
-                action.user_message += str(e)
-                action.result = False
-                action.save()
-                return False
-            except Exception:  # noqa: BLE001
-                action.message += f"{traceback.format_exc()}\n"
-                action.result = False
-                action.save()
-                return False
+        max_parallel = settings.DIRECTOR_OPERATION_MAX_PARALLEL_ACTIONS
+
+        pending = list(range(len(self.actions)))
+        succeeded: set[int] = set()
+        running: dict[int, ProgressWriter] = {}
+        events: queue.SimpleQueue[_ActionEvent] = queue.SimpleQueue()
+        failed = False
+
+        with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+            while pending or running:
+                ready = [] if failed else [i for i in pending if self.dependencies[i] <= succeeded]
+
+                if len(ready) == 1 and not running:
+                    # nothing else could run alongside it, so there's no need for a thread
+                    (index,) = ready
+                    pending.remove(index)
+                    action, callback = self.actions[index]
+                    if self._execute_action(action, callback, appservers, new_action_callback):
+                        succeeded.add(index)
+                    else:
+                        failed = True
+                    continue
+
+                for index in ready[: max_parallel - len(running)]:
+                    pending.remove(index)
+                    action, callback = self.actions[index]
+                    try:
+                        self._start_action(action, new_action_callback)
+                    except Exception as e:  # noqa: BLE001
+                        self._record_failure(action, e)
+                        failed = True
+                        break
+                    running[index] = ProgressWriter(action)
+                    pool.submit(self._produce_messages, index, callback, appservers, events)
+
+                if not running:
+                    break
+
+                event = events.get()
+                progress = running[event.index]
+                if event.message is not None:
+                    progress.write(event.message)
+                    continue
+
+                del running[event.index]
+                progress.close()
+                if event.error is None:
+                    progress.action.result = True
+                    progress.action.save(update_fields=["message", "result"])
+                    send_action_finished_message(progress.action)
+                    metrics.action_finished(progress.action)
+                    succeeded.add(event.index)
+                else:
+                    self._record_failure(progress.action, event.error)
+                    failed = True
+
+        return not failed
+
+    @staticmethod
+    def _start_action(
+        action: Action, new_action_callback: Callable[[Action], object] | None
+    ) -> None:
+        # first, so that recording a failure to start the action balances it out
+        metrics.action_started(action)
+        action.start_action()
+        send_action_started_message(action)
+        if new_action_callback:
+            new_action_callback(action)
+
+    def _execute_action(
+        self,
+        action: Action,
+        callback: ActionCallback,
+        appservers: list[Appserver],
+        new_action_callback: Callable[[Action], object] | None,
+    ) -> bool:
+        """Starts and runs an action in the current thread, recording its result.
+
+        Returns:
+            Whether the action was successful.
+        """
+        try:
+            self._start_action(action, new_action_callback)
+            self._run_action(action, callback, appservers)
+        except Exception as e:  # noqa: BLE001
+            self._record_failure(action, e)
+            return False
         return True
 
     def _run_action(
@@ -134,12 +349,60 @@ class OperationWrapper:
             callback: The callback to run.
             appservers: The pingable appservers
         """
-        for message in callback(self.site, appservers):
-            assert isinstance(message, str), "Messages must be strings"
-            action.message += f"{message}\n"
-            action.save()
+        progress = ProgressWriter(action)
+        try:
+            for message in callback(self.site, appservers):
+                assert isinstance(message, str), "Messages must be strings"
+                progress.write(message)
+        finally:
+            # the messages are saved along with the result
+            progress.close()
         action.result = True
-        action.save()
+        action.save(update_fields=["message", "result"])
+        send_action_finished_message(action)
+        metrics.action_finished(action)
+
+    def _produce_messages(
+        self,
+        index: int,
+        callback: ActionCallback,
+        appservers: list[Appserver],
+        events: queue.SimpleQueue[_ActionEvent],
+    ) -> None:
+        """Runs an action's callback in a worker thread.
+
+        The messages are sent back to the thread running :meth:`execute_operation`,
+        which is the only thread that saves the action.
+        """
+        try:
+            for message in callback(self.site, appservers):
+                assert isinstance(message, str), "Messages must be strings"
+                events.put(_ActionEvent(index, message=message))
+        except Exception as e:  # noqa: BLE001
+            events.put(_ActionEvent(index, done=True, error=e))
+            return
+        finally:
+            # the callback may have opened a database connection in this thread
+            connections.close_all()
+        events.put(_ActionEvent(index, done=True))
+
+    def _record_failure(self, action: Action, error: Exception) -> None:
+        if isinstance(error, AppserverBusyError):
+            # the operation is retried, so the action hasn't failed (and it doesn't let
+            # the operations queued after it start in the meantime)
+            self.busy = error
+            action.user_message += str(error)
+            action.save(update_fields=["message", "user_message"])
+            metrics.action_finished(action)
+            return
+        if isinstance(error, UserFacingError):
+            action.user_message += str(error)
+        else:
+            action.message += f"{''.join(traceback.format_exception(error))}\n"
+        action.result = False
+        action.save(update_fields=["message", "user_message", "result"])
+        send_action_finished_message(action)
+        metrics.action_finished(action)
 
 
 @contextlib.contextmanager
@@ -153,6 +416,10 @@ def auto_run_operation_wrapper(operation_id: int) -> Iterator[OperationWrapper]:
     #. Passes the :class:`OperationWrapper` to the with statement.
     #. Runs the :class:`OperationWrapper` with the given scope when the with statement has finished.
     #. Deletes the :class:`.Operation` if it was successful.
+
+    If an appserver was too busy to run one of the actions, the actions are deleted
+    and the operation goes back to the queue, before the :class:`AppserverBusyError`
+    is raised.
     """
     operation = Operation.objects.get(id=operation_id)
     wrapper = OperationWrapper(operation)
@@ -161,21 +428,118 @@ def auto_run_operation_wrapper(operation_id: int) -> Iterator[OperationWrapper]:
 
     send_operation_updated_message(operation.site)
 
-    def action_started(_: Action) -> None:
-        send_operation_updated_message(operation.site)
-
-    result = wrapper.execute_operation(new_action_callback=action_started)
+    metrics.operation_started(operation)
+    result = False
+    try:
+        result = wrapper.execute_operation()
+    finally:
+        metrics.operation_finished(operation, succeeded=result)
 
     if result:
         operation.action_set.all().delete()
         operation.delete()
+    elif wrapper.busy is not None:
+        # so it can be claimed again, and the actions registered again, when it's retried
+        operation.action_set.all().delete()
+        operation.started_time = None
+        operation.save(update_fields=["started_time"])
 
     send_operation_updated_message(operation.site)
+    if wrapper.busy is not None:
+        raise wrapper.busy
+
+
+def _send_site_event(site_id: int, data: dict[str, Any]) -> None:
+    """Sends an event to everyone watching a site (see :class:`.SiteConsumer`).
+
+    Events are best effort: failing to send one never fails the operation.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(
+            site_group_name(site_id), {"type": "site.event", "data": {"site_id": site_id, **data}}
+        )
+    except Exception:  # noqa: BLE001
+        logger.warning("Failed to send %s event for site %d", data["type"], site_id, exc_info=True)
 
 
-def send_operation_updated_message(_site: Site) -> None:
-    pass
+def send_operation_updated_message(site: Site) -> None:
+    """Sends the site's current operation, or ``None`` if it has no operation.
 
+    The number of operations queued after it is sent along with it.
+    """
+    operations = list(
+        Operation.objects.filter(site=site)
+        .exclude(id__in=Operation.objects.filter_failed().values("id"))
+        .order_by("id")
+    )
+    _send_site_event(
+        site.id, {"type": "operation.updated", "operation": describe_operations(operations)}
+    )
+
+
+def describe_operations(operations: list[Operation]) -> dict[str, Any] | None:
+    """Describes a site's current operation, as it's sent to the browser.
 
-def send_site_updated_message(_site: Site) -> None:
-    pass
+    Failed operations are kept for inspection, but they aren't the site's current
+    operation, so they should be left out.
+
+    Args:
+        operations: the site's operations that haven't failed, oldest first
+    """
+    if not operations:
+        return None
+    from .tasks import BUILD_OPERATION_TYPES
+
+    operation = operations[0]
+    return {
+        "id": operation.id,
+        "type": operation.ty,
+        "name": operation.get_ty_display(),
+        "has_started": operation.has_started,
+        # whether its build can be cancelled
+        "building": operation.has_started and operation.ty in BUILD_OPERATION_TYPES,
+        "queued": len(operations) - 1,
+    }
+
+
+def send_action_started_message(action: Action) -> None:
+    _send_site_event(
+        action.operation.site_id,
+        {
+            "type": "action.started",
+            "action": {"id": action.id, "slug": action.slug, "name": action.name},
+        },
+    )
+
+
+def send_action_progress_message(action: Action, message: str) -> None:
+    """Sends the lines that were just added to the action's message."""
+    _send_site_event(
+        action.operation.site_id,
+        {"type": "action.progress", "action_id": action.id, "message": message},
+    )
+
+
+def send_action_finished_message(action: Action) -> None:
+    _send_site_event(
+        action.operation.site_id,
+        {
+            "type": "action.finished",
+            "action_id": action.id,
+            "result": action.result,
+            "user_message": action.user_message,
+        },
+    )
+
+
+def send_site_updated_message(site: Site) -> None:
+    _send_site_event(
+        site.id,
+        {
+            "type": "site.updated",
+            "site": {"id": site.id, "name": site.name, "availability": site.availability},
+        },
+    )
@@ -0,0 +1,184 @@
+"""Policies for choosing which appserver an action runs on.
+
+The policy is configured with ``DIRECTOR_APPSERVER_SELECTION_POLICY``, which
+should be the import path of a :class:`SelectionPolicy` subclass.
+"""
+
+from __future__ import annotations
+
+import abc
+import hashlib
+import random
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Literal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from . import health
+from .appserver import Appserver
+
+if TYPE_CHECKING:
+    from .models import Site
+
+_AFFINITY_HITS_KEY = "build-affinity:hits"
+_AFFINITY_MISSES_KEY = "build-affinity:misses"
+
+type ActionKind = Literal["default", "build"]
+"""How heavy the work an action sends to the appserver is.
+
+``build`` is used for building Docker images, which take much longer (and many
+more resources) than anything else.
+"""
+
+
+class SelectionPolicy(abc.ABC):
+    """Chooses which appserver an action should run on."""
+
+    @abc.abstractmethod
+    def select(self, appservers: Sequence[Appserver], *, site: Site, kind: ActionKind) -> Appserver:
+        """Chooses one of the pingable appservers.
+
+        Args:
+            appservers: the pingable appservers (never empty)
+            site: the site the action is running on
+            kind: how heavy the action is
+        """
+
+
+class RandomPolicy(SelectionPolicy):
+    """Chooses an appserver at random."""
+
+    def select(self, appservers: Sequence[Appserver], *, site: Site, kind: ActionKind) -> Appserver:
+        return random.choice(appservers)
+
+
+class ScoredPolicy(SelectionPolicy):
+    """Chooses the appserver with the lowest score, breaking ties at random."""
+
+    @abc.abstractmethod
+    def score(self, appserver: Appserver, *, kind: ActionKind) -> float:
+        """Returns how busy an appserver is. Lower is better."""
+
+    def select(self, appservers: Sequence[Appserver], *, site: Site, kind: ActionKind) -> Appserver:
+        scores = {appserver: self.score(appserver, kind=kind) for appserver in appservers}
+        lowest = min(scores.values())
+        return random.choice([appserver for appserver, score in scores.items() if score == lowest])
+
+
+class LeastOutstandingPolicy(ScoredPolicy):
+    """Chooses the appserver with the fewest requests in flight."""
+
+    def score(self, appserver: Appserver, *, kind: ActionKind) -> float:
+        return appserver.outstanding_requests
+
+
+class LoadScorePolicy(ScoredPolicy):
+    """Chooses the appserver with the lowest load.
+
+    The load combines the requests in flight with the load reported by the
+    appserver. Running builds are weighted more heavily when choosing where to
+    build an image, so builds are spread across the appservers.
+    """
+
+    build_weight = 1.0
+    """The weight of each running build."""
+
+    build_weight_for_builds = 3.0
+    """The weight of each running build, when choosing where to run another build."""
+
+    cpu_weight = 1.0
+    memory_weight = 2.0
+
+    def score(self, appserver: Appserver, *, kind: ActionKind) -> float:
+        score = float(appserver.outstanding_requests)
+        if (load := appserver.load()) is None:
+            return score
+
+        build_weight = self.build_weight_for_builds if kind == "build" else self.build_weight
+        return (
+            score
+            + build_weight * load.running_builds
+            + self.cpu_weight * load.cpu
+            + self.memory_weight * load.memory
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class AffinityStats:
+    """How often builds landed on the appserver their site prefers.
+
+    Args:
+        hits: the number of builds sent to the preferred appserver
+        misses: the number of builds sent elsewhere, because it was down
+    """
+
+    hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def preferred_host(site: Site, hosts: Iterable[str]) -> str:
+    """Returns the appserver a site's images should be built on.
+
+    This uses rendezvous hashing, so each site keeps the same appserver as long as
+    it's up, and adding or removing an appserver only moves the sites that
+    preferred it.
+    """
+
+    def weight(host: str) -> int:
+        digest = hashlib.blake2b(f"{site.id}:{host}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest)
+
+    return max(hosts, key=weight)
+
+
+def affinity_stats() -> AffinityStats:
+    """Returns the build affinity statistics across all workers."""
+    counts = cache.get_many([_AFFINITY_HITS_KEY, _AFFINITY_MISSES_KEY])
+    return AffinityStats(
+        hits=counts.get(_AFFINITY_HITS_KEY, 0),
+        misses=counts.get(_AFFINITY_MISSES_KEY, 0),
+    )
+
+
+def _record_affinity(*, hit: bool) -> None:
+    key = _AFFINITY_HITS_KEY if hit else _AFFINITY_MISSES_KEY
+    cache.add(key, 0, timeout=None)
+    cache.incr(key)
+
+
+def get_policy() -> SelectionPolicy:
+    """Returns the configured :class:`SelectionPolicy`."""
+    return import_string(settings.DIRECTOR_APPSERVER_SELECTION_POLICY)()
+
+
+def select_appserver(
+    appservers: Sequence[Appserver], site: Site, *, kind: ActionKind = "default"
+) -> Appserver:
+    """Chooses which appserver an action should run on.
+
+    If ``DIRECTOR_BUILD_AFFINITY`` is set, images are built on the appserver the site
+    prefers (see :func:`preferred_host`), so the layers cached from its last build
+    can be reused. The configured policy is only used if that appserver is down.
+
+    Args:
+        appservers: the pingable appservers
+        site: the site the action is running on
+        kind: how heavy the action is
+    """
+    assert appservers, "Expected at least one appserver"
+    if kind == "build" and settings.DIRECTOR_BUILD_AFFINITY:
+        preferred = preferred_host(site, health.known_hosts())
+        for appserver in appservers:
+            if appserver.host == preferred:
+                _record_affinity(hit=True)
+                return appserver
+        _record_affinity(hit=False)
+    return get_policy().select(appservers, site=site, kind=kind)
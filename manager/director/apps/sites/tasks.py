@@ -1,33 +1,206 @@
-from celery import shared_task
+import logging
+import traceback
+from collections.abc import Callable
+from typing import Any
+
+from celery import Task, shared_task
 from django.conf import settings
 
-from . import actions
-from .models import Site
-from .operations import auto_run_operation_wrapper
+from . import actions, fleet
+from .appserver import Appserver
+from .models import Action, Operation
+from .operations import AppserverBusyError, OperationWrapper, auto_run_operation_wrapper
 
+logger = logging.getLogger(__name__)
 
-@shared_task
-def create_site(operation_id: int) -> None:
-    with auto_run_operation_wrapper(operation_id) as wrapper:
+
+def create_site(wrapper: OperationWrapper) -> None:
+    wrapper.register_action(
+        "Building Docker image",
+        actions.build_docker_image,
+        user_recoverable=True,
+    )
+    wrapper.register_action("Creating Docker service", actions.update_docker_service)
+
+
+def delete_site(wrapper: OperationWrapper) -> None:
+    # these are all independent of each other
+    if settings.SITE_DELETION_REMOVE_FILES:
+        wrapper.register_action("Deleting site files", actions.delete_site_files, depends_on=())
+    if settings.SITE_DELETION_REMOVE_DATABASE:
         wrapper.register_action(
-            "Building Docker image",
-            actions.build_docker_image,
-            user_recoverable=True,
+            "Deleting site database", actions.delete_site_database, depends_on=()
         )
-        wrapper.register_action("Creating Docker service", actions.update_docker_service)
+    wrapper.register_action("Deleting Docker service", actions.remove_docker_service, depends_on=())
+
+    # but the image can't be removed while the service is still using it
+    wrapper.register_action(
+        "Deleting Docker image",
+        actions.remove_docker_image,
+        depends_on=[actions.remove_docker_service],
+    )
+
+
+def fix_site(wrapper: OperationWrapper) -> None:
+    wrapper.register_action(
+        "Building Docker image",
+        actions.build_docker_image,
+        user_recoverable=True,
+    )
+    # the site may be broken in a way the service's spec doesn't show
+    wrapper.register_action("Restarting Docker service", actions.restart_docker_service)
+
+
+def update_docker_image(wrapper: OperationWrapper) -> None:
+    wrapper.register_action(
+        "Rebuilding Docker image",
+        actions.rebuild_docker_image,
+        user_recoverable=True,
+    )
+    wrapper.register_action("Updating Docker service", actions.update_docker_service)
+
+
+def update_docker_service(wrapper: OperationWrapper) -> None:
+    wrapper.register_action("Updating Docker service", actions.update_docker_service)
+
+
+def restart_docker_service(wrapper: OperationWrapper) -> None:
+    wrapper.register_action("Restarting Docker service", actions.restart_docker_service)
+
+
+OPERATIONS: dict[str, Callable[[OperationWrapper], None]] = {
+    "create_site": create_site,
+    "delete_site": delete_site,
+    "fix_site": fix_site,
+    "update_docker_image": update_docker_image,
+    "update_resource_limits": update_docker_service,
+    "restart_site": restart_docker_service,
+}
+"""Registers the actions for each type of operation."""
+
+BUILD_OPERATION_TYPES = frozenset({"create_site", "fix_site", "update_docker_image"})
+"""The types of operations that build an image, which run on ``DIRECTOR_BUILD_QUEUE``."""
+
+
+def queue_operation(operation: Operation, *, interactive: bool = True) -> None:
+    """Sends an operation to the workers.
+
+    Operations that build an image can take minutes, so they go to a separate queue
+    from the quick operations.
+
+    Args:
+        operation: the operation to run
+        interactive: whether a user is waiting on the operation
+    """
+    if operation.ty in BUILD_OPERATION_TYPES:
+        queue = settings.DIRECTOR_BUILD_QUEUE
+    else:
+        queue = settings.DIRECTOR_OPERATION_QUEUE
+    if interactive:
+        priority = settings.DIRECTOR_OPERATION_PRIORITY_INTERACTIVE
+    else:
+        priority = settings.DIRECTOR_OPERATION_PRIORITY_BACKGROUND
+    run_operation.apply_async((operation.id,), queue=queue, priority=priority)
+
+
+@shared_task(bind=True, max_retries=settings.DIRECTOR_OPERATION_QUEUE_MAX_RETRIES, acks_late=True)
+def run_operation(self: Task, operation_id: int, busy_retries: int = 0) -> None:
+    """Runs an operation, once every earlier operation on its site has finished.
+
+    Operations can be coalesced into other operations while they are queued, in
+    which case there is nothing left to do. If the earlier operations take too
+    long, or the operation can't be run, it fails, so it doesn't hold up the
+    operations queued after it.
+
+    If an appserver is too busy to run one of its actions, the operation is run again
+    once the appserver asks, up to ``DIRECTOR_BUILD_BUSY_RETRIES`` times, instead of
+    holding up a worker while it waits.
+
+    Use :func:`queue_operation` to send it to the right queue. Retries stay on the
+    same queue, with the same priority.
+    """
+    operation = Operation.objects.filter(id=operation_id).select_related("site").first()
+    if operation is None:
+        logger.info("Operation %d was coalesced into another operation", operation_id)
+        return
+
+    if operation.is_waiting():
+        if self.request.retries >= self.max_retries:
+            operation.fail("Gave up waiting for the earlier operations on the site to finish")
+            return
+        raise self.retry(countdown=settings.DIRECTOR_OPERATION_QUEUE_RETRY_DELAY)
+
+    if not operation.claim():
+        # another worker got to it first
+        return
+
+    site = operation.site
+    try:
+        with auto_run_operation_wrapper(operation_id) as wrapper:
+            OPERATIONS[operation.ty](wrapper)
+    except AppserverBusyError as e:
+        if busy_retries >= settings.DIRECTOR_BUILD_BUSY_RETRIES:
+            # it went back to the queue
+            operation.refresh_from_db(fields=["started_time"])
+            operation.fail(f"The appservers were too busy to run the operation: {e}")
+            return
+        logger.info("Retrying operation %d in %d seconds: %s", operation_id, e.retry_after, e)
+        raise self.retry(
+            kwargs={"busy_retries": busy_retries + 1},
+            countdown=e.retry_after,
+            # these are limited by busy_retries instead
+            max_retries=self.request.retries + 1,
+        ) from e
+    except Exception:
+        # e.g. there were no appservers to run the actions on
+        operation.fail(traceback.format_exc())
+        raise
+
+    # successful operations are removed by the wrapper
+    succeeded = not Operation.objects.filter(id=operation_id).exists()
+    if operation.ty == "delete_site" and succeeded:
+        # the operations that failed before the site was deleted don't matter anymore
+        Action.objects.filter(operation__site=site).delete()
+        site.operation_set.all().delete()
+        site.delete()
 
 
 @shared_task
-def delete_site(operation_id: int) -> None:
-    site = Site.objects.get(operation__id=operation_id)
+def run_fleet_operation(
+    fleet_id: str, ty: str, site_ids: list[int], state: dict[str, Any] | None = None
+) -> None:
+    """Runs an operation on many sites, with bounded concurrency (see :mod:`.fleet`).
 
-    with auto_run_operation_wrapper(operation_id) as wrapper:
-        if settings.SITE_DELETION_REMOVE_FILES:
-            wrapper.register_action("Deleting site files", actions.delete_site_files)
-        if settings.SITE_DELETION_REMOVE_DATABASE:
-            wrapper.register_action("Deleting site database", actions.delete_site_database)
+    Each run starts as many operations as it can, then queues the task again to
+    check on them, instead of holding up a worker until they have all finished.
+    """
+    runner = fleet.FleetRunner(
+        ty, site_ids, fleet_id=fleet_id, batch_size=settings.DIRECTOR_FLEET_BATCH_SIZE
+    )
+    if state is not None:
+        runner.restore(state)
+    finished = runner.progress.finished
+
+    progress = runner.step()
+    if state is None or progress.finished != finished:
+        logger.info("Fleet operation %s: %s", fleet_id, progress)
+    if not progress.is_done:
+        run_fleet_operation.apply_async(
+            (fleet_id, ty, site_ids, runner.state()),
+            countdown=settings.DIRECTOR_FLEET_POLL_INTERVAL,
+        )
+        return
+
+    if progress.failed:
+        logger.warning(
+            "Fleet operation %s failed on %d sites: %s",
+            fleet_id,
+            len(progress.failed),
+            ", ".join(progress.failed),
+        )
 
-        wrapper.register_action("Deleting Docker service", actions.remove_docker_service)
-        wrapper.register_action("Deleting Docker image", actions.remove_docker_image)
 
-    site.delete()
+@shared_task(ignore_result=True)
+def ping_appservers() -> None:
+    """Updates the appserver health registry."""
+    Appserver.refresh_health()
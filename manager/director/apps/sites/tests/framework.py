@@ -24,7 +24,7 @@ def _url(path: str) -> str:
 
 
 @contextlib.contextmanager
-def mock(*args: MockInfo) -> Iterator[None]:
+def mock(*args: MockInfo) -> Iterator[responses.RequestsMock]:
     with responses.RequestsMock() as rsps:
         rsps.add(
             method="GET",
@@ -40,4 +40,4 @@ def mock(*args: MockInfo) -> Iterator[None]:
                 json=info["data"],
                 status=info.get("status_code", 200),
             )
-        yield
+        yield rsps
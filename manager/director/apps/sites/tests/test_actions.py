@@ -1,6 +1,15 @@
+import json
 import random
 
+import pytest
+import requests
+from django.core.cache import cache
+from django.urls import reverse
+
+from .. import actions
 from ..appserver import Appserver
+from ..models import Operation, Site
+from ..operations import AppserverBusyError, UserFacingError
 from . import framework
 
 
@@ -16,3 +25,199 @@ def test_ping_appserver() -> None:
         )
         assert response.status_code == 200
         assert response.json() == data
+
+
+def test_build_describes_the_build(settings) -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    builds = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/builds"
+
+    with framework.mock() as rsps:
+        rsps.add("POST", builds, json={"id": "job", "state": "queued"}, status=202)
+        rsps.add("GET", f"{builds}/job/log", body="Step 1/2\n\nStep 2/2\n")
+        rsps.add(
+            "GET",
+            f"{builds}/job",
+            json={
+                "id": "job",
+                "state": "succeeded",
+                "context_size": 3 * 2**20,
+                "context_upload_seconds": 0.25,
+                "cache_hit_ratio": 0.75,
+            },
+        )
+        messages = list(actions.build_docker_image(site, Appserver.list_pingable()))
+
+        submitted = json.loads(rsps.calls[1].request.body)
+        assert submitted["build_limits"] == site.serialize_build_limits()
+
+    assert messages[1:] == [
+        "Step 1/2",
+        "Step 2/2",
+        "Docker image built",
+        "Sent 3.0 MiB build context in 0.2s",
+        "75% of build steps were cached",
+    ]
+
+
+def test_build_raises_when_appserver_is_busy(settings) -> None:
+    settings.DIRECTOR_BUILD_BUSY_MAX_DELAY = 10
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    builds = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/builds"
+
+    with framework.mock() as rsps:
+        rsps.add("POST", builds, json={}, status=429, headers={"Retry-After": "30"})
+        with pytest.raises(AppserverBusyError, match="retrying in 10 seconds") as exc_info:
+            list(actions.build_docker_image(site, Appserver.list_pingable()))
+
+    assert exc_info.value.retry_after == 10
+
+
+@pytest.mark.parametrize(
+    ("action", "up_to_date", "message"),
+    (
+        (actions.build_docker_image, True, "Docker image is up to date"),
+        (actions.rebuild_docker_image, False, "Docker image built"),
+    ),
+)
+def test_build_skipped_when_up_to_date(action, *, up_to_date: bool, message: str) -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    builds = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/builds"
+
+    with framework.mock() as rsps:
+        rsps.add("POST", builds, json={"id": "job", "state": "queued"}, status=202)
+        rsps.add("GET", f"{builds}/job/log", body="Image is up to date, skipping build\n")
+        rsps.add(
+            "GET",
+            f"{builds}/job",
+            json={"id": "job", "state": "succeeded", "up_to_date": up_to_date},
+        )
+        messages = list(action(site, Appserver.list_pingable()))
+
+        submitted = json.loads(rsps.calls[1].request.body)
+        assert submitted["force"] == (action is actions.rebuild_docker_image)
+
+    assert messages[-1] == message
+
+
+def test_build_failure_is_user_facing() -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    builds = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/builds"
+    error = {"description": "Failed to build image", "explanation": "oops", "user_error": True}
+
+    with framework.mock() as rsps:
+        rsps.add("POST", builds, json={"id": "job", "state": "queued"}, status=202)
+        rsps.add("GET", f"{builds}/job/log", body="")
+        rsps.add(
+            "GET",
+            f"{builds}/job",
+            json={"id": "job", "state": "failed", "error": error, "retry_after": None},
+        )
+        with pytest.raises(UserFacingError, match="Failed to build image: oops"):
+            list(actions.build_docker_image(site, Appserver.list_pingable()))
+
+
+def test_cancel_build() -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    operation = Operation.objects.create(site=site, ty="fix_site")
+    assert operation.claim()
+    builds = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/builds"
+    error = {
+        "description": "Build cancelled",
+        "explanation": "The build was cancelled",
+        "user_error": True,
+    }
+
+    with framework.mock() as rsps:
+        rsps.add("POST", builds, json={"id": "job", "state": "queued"}, status=202)
+        rsps.add("GET", f"{builds}/job/log", body="Step 1/2\n")
+        rsps.add("POST", f"{builds}/job/cancel", json={"id": "job", "state": "running"})
+        rsps.add(
+            "GET",
+            f"{builds}/job",
+            json={"id": "job", "state": "cancelled", "error": error, "retry_after": None},
+        )
+        messages = actions.build_docker_image(site, Appserver.list_pingable())
+        assert next(messages).startswith("Connecting")
+        assert next(messages) == "Step 1/2"
+
+        assert actions.cancel_build(site)
+        with pytest.raises(UserFacingError, match="Build cancelled: The build was cancelled"):
+            list(messages)
+
+    # the build is finished, so there is nothing left to cancel
+    operation.delete()
+    assert not actions.cancel_build(site)
+
+
+def test_cancel_build_before_it_is_submitted() -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    assert Operation.objects.create(site=site, ty="fix_site").claim()
+
+    # e.g. while the appserver is being chosen
+    assert actions.cancel_build(site)
+    with framework.mock() as rsps:
+        with pytest.raises(UserFacingError, match="The build was cancelled"):
+            list(actions.build_docker_image(site, Appserver.list_pingable()))
+        # only the ping
+        assert len(rsps.calls) == 1
+
+    # the next build isn't cancelled
+    assert cache.get(actions._CANCEL_KEY.format(site.id)) is None
+
+
+def test_cancel_build_view_reports_errors(monkeypatch, client, student) -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    site.users.add(student)
+    client.force_login(student)
+
+    def cancel_build(_site: Site) -> bool:
+        raise requests.ConnectionError("appserver is down")
+
+    monkeypatch.setattr(actions, "cancel_build", cancel_build)
+    response = client.post(reverse("sites:cancel_build", args=[site.id]), follow=True)
+    assert response.status_code == 200
+    assert [str(message) for message in response.context["messages"]] == [
+        "The build couldn't be cancelled, please try again"
+    ]
+
+
+@pytest.mark.parametrize(
+    ("result", "message"),
+    (
+        ({"status": "updated", "changed": ["labels"]}, "Created/updated Docker service"),
+        ({"status": "unchanged", "changed": []}, "Docker service is up to date"),
+        (
+            {"status": "updated", "changed": ["image"], "startup_seconds": 2.5},
+            "Site started in 2.5s",
+        ),
+    ),
+)
+def test_update_docker_service(result: dict, message: str) -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+
+    with framework.mock({"path": "/api/docker/service/update", "data": result}):
+        messages = list(actions.update_docker_service(site, Appserver.list_pingable()))
+
+    assert messages[-1] == message
+
+
+def test_restart_docker_service() -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    result = {"status": "restarted", "changed": [], "startup_seconds": 1.5}
+
+    # the request has to ask for the restart to match
+    with framework.mock({"path": "/api/docker/service/update?restart=true", "data": result}):
+        messages = list(actions.restart_docker_service(site, Appserver.list_pingable()))
+
+    assert messages[-2:] == ["Restarted Docker service", "Site started in 1.5s"]
+
+
+def test_rolled_back_update_is_user_facing() -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    result = {"status": "updated", "changed": ["image"], "rolled_back": True}
+
+    with (
+        framework.mock({"path": "/api/docker/service/update", "data": result}),
+        pytest.raises(UserFacingError, match="failed its health check"),
+    ):
+        list(actions.update_docker_service(site, Appserver.list_pingable()))
@@ -0,0 +1,71 @@
+from django.conf import settings
+from prometheus_client import REGISTRY
+
+from .. import appserver
+from ..appserver import Appserver
+from . import framework
+
+
+def test_sessions_are_pooled_per_host() -> None:
+    session = appserver.get_session("mocked-appserver")
+    assert appserver.get_session("mocked-appserver") is session
+    assert appserver.get_session("other-appserver") is not session
+
+
+def test_request_timeouts() -> None:
+    with framework.mock({"path": "/api/docker/image/build", "data": {}}) as rsps:
+        (app,) = Appserver.list_pingable()
+        app.http_request("/api/docker/image/build", method="POST", timeout="build")
+
+        ping, build = rsps.calls
+        assert ping.request.req_kwargs["timeout"] == settings.DIRECTOR_APPSERVER_TIMEOUTS["ping"]
+        assert build.request.req_kwargs["timeout"] == settings.DIRECTOR_APPSERVER_TIMEOUTS["build"]
+
+
+def test_connection_reuse_ratio() -> None:
+    assert appserver.ConnectionStats(requests=0, connections=0).reuse_ratio == 0
+    assert appserver.ConnectionStats(requests=10, connections=1).reuse_ratio == 0.9
+
+
+def test_connection_metrics(monkeypatch) -> None:
+    totals = iter([(3, 1), (5, 1)])
+    monkeypatch.setattr(
+        appserver,
+        "_pool_stats",
+        lambda _host, _session: appserver.ConnectionStats(*next(totals)),
+    )
+    monkeypatch.setattr(appserver, "_recorded_stats", {})
+
+    def samples() -> tuple[float, float]:
+        return tuple(  # type: ignore[return-value]
+            REGISTRY.get_sample_value(name, {"host": "mocked-appserver"}) or 0.0
+            for name in (
+                "director_appserver_requests_total",
+                "director_appserver_connections_total",
+            )
+        )
+
+    before = samples()
+    with framework.mock({"path": "/api/docker/image/build", "data": {}}):
+        (app,) = Appserver.list_pingable()
+        app.http_request("/api/docker/image/build", method="POST")
+
+    after = samples()
+    # the ping, and then the request itself
+    assert (after[0] - before[0], after[1] - before[1]) == (5, 1)
+
+
+def test_streamed_requests_are_outstanding_until_closed() -> None:
+    log = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/builds/job/log"
+    with framework.mock() as rsps:
+        rsps.add("GET", log, body="Step 1/1\n")
+        (app,) = Appserver.list_pingable()
+
+        response = app.http_request("/api/docker/image/builds/job/log", method="GET", stream=True)
+        assert app.outstanding_requests == 1
+        with response:
+            assert list(response.iter_lines(decode_unicode=True)) == ["Step 1/1"]
+        assert app.outstanding_requests == 0
+
+        app.http_request("/api/docker/image/builds/job/log", method="GET")
+        assert app.outstanding_requests == 0
@@ -0,0 +1,141 @@
+import json
+from collections.abc import Callable
+from typing import Any
+
+import pytest
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.urls import reverse
+
+from ..consumers import SiteConsumer
+from ..models import Action, Operation, Site
+from ..operations import (
+    ProgressWriter,
+    send_action_finished_message,
+    send_operation_updated_message,
+)
+
+
+@pytest.fixture
+def site(student) -> Site:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    site.users.add(student)
+    return site
+
+
+def communicator(user) -> WebsocketCommunicator:
+    comm = WebsocketCommunicator(SiteConsumer.as_asgi(), "/ws/sites/")
+    comm.scope["user"] = user
+    return comm
+
+
+def watch(user, site: Site, send_events: Callable[[], None]) -> list[dict[str, Any]]:
+    """Returns the events a user watching the site receives while ``send_events`` runs."""
+
+    async def run() -> list[dict[str, Any]]:
+        comm = communicator(user)
+        connected, _ = await comm.connect()
+        assert connected
+        await comm.send_json_to({"subscribe": [site.id]})
+        # the subscription is done once the consumer is idle again
+        assert await comm.receive_nothing()
+        await database_sync_to_async(send_events)()
+        events = []
+        while not await comm.receive_nothing():
+            events.append(await comm.receive_json_from())
+        await comm.disconnect()
+        return events
+
+    return async_to_sync(run)()
+
+
+def test_action_events(site: Site, student, django_user_model) -> None:
+    operation = Operation.objects.create(site=site, ty="fix_site")
+    action = Action.objects.create(operation=operation, slug="some_action", name="Some action")
+    superuser = django_user_model.objects.create_superuser(
+        username="admin", first_name="A", last_name="B", email="a@b.c", is_teacher=True
+    )
+
+    def send_events() -> None:
+        progress = ProgressWriter(action)
+        progress.write("building")
+        progress.close()
+        action.result = True
+        send_action_finished_message(action)
+
+    events = watch(superuser, site, send_events)
+    assert [event["type"] for event in events] == ["action.progress", "action.finished"]
+    assert events[0]["message"] == "building\n"
+    assert events[1]["result"] is True
+
+    # the action messages are only for superusers
+    events = watch(student, site, send_events)
+    assert [event["type"] for event in events] == ["action.finished"]
+
+
+def test_cannot_watch_invisible_site(site: Site, teacher) -> None:
+    operation = Operation.objects.create(site=site, ty="fix_site")
+    action = Action.objects.create(operation=operation, slug="some_action", name="Some action")
+
+    assert not watch(teacher, site, lambda: send_action_finished_message(action))
+
+
+def test_one_connection_watches_many_sites(site: Site, student) -> None:
+    other = Site.objects.create(name="other", mode="dynamic", purpose="project")
+    other.users.add(student)
+
+    async def run() -> list[dict[str, Any]]:
+        comm = communicator(student)
+        connected, _ = await comm.connect()
+        assert connected
+        await comm.send_json_to({"subscribe": [site.id, other.id]})
+        assert await comm.receive_nothing()
+        for subscribed in (site, other):
+            await database_sync_to_async(Operation.objects.create)(site=subscribed, ty="fix_site")
+            await database_sync_to_async(send_operation_updated_message)(subscribed)
+        events = [await comm.receive_json_from(), await comm.receive_json_from()]
+        await comm.disconnect()
+        return events
+
+    events = async_to_sync(run)()
+    assert [(event["type"], event["site_id"]) for event in events] == [
+        ("operation.updated", site.id),
+        ("operation.updated", other.id),
+    ]
+
+
+def test_index_watches_sites(client, site: Site, student) -> None:
+    Operation.objects.create(site=site, ty="fix_site")
+    Operation.objects.create(site=site, ty="restart_site")
+    client.force_login(student)
+
+    response = client.get(reverse("sites:index"))
+    (row,) = response.context["sites"]
+    assert json.loads(row.operation_json) == {
+        "id": row.operations[0].id,
+        "type": "fix_site",
+        "name": "Attempting to fix site",
+        "has_started": False,
+        "building": False,
+        "queued": 1,
+    }
+    content = response.content.decode()
+    assert f'x-data="siteStatus({site.id}, ' in content
+    # shown once the build starts
+    assert 'x-show="building"' in content
+
+
+def test_failed_operations_are_not_current(client, site: Site, student) -> None:
+    failed = Operation.objects.create(site=site, ty="fix_site")
+    failed.fail("oh no")
+    Operation.objects.create(site=site, ty="restart_site")
+    client.force_login(student)
+
+    response = client.get(reverse("sites:index"))
+    (row,) = response.context["sites"]
+    operation = json.loads(row.operation_json)
+    assert (operation["type"], operation["queued"]) == ("restart_site", 0)
+
+    events = watch(student, site, lambda: Operation.objects.get(ty="restart_site").fail("oh no"))
+    assert events[-1] == {"type": "operation.updated", "site_id": site.id, "operation": None}
@@ -0,0 +1,178 @@
+import json
+
+import pytest
+import responses
+from django.urls import reverse
+
+from .. import fleet, tasks
+from ..appserver import Appserver
+from ..models import Action, Operation, Site
+
+
+@pytest.fixture
+def sites() -> list[Site]:
+    return [
+        Site.objects.create(name=f"site{i}", mode="dynamic", purpose="project") for i in range(5)
+    ]
+
+
+@pytest.fixture(autouse=True)
+def no_celery(monkeypatch) -> None:
+    monkeypatch.setattr(tasks, "queue_operation", lambda operation, **_kwargs: None)
+    monkeypatch.setattr(Appserver, "list_pingable", lambda: [Appserver("mocked-appserver")])
+
+
+def test_concurrency_is_bounded(sites: list[Site]) -> None:
+    runner = fleet.FleetRunner("restart_site", [site.id for site in sites], max_concurrent=2)
+
+    progress = runner.step()
+    assert Operation.objects.count() == 2
+    assert progress.running == 2
+    assert progress.pending == 3
+
+    # nothing finished, so nothing new starts
+    assert runner.step().running == 2
+    assert Operation.objects.count() == 2
+
+    # operations are deleted once they succeed
+    Operation.objects.order_by("id").first().delete()
+    progress = runner.step()
+    assert progress.succeeded == 1
+    assert progress.running == 2
+    assert Operation.objects.count() == 2
+
+
+def test_per_appserver_limit(settings, sites: list[Site]) -> None:
+    settings.DIRECTOR_FLEET_MAX_PER_APPSERVER = 1
+    runner = fleet.FleetRunner("restart_site", [site.id for site in sites])
+
+    assert runner.step().running == 1
+    assert Operation.objects.count() == 1
+
+
+def test_busiest_appserver_limits_concurrency(monkeypatch, settings, sites: list[Site]) -> None:
+    settings.DIRECTOR_FLEET_MAX_PER_APPSERVER = 2
+    busy, idle = Appserver("busy-appserver"), Appserver("idle-appserver")
+    monkeypatch.setattr(Appserver, "list_pingable", lambda: [busy, idle])
+    monkeypatch.setattr(
+        Appserver, "outstanding_requests", property(lambda self: 1 if self is busy else 0)
+    )
+    runner = fleet.FleetRunner("restart_site", [site.id for site in sites])
+
+    # the operations could all land on the busy appserver
+    assert runner.step().running == 1
+
+
+def test_batches_start_operations_within_capacity(settings, sites: list[Site]) -> None:
+    # every site is in the middle of an operation
+    for site in sites:
+        assert site.start_operation("fix_site").claim()
+    runner = fleet.FleetRunner(
+        "restart_site", [site.id for site in sites], max_concurrent=2, batch_size=10
+    )
+
+    progress = runner.step()
+    assert progress.running == 2
+    assert progress.pending == 3
+    assert Operation.objects.filter(ty="restart_site").count() == 2
+
+
+def test_failures_are_reported(sites: list[Site]) -> None:
+    runner = fleet.FleetRunner("restart_site", [site.id for site in sites[:2]], max_concurrent=2)
+    runner.step()
+
+    failed, succeeded = Operation.objects.order_by("id")
+    Action.objects.create(operation=failed, slug="restart", name="Restarting", result=False)
+    succeeded.delete()
+
+    progress = runner.step()
+    assert progress.is_done
+    assert progress.succeeded == 1
+    assert progress.failed == (failed.site.name,)
+
+    assert fleet.get_progress(runner.fleet_id) == progress
+
+
+def test_service_updates_are_batched(settings, sites: list[Site]) -> None:
+    settings.DIRECTOR_FLEET_BATCH_SIZE = 10
+    # sites with queued operations go through their queue
+    sites[0].start_operation("fix_site")
+    results = [
+        {"site": sites[1].id, "result": {"status": "unchanged", "changed": []}, "error": None},
+        {"site": sites[2].id, "result": None, "error": "No such image"},
+        {"site": sites[3].id, "result": {"status": "updated", "changed": ["image"]}, "error": None},
+    ]
+    runner = fleet.FleetRunner(
+        "restart_site", [site.id for site in sites], batch_size=settings.DIRECTOR_FLEET_BATCH_SIZE
+    )
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        rsps.add(
+            "POST",
+            f"{Appserver.protocol()}://mocked-appserver/api/docker/service/update-many",
+            body="".join(json.dumps(result) + "\n" for result in results),
+        )
+        progress = runner.step()
+        request = rsps.calls[-1].request
+        submitted = json.loads(request.body)
+
+    # the fleet's concurrency limit applies to the batch too
+    assert request.params == {"concurrency": "2", "restart": "true"}
+
+    assert sorted(site["pk"] for site in submitted) == sorted(site.id for site in sites[1:])
+    assert progress.succeeded == 2
+    # sites[4] wasn't reported back on
+    assert sorted(progress.failed) == [sites[2].name, sites[4].name]
+    # the fix_site that was queued on sites[0] restarts it too
+    assert progress.running == 1
+    assert list(Operation.objects.values_list("ty", flat=True)) == ["fix_site"]
+
+
+def test_fleet_task_requeues_itself(monkeypatch, settings, sites: list[Site]) -> None:
+    settings.DIRECTOR_FLEET_MAX_CONCURRENT = 2
+    requeued = []
+    monkeypatch.setattr(
+        tasks.run_fleet_operation,
+        "apply_async",
+        lambda args, countdown: requeued.append((args, countdown)),
+    )
+    site_ids = [site.id for site in sites[:3]]
+
+    tasks.run_fleet_operation("fleet", "fix_site", site_ids)
+    ((args, countdown),) = requeued
+    assert countdown == settings.DIRECTOR_FLEET_POLL_INTERVAL
+    assert Operation.objects.count() == 2
+
+    # the next run carries on where the last one left off
+    Operation.objects.all().delete()
+    tasks.run_fleet_operation(*args)
+    assert Operation.objects.count() == 1
+    assert fleet.get_progress("fleet").succeeded == 2
+
+    Operation.objects.all().delete()
+    tasks.run_fleet_operation(*requeued[-1][0])
+    assert len(requeued) == 2
+    assert fleet.get_progress("fleet").is_done
+
+
+def test_admin_shows_progress(monkeypatch, admin_client, sites: list[Site]) -> None:
+    monkeypatch.setattr(tasks.run_fleet_operation, "delay", lambda *_args: None)
+
+    response = admin_client.post(
+        reverse("admin:sites_site_changelist"),
+        {"action": "restart_sites", "_selected_action": [site.id for site in sites]},
+        follow=True,
+    )
+    (message,) = response.context["messages"]
+    fleet_id = str(message).split("fleet operation ")[-1].split("<")[0]
+    url = reverse("admin:sites_site_fleet_progress", args=[fleet_id])
+    assert url in str(message)
+
+    response = admin_client.get(url)
+    assert response.status_code == 200
+    assert response.context["progress"] == fleet.FleetProgress(ty="restart_site", total=5)
+
+    assert (
+        admin_client.get(reverse("admin:sites_site_fleet_progress", args=["unknown"])).status_code
+        == 404
+    )
@@ -0,0 +1,95 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from django.core.cache import cache
+from django.urls import reverse
+
+from .. import health
+from ..appserver import Appserver
+from . import framework
+
+
+def test_list_pingable_populates_registry() -> None:
+    assert health.healthy_hosts() is None
+    with framework.mock():
+        (appserver,) = Appserver.list_pingable()
+    assert appserver.host == "mocked-appserver"
+    assert health.healthy_hosts() == ["mocked-appserver"]
+
+    # the registry is warm, so this shouldn't ping again
+    assert [app.host for app in Appserver.list_pingable()] == ["mocked-appserver"]
+
+
+def test_hysteresis(settings) -> None:
+    settings.DIRECTOR_APPSERVER_HEALTH_FALL = 2
+    settings.DIRECTOR_APPSERVER_HEALTH_RISE = 2
+    results = iter([True, False, False, True, True])
+
+    def ping(_host: str) -> bool:
+        return next(results)
+
+    assert health.refresh(ping) == ["mocked-appserver"]
+    # a single failure is not enough to mark it as down
+    assert health.refresh(ping) == ["mocked-appserver"]
+    assert health.refresh(ping) == []
+    # and a single success is not enough to bring it back
+    assert health.refresh(ping) == []
+    assert health.refresh(ping) == ["mocked-appserver"]
+
+
+def test_register_heartbeat(settings) -> None:
+    health.register_heartbeat("dynamic-appserver:8080")
+    assert health.known_hosts() == ["mocked-appserver", "dynamic-appserver:8080"]
+
+    settings.DIRECTOR_APPSERVER_HOSTS = ["dynamic-appserver:8080"]
+    assert health.known_hosts() == ["dynamic-appserver:8080"]
+
+
+def test_concurrent_heartbeats_are_all_registered() -> None:
+    hosts = [f"dynamic-appserver-{i}:8080" for i in range(8)]
+    barrier = threading.Barrier(len(hosts))
+
+    def register(host: str) -> None:
+        barrier.wait()
+        health.register_heartbeat(host)
+
+    with ThreadPoolExecutor(max_workers=len(hosts)) as pool:
+        list(pool.map(register, hosts))
+
+    assert sorted(health.known_hosts()[1:]) == hosts
+
+
+def test_expired_hosts_are_forgotten() -> None:
+    health.register_heartbeat("dynamic-appserver:8080")
+    health.register_heartbeat("other-appserver:8080")
+    cache.delete(health._HEARTBEAT_KEY.format("dynamic-appserver:8080"))
+
+    assert health.known_hosts() == ["mocked-appserver", "other-appserver:8080"]
+    assert cache.get(health._REGISTERED_KEY) == ["other-appserver:8080"]
+
+
+@pytest.mark.parametrize(
+    ("authorization", "status_code"),
+    (("Bearer secret", 200), ("Bearer wrong", 403), ("", 403)),
+)
+def test_heartbeat_view(client, settings, authorization: str, status_code: int) -> None:
+    settings.DIRECTOR_APPSERVER_HEARTBEAT_TOKEN = "secret"
+    response = client.post(
+        reverse("sites:appserver_heartbeat"),
+        json.dumps({"host": "dynamic-appserver:8080"}),
+        content_type="application/json",
+        headers={"Authorization": authorization},
+    )
+    assert response.status_code == status_code
+    assert ("dynamic-appserver:8080" in health.known_hosts()) == (status_code == 200)
+
+
+def test_heartbeat_view_disabled(client) -> None:
+    response = client.post(
+        reverse("sites:appserver_heartbeat"),
+        json.dumps({"host": "dynamic-appserver:8080"}),
+        content_type="application/json",
+    )
+    assert response.status_code == 404
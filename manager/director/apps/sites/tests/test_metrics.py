@@ -0,0 +1,97 @@
+from collections.abc import Iterator
+
+from django.urls import reverse
+from prometheus_client import REGISTRY
+
+from .. import metrics, tasks
+from ..appserver import Appserver
+from ..models import Operation, Site
+from ..operations import auto_run_operation_wrapper
+from . import framework
+
+
+def metrics_action(_site: Site, _appservers: list[Appserver]) -> Iterator[str]:
+    yield "done"
+
+
+def failing_metrics_action(_site: Site, _appservers: list[Appserver]) -> Iterator[str]:
+    raise RuntimeError("oh no")
+    yield
+
+
+def sample(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+SAMPLES = {
+    "failed_operations": (
+        "director_operations_total",
+        {"type": "restart_site", "result": "failure"},
+    ),
+    "succeeded_actions": (
+        "director_actions_total",
+        {"slug": "metrics_action", "result": "success", "user_recoverable": "false"},
+    ),
+    "failed_actions": (
+        "director_actions_total",
+        {"slug": "failing_metrics_action", "result": "failure", "user_recoverable": "true"},
+    ),
+    "queue_waits": ("director_operation_queue_wait_seconds_count", {"type": "restart_site"}),
+}
+
+
+def test_operation_metrics() -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    operation = Operation.objects.create(site=site, ty="restart_site")
+    assert operation.claim()
+
+    # the registry is shared with the other tests
+    before = {key: sample(name, **labels) for key, (name, labels) in SAMPLES.items()}
+
+    with framework.mock(), auto_run_operation_wrapper(operation.id) as wrapper:
+        wrapper.register_action("Succeeding", metrics_action)
+        wrapper.register_action("Failing", failing_metrics_action, user_recoverable=True)
+
+    after = {key: sample(name, **labels) for key, (name, labels) in SAMPLES.items()}
+    assert {key: after[key] - before[key] for key in SAMPLES} == dict.fromkeys(SAMPLES, 1)
+    assert sample("director_operations_in_progress", type="restart_site") == 0
+    assert sample("director_actions_in_progress", slug="metrics_action") == 0
+
+
+def test_metrics_view(client, settings, student) -> None:
+    # without a token, only staff can see the metrics
+    assert client.get(reverse("sites:metrics")).status_code == 403
+    client.force_login(student)
+    assert client.get(reverse("sites:metrics")).status_code == 403
+    student.is_staff = True
+    student.save()
+    response = client.get(reverse("sites:metrics"))
+    assert response.status_code == 200
+    assert b"director_operations_in_progress" in response.content
+
+    client.logout()
+    settings.DIRECTOR_METRICS_TOKEN = "secret"
+    assert client.get(reverse("sites:metrics")).status_code == 403
+    response = client.get(reverse("sites:metrics"), headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+
+
+def queue_depths() -> dict[str, float]:
+    return {
+        sample.labels["queue"]: sample.value
+        for metric in metrics.QueueDepthCollector().collect()
+        for sample in metric.samples
+    }
+
+
+def test_operations_are_routed_by_type(settings) -> None:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    before = queue_depths()
+
+    tasks.queue_operation(Operation.objects.create(site=site, ty="fix_site"))
+    tasks.queue_operation(Operation.objects.create(site=site, ty="restart_site"))
+    tasks.queue_operation(Operation.objects.create(site=site, ty="restart_site"), interactive=False)
+
+    after = queue_depths()
+    assert after[settings.DIRECTOR_BUILD_QUEUE] - before[settings.DIRECTOR_BUILD_QUEUE] == 1
+    assert after[settings.DIRECTOR_OPERATION_QUEUE] - before[settings.DIRECTOR_OPERATION_QUEUE] == 2
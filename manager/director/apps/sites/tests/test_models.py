@@ -0,0 +1,218 @@
+import pytest
+
+from .. import actions, tasks
+from ..appserver import Appserver
+from ..models import Action, Operation, Site
+from . import framework
+
+
+@pytest.fixture
+def site() -> Site:
+    return Site.objects.create(name="test", mode="dynamic", purpose="project")
+
+
+@pytest.fixture
+def queued(monkeypatch) -> list[int]:
+    """The ids of the operations sent to Celery."""
+    queued: list[int] = []
+    monkeypatch.setattr(
+        tasks, "queue_operation", lambda operation, **_kwargs: queued.append(operation.id)
+    )
+    return queued
+
+
+def test_same_operations_are_coalesced(
+    site: Site, queued: list[int], django_capture_on_commit_callbacks
+) -> None:
+    with django_capture_on_commit_callbacks(execute=True):
+        first = site.start_operation("update_docker_image")
+        second = site.start_operation("update_docker_image")
+
+    assert first == second
+    assert queued == [first.id]
+
+
+def test_pending_operation_absorbs_weaker_operation(site: Site, queued: list[int]) -> None:
+    fix = site.start_operation("fix_site")
+    assert site.start_operation("restart_site") == fix
+    assert list(Operation.objects.filter(site=site)) == [fix]
+
+
+def test_stronger_operation_replaces_pending_operation(
+    site: Site, queued: list[int], django_capture_on_commit_callbacks
+) -> None:
+    with django_capture_on_commit_callbacks(execute=True):
+        site.start_operation("restart_site")
+        site.start_operation("update_resource_limits")
+        fix = site.start_operation("fix_site")
+
+    assert list(Operation.objects.filter(site=site)) == [fix]
+    # the replaced operations' tasks find nothing to do
+    assert len(queued) == 3
+
+
+def test_only_the_end_of_the_queue_is_coalesced(site: Site, queued: list[int]) -> None:
+    site.start_operation("fix_site")
+    site.start_operation("regen_site_secrets")
+    site.start_operation("restart_site")
+
+    assert [op.ty for op in Operation.objects.filter(site=site).order_by("id")] == [
+        "fix_site",
+        "regen_site_secrets",
+        "restart_site",
+    ]
+
+
+def test_started_operations_are_not_coalesced(site: Site, queued: list[int]) -> None:
+    fix = site.start_operation("fix_site")
+    assert fix.claim()
+    assert site.start_operation("restart_site") != fix
+
+
+def test_delete_absorbs_everything(site: Site, queued: list[int]) -> None:
+    fix = site.start_operation("fix_site")
+    fix.claim()
+    site.start_operation("regen_site_secrets")
+    delete = site.start_operation("delete_site")
+
+    assert list(Operation.objects.filter(site=site).order_by("id")) == [fix, delete]
+    assert site.start_operation("create_site") == delete
+
+
+def test_failed_delete_does_not_absorb_operations(
+    site: Site, queued: list[int], django_capture_on_commit_callbacks
+) -> None:
+    with django_capture_on_commit_callbacks(execute=True):
+        delete = site.start_operation("delete_site")
+        assert delete.claim()
+        Action.objects.create(
+            operation=delete, slug="some_action", name="Some action", result=False
+        )
+        fix = site.start_operation("fix_site")
+
+    assert fix != delete
+    assert queued == [delete.id, fix.id]
+    assert not fix.is_waiting()
+
+
+def test_operations_wait_for_earlier_operations(site: Site, queued: list[int]) -> None:
+    first = site.start_operation("fix_site")
+    second = site.start_operation("regen_site_secrets")
+    assert not first.is_waiting()
+    assert second.is_waiting()
+
+    # failed operations don't hold up the queue
+    first.claim()
+    Action.objects.create(operation=first, slug="some_action", name="Some action", result=False)
+    assert not second.is_waiting()
+
+
+def test_operations_are_claimed_once(site: Site, queued: list[int]) -> None:
+    op = site.start_operation("fix_site")
+    assert op.claim()
+    assert op.has_started
+    assert not Operation.objects.get(id=op.id).claim()
+
+
+def test_claimed_operations_are_not_deleted_when_coalesced(
+    monkeypatch, site: Site, queued: list[int]
+) -> None:
+    limits = site.start_operation("update_resource_limits")
+    covers = Operation.covers
+
+    def claim_while_coalescing(ty: str, other: str) -> bool:
+        # its task claims it after the queue was read
+        Operation.objects.get(id=limits.id).claim()
+        return covers(ty, other)
+
+    monkeypatch.setattr(Operation, "covers", staticmethod(claim_while_coalescing))
+    fix = site.start_operation("fix_site")
+
+    assert list(Operation.objects.filter(site=site).order_by("id")) == [limits, fix]
+
+
+def test_stale_operations_do_not_hold_up_the_queue(settings, site: Site, queued: list[int]) -> None:
+    first = site.start_operation("fix_site")
+    second = site.start_operation("regen_site_secrets")
+    assert first.claim()
+    assert second.is_waiting()
+
+    settings.DIRECTOR_OPERATION_CLAIM_TIMEOUT = 0
+    # its task can claim it again when it's redelivered
+    assert Operation.objects.get(id=first.id).claim()
+    # or it fails once another operation waits on it
+    assert not second.is_waiting()
+    assert list(Operation.objects.filter_failed()) == [first]
+
+
+def test_operations_that_cannot_run_fail(monkeypatch, site: Site, queued: list[int]) -> None:
+    def list_pingable() -> list[Appserver]:
+        raise RuntimeError("No pingable app servers found")
+
+    monkeypatch.setattr(Appserver, "list_pingable", list_pingable)
+    first = site.start_operation("fix_site")
+    second = site.start_operation("regen_site_secrets")
+
+    with pytest.raises(RuntimeError):
+        tasks.run_operation(first.id)
+
+    assert list(Operation.objects.filter_failed()) == [first]
+    assert not second.is_waiting()
+
+
+def test_operations_give_up_waiting(settings, site: Site, queued: list[int]) -> None:
+    site.start_operation("fix_site")
+    second = site.start_operation("regen_site_secrets")
+
+    tasks.run_operation.apply((second.id,), retries=settings.DIRECTOR_OPERATION_QUEUE_MAX_RETRIES)
+
+    assert list(Operation.objects.filter_failed()) == [second]
+    # it can't absorb the operations queued after it
+    assert site.start_operation("regen_site_secrets") != second
+
+
+def test_operations_are_retried_when_the_appserver_is_busy(
+    monkeypatch, settings, site: Site, queued: list[int]
+) -> None:
+    settings.DIRECTOR_BUILD_BUSY_MAX_DELAY = 0
+    selected: list[str] = []
+
+    def select_appserver(appservers: list[Appserver], _site: Site, **kwargs) -> Appserver:
+        selected.append(kwargs.get("kind", "default"))
+        return appservers[0]
+
+    monkeypatch.setattr(actions, "select_appserver", select_appserver)
+    operation = site.start_operation("fix_site")
+    builds = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/builds"
+    result = {"status": "restarted", "changed": []}
+
+    with framework.mock(
+        {"path": "/api/docker/service/update?restart=true", "data": result}
+    ) as rsps:
+        rsps.add("POST", builds, json={}, status=429, headers={"Retry-After": "30"})
+        rsps.add("POST", builds, json={"id": "job", "state": "queued"}, status=202)
+        rsps.add("GET", f"{builds}/job/log", body="Step 1/1\n")
+        rsps.add("GET", f"{builds}/job", json={"id": "job", "state": "succeeded"})
+        # the retry runs right away, since Celery tasks are eager in tests
+        tasks.run_operation.apply((operation.id,))
+
+    # the appserver was chosen again for the second attempt
+    assert selected == ["build", "build", "default"]
+    assert not Operation.objects.filter(id=operation.id).exists()
+
+
+def test_operations_give_up_when_the_appserver_stays_busy(
+    settings, site: Site, queued: list[int]
+) -> None:
+    settings.DIRECTOR_BUILD_BUSY_MAX_DELAY = 0
+    settings.DIRECTOR_BUILD_BUSY_RETRIES = 0
+    operation = site.start_operation("fix_site")
+    builds = f"{Appserver.protocol()}://mocked-appserver/api/docker/image/builds"
+
+    with framework.mock() as rsps:
+        rsps.add("POST", builds, json={}, status=429, headers={"Retry-After": "30"})
+        tasks.run_operation.apply((operation.id,))
+
+    assert list(Operation.objects.filter_failed()) == [operation]
+    # it can't absorb the operations queued after it
+    assert site.start_operation("regen_site_secrets") != operation
@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+from collections.abc import Iterator
+
+import pytest
+
+from .. import operations
+from ..appserver import Appserver
+from ..models import Action, Operation, Site
+from ..operations import OperationWrapper, ProgressWriter
+from . import framework
+
+
+@pytest.fixture
+def operation() -> Operation:
+    site = Site.objects.create(name="test", mode="dynamic", purpose="project")
+    return Operation.objects.create(site=site, ty="fix_site")
+
+
+def chatty_action(_site: Site, _appservers: list[Appserver]) -> Iterator[str]:
+    for i in range(100):
+        yield f"line {i}"
+
+
+def failing_action(_site: Site, _appservers: list[Appserver]) -> Iterator[str]:
+    yield "about to fail"
+    raise RuntimeError("oh no")
+
+
+def test_progress_is_batched(settings, operation: Operation, django_assert_max_num_queries) -> None:
+    settings.DIRECTOR_ACTION_PROGRESS_FLUSH_INTERVAL = 60
+    settings.DIRECTOR_ACTION_PROGRESS_FLUSH_SIZE = 200
+    wrapper = OperationWrapper(operation)
+    wrapper.register_action("Chatty action", chatty_action)
+
+    with framework.mock(), django_assert_max_num_queries(10):
+        assert wrapper.execute_operation()
+
+    action = Action.objects.get(operation=operation)
+    assert action.result is True
+    assert action.message == "".join(f"line {i}\n" for i in range(100))
+
+
+def test_progress_is_saved_on_failure(operation: Operation) -> None:
+    wrapper = OperationWrapper(operation)
+    wrapper.register_action("Failing action", failing_action)
+
+    with framework.mock():
+        assert not wrapper.execute_operation()
+
+    action = Action.objects.get(operation=operation)
+    assert action.result is False
+    assert action.message.startswith("about to fail\n")
+    assert "RuntimeError: oh no" in action.message
+
+
+def test_progress_writer_flushes_on_size(settings, operation: Operation) -> None:
+    settings.DIRECTOR_ACTION_PROGRESS_FLUSH_INTERVAL = 60
+    settings.DIRECTOR_ACTION_PROGRESS_FLUSH_SIZE = 10
+    action = Action.objects.create(operation=operation, slug="some_action", name="Some action")
+
+    progress = ProgressWriter(action)
+    progress.write("short")
+    assert Action.objects.get(id=action.id).message == ""
+    progress.write("long enough")
+    assert Action.objects.get(id=action.id).message == "short\nlong enough\n"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_progress_writer_flushes_after_silence(monkeypatch, settings, operation: Operation) -> None:
+    settings.DIRECTOR_ACTION_PROGRESS_FLUSH_INTERVAL = 0.05
+    sent: queue.SimpleQueue[str] = queue.SimpleQueue()
+    monkeypatch.setattr(
+        operations, "send_action_progress_message", lambda _action, chunk: sent.put(chunk)
+    )
+    action = Action.objects.create(operation=operation, slug="some_action", name="Some action")
+
+    progress = ProgressWriter(action)
+    progress.write("first")
+    # a slow step, without any output for a while
+    progress.write("Step 2/2 : RUN pip install")
+    assert sent.get(timeout=5) == "first\nStep 2/2 : RUN pip install\n"
+
+    deadline = time.monotonic() + 5
+    while not Action.objects.get(id=action.id).message and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert Action.objects.get(id=action.id).message == "first\nStep 2/2 : RUN pip install\n"
+
+
+def test_independent_actions_run_in_parallel(operation: Operation) -> None:
+    barrier = threading.Barrier(2, timeout=5)
+
+    def first_action(_site: Site, _appservers: list[Appserver]) -> Iterator[str]:
+        yield "waiting for second_action"
+        barrier.wait()
+
+    def second_action(_site: Site, _appservers: list[Appserver]) -> Iterator[str]:
+        yield "waiting for first_action"
+        barrier.wait()
+
+    def last_action(_site: Site, _appservers: list[Appserver]) -> Iterator[str]:
+        assert barrier.n_waiting == 0
+        yield "done"
+
+    wrapper = OperationWrapper(operation)
+    wrapper.register_action("First action", first_action, depends_on=())
+    wrapper.register_action("Second action", second_action, depends_on=())
+    wrapper.register_action("Last action", last_action)
+
+    with framework.mock():
+        assert wrapper.execute_operation()
+
+    actions = Action.objects.filter(operation=operation).order_by("id")
+    assert [action.result for action in actions] == [True, True, True]
+    assert actions[0].message == "waiting for second_action\n"
+
+
+def test_dependents_of_failed_actions_do_not_run(operation: Operation) -> None:
+    wrapper = OperationWrapper(operation)
+    wrapper.register_action("Failing action", failing_action, depends_on=())
+    wrapper.register_action("Chatty action", chatty_action, depends_on=())
+    wrapper.register_action("Dependent action", chatty_action, depends_on=[failing_action])
+
+    with framework.mock():
+        assert not wrapper.execute_operation()
+
+    failing, independent, dependent = Action.objects.filter(operation=operation).order_by("id")
+    assert failing.result is False
+    assert "RuntimeError: oh no" in failing.message
+    # it was already running, so it's allowed to finish
+    assert independent.result is True
+    assert dependent.result is None
+    assert dependent.started_time is None
+
+
+@pytest.mark.parametrize("num_actions", (1, 2))
+def test_failing_to_start_an_action_fails_it(operation: Operation, num_actions: int) -> None:
+    def new_action_callback(_action: Action) -> None:
+        raise RuntimeError("couldn't start")
+
+    wrapper = OperationWrapper(operation)
+    for i in range(num_actions):
+        wrapper.register_action(f"Action {i}", chatty_action, depends_on=())
+
+    with framework.mock():
+        assert not wrapper.execute_operation(new_action_callback=new_action_callback)
+
+    first, *others = Action.objects.filter(operation=operation).order_by("id")
+    assert first.result is False
+    assert "RuntimeError: couldn't start" in first.message
+    assert all(action.started_time is None for action in others)
@@ -0,0 +1,91 @@
+import pytest
+import responses
+from django.core.cache import cache
+
+from .. import metrics
+from ..appserver import Appserver
+from ..models import Site
+from ..selection import (
+    LeastOutstandingPolicy,
+    LoadScorePolicy,
+    affinity_stats,
+    preferred_host,
+    select_appserver,
+)
+
+
+@pytest.fixture
+def site() -> Site:
+    return Site.objects.create(name="test", mode="dynamic", purpose="project")
+
+
+@pytest.fixture
+def appservers(settings) -> list[Appserver]:
+    settings.DIRECTOR_APPSERVER_HOSTS = ["app1", "app2"]
+    return [Appserver("app1"), Appserver("app2")]
+
+
+def test_least_outstanding(site: Site, appservers: list[Appserver]) -> None:
+    cache.set("appserver-outstanding:app1", 3)
+    cache.set("appserver-outstanding:app2", 1)
+    assert LeastOutstandingPolicy().select(appservers, site=site, kind="default").host == "app2"
+
+
+@responses.activate
+def test_load_score_spreads_builds(site: Site, appservers: list[Appserver]) -> None:
+    responses.get(
+        f"{Appserver.protocol()}://app1/status/load",
+        json={"running_builds": 2, "cpu": 0.1, "memory": 0.2},
+    )
+    responses.get(
+        f"{Appserver.protocol()}://app2/status/load",
+        json={"running_builds": 0, "cpu": 0.5, "memory": 0.4},
+    )
+    policy = LoadScorePolicy()
+    assert policy.select(appservers, site=site, kind="build").host == "app2"
+    # the loads are cached
+    assert policy.select(appservers, site=site, kind="build").host == "app2"
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_load_score_without_load(site: Site, appservers: list[Appserver]) -> None:
+    responses.get(f"{Appserver.protocol()}://app1/status/load", status=404)
+    responses.get(
+        f"{Appserver.protocol()}://app2/status/load",
+        json={"running_builds": 1, "cpu": 0.5, "memory": 0.4},
+    )
+    assert appservers[0].load() is None
+    assert LoadScorePolicy().select(appservers, site=site, kind="build").host == "app1"
+
+
+def test_configurable_policy(settings, site: Site, appservers: list[Appserver]) -> None:
+    settings.DIRECTOR_APPSERVER_SELECTION_POLICY = "director.apps.sites.selection.RandomPolicy"
+    assert select_appserver(appservers, site) in appservers
+
+
+def test_build_affinity(site: Site, appservers: list[Appserver]) -> None:
+    preferred = preferred_host(site, ["app1", "app2"])
+    for _ in range(3):
+        assert select_appserver(appservers, site, kind="build").host == preferred
+
+    # fall back to another appserver if the preferred one is down
+    (fallback,) = (app for app in appservers if app.host != preferred)
+    assert select_appserver([fallback], site, kind="build") is fallback
+
+    stats = affinity_stats()
+    assert (stats.hits, stats.misses) == (3, 1)
+    assert stats.hit_rate == 0.75
+
+    (family,) = metrics.BuildAffinityCollector().collect()
+    assert {sample.labels["result"]: sample.value for sample in family.samples} == {
+        "hit": 3,
+        "miss": 1,
+    }
+
+
+def test_preferred_host_is_stable(site: Site) -> None:
+    preferred = preferred_host(site, ["app1", "app2", "app3"])
+    # removing another appserver doesn't move the site
+    remaining = [host for host in ("app1", "app2", "app3") if host != preferred][:1]
+    assert preferred_host(site, [preferred, *remaining]) == preferred
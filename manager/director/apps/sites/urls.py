@@ -8,4 +8,7 @@ urlpatterns = [
     path("", views.index, name="index"),
     path("create/", views.create_site, name="create"),
     path("delete/<int:site_id>", views.delete_site, name="delete"),
+    path("cancel-build/<int:site_id>", views.cancel_build, name="cancel_build"),
+    path("appservers/heartbeat", views.appserver_heartbeat, name="appserver_heartbeat"),
+    path("metrics", views.metrics_view, name="metrics"),
 ]
@@ -1,28 +1,59 @@
 from __future__ import annotations
 
+import hmac
+import json
 import logging
+import re
 from typing import TYPE_CHECKING
 
+import requests
+from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.db.models import Prefetch
+from django.http import (
+    Http404,
+    HttpRequest,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    JsonResponse,
+)
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
-from django.views.decorators.http import require_POST
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from django_htmx.http import HttpResponseLocation
+from prometheus_client import CONTENT_TYPE_LATEST
 
-from . import tasks
+from . import actions, health, metrics
 from .forms import CreateSiteForm
-from .models import Site
+from .models import Operation, Site
+from .operations import UserFacingError, describe_operations
 
 if TYPE_CHECKING:
     from director.djtypes import AuthenticatedHttpRequest
 
 logger = logging.getLogger(__name__)
 
+# a hostname (or IP address) with an optional port
+APPSERVER_HOST_REGEX = re.compile(r"[a-zA-Z0-9.-]+(:[0-9]{1,5})?")
+
 
 @login_required
 def index(request: AuthenticatedHttpRequest) -> HttpResponse:
-    sites = Site.objects.filter_visible(request.user)
+    sites = Site.objects.filter_visible(request.user).prefetch_related(
+        Prefetch(
+            "operation_set",
+            queryset=Operation.objects.exclude(
+                id__in=Operation.objects.filter_failed().values("id")
+            ).order_by("id"),
+            to_attr="operations",
+        )
+    )
+    for site in sites:
+        # the initial state of the status cells, which are then kept up to date over a websocket
+        site.operation_json = json.dumps(describe_operations(site.operations))
 
     return render(request, "sites/index.html", {"sites": sites})
 
@@ -34,13 +65,13 @@ def create_site(request: AuthenticatedHttpRequest) -> HttpResponse:
         if form.is_valid():
             site = form.save()
             site.users.add(request.user)
-            op = site.start_operation("create_site")
-            tasks.create_site.delay(op.id)
 
             if site.mode == "static":
+                site.start_operation("create_site")
                 return HttpResponseLocation(reverse("sites:index"))
 
-            return HttpResponseLocation(reverse("marketplace:store"))
+            # dynamic sites are set up once a template is chosen
+            return HttpResponseLocation(reverse("marketplace:store_for_site", args=[site.id]))
 
         if request.htmx:
             return render(request, "sites/partials/create_form.html", {"form": form})
@@ -55,6 +86,68 @@ def create_site(request: AuthenticatedHttpRequest) -> HttpResponse:
 @require_POST
 def delete_site(request: AuthenticatedHttpRequest, site_id: int) -> HttpResponse:
     site = get_object_or_404(Site.objects.filter_visible(request.user), id=site_id)
-    op = site.start_operation("delete_site")
-    tasks.delete_site.delay(op.id)
+    site.start_operation("delete_site")
+    return redirect("sites:index")
+
+
+@login_required
+@require_POST
+def cancel_build(request: AuthenticatedHttpRequest, site_id: int) -> HttpResponse:
+    site = get_object_or_404(Site.objects.filter_editable(request.user), id=site_id)
+    try:
+        cancelled = actions.cancel_build(site)
+    except (requests.RequestException, RuntimeError, ValueError, UserFacingError):
+        logger.warning("Failed to cancel the build of %s", site.name, exc_info=True)
+        messages.error(request, "The build couldn't be cancelled, please try again")
+    else:
+        if cancelled:
+            messages.success(request, "The build is being cancelled")
+        else:
+            messages.info(request, "There is no build to cancel")
     return redirect("sites:index")
+
+
+@csrf_exempt
+@require_POST
+def appserver_heartbeat(request: HttpRequest) -> HttpResponse:
+    """Registers an appserver that is sending heartbeats.
+
+    Expects a JSON body of the form ``{"host": "appserver:8080"}``, and
+    ``DIRECTOR_APPSERVER_HEARTBEAT_TOKEN`` as a bearer token.
+    """
+    token = settings.DIRECTOR_APPSERVER_HEARTBEAT_TOKEN
+    if token is None:
+        raise Http404("Appserver registration is disabled")
+
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        return HttpResponseForbidden()
+
+    try:
+        host = json.loads(request.body)["host"]
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest("Expected a JSON object with a host")
+    if not isinstance(host, str) or APPSERVER_HOST_REGEX.fullmatch(host) is None:
+        return HttpResponseBadRequest("Invalid host")
+
+    health.register_heartbeat(host)
+    return JsonResponse({"ttl": settings.DIRECTOR_APPSERVER_HEARTBEAT_TTL})
+
+
+@require_GET
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """Exports the operation metrics for Prometheus to scrape.
+
+    If ``DIRECTOR_METRICS_TOKEN`` is set, it must be sent as a bearer token. Otherwise,
+    only staff can see the metrics, since they include the appservers' hostnames.
+    """
+    token = settings.DIRECTOR_METRICS_TOKEN
+    if token is None:
+        allowed = request.user.is_staff
+    else:
+        authorization = request.headers.get("Authorization", "")
+        allowed = hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+    if not allowed:
+        return HttpResponseForbidden()
+
+    return HttpResponse(metrics.render(), content_type=CONTENT_TYPE_LATEST)
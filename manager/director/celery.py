@@ -2,7 +2,7 @@ import logging
 import os
 
 from celery import Celery
-from celery.signals import after_setup_logger, after_setup_task_logger
+from celery.signals import after_setup_logger, after_setup_task_logger, worker_process_shutdown
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "director.settings")
 
@@ -17,3 +17,12 @@ def setup_logger(logger, **kwargs):
     from django.conf import settings
 
     logger.level = getattr(logging, settings.CELERY_LOG_LEVEL)
+
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    """Stops exporting the live gauges of a worker process that exited."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid or os.getpid())
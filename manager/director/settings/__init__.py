@@ -138,6 +138,20 @@ if TESTING:
     DATABASES["default"]["NAME"] = ":memory:"
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://redis:6379/1",
+    },
+}
+
+if TESTING:
+    CACHES["default"] = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -246,12 +260,25 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # ASGI for websockets
 ASGI_APPLICATION = "director.asgi.application"
 
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {"hosts": [("redis", 6379)]},
+    },
+}
+
+if TESTING:
+    CHANNEL_LAYERS["default"] = {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+
 
 # Celery
 CELERY_BROKER_URL = "redis://redis:6379/0"
 CELERY_LOG_LEVEL = "WARNING"
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 
+if TESTING:
+    CELERY_BROKER_URL = "memory://"
+
 
 # Director settings
 DOCS_URL = "https://jasongrace2282.github.io/director5/"
@@ -277,6 +304,16 @@ DIRECTOR_RESOURCES_DEFAULT_CPUS: Final = 0.6
 DIRECTOR_RESOURCES_DEFAULT_MEMORY_LIMIT: Final = 100 * 1000 * 1000
 # Client body (aka file upload) size limit in bytes
 DIRECTOR_RESOURCES_MAX_REQUEST_BODY: Final = 2 * 1024 * 1024
+# The CPUs and memory (in bytes) each image build may use. Appservers reserve these
+# from their build budget, and answer with a 429 if they're too busy.
+DIRECTOR_BUILD_DEFAULT_CPUS: Final = 1.0
+DIRECTOR_BUILD_DEFAULT_MEMORY_LIMIT: Final = 1000 * 1000 * 1000
+# How many times a build is retried when the appserver is too busy, and the longest
+# it waits (in seconds) between attempts, whatever the appserver asks for. The
+# operation goes back to the queue in the meantime, and the appserver is chosen again
+# for each attempt.
+DIRECTOR_BUILD_BUSY_RETRIES: Final = 10
+DIRECTOR_BUILD_BUSY_MAX_DELAY: Final = 60
 
 # Appservers
 DIRECTOR_APPSERVER_HOSTS: list[str] = ["fastapi:8080"]
@@ -288,6 +325,120 @@ Uses HTTP if is ``None``. Note that the SSL settings must be the same
 for all appservers (by design).
 """
 
+# The maximum number of keep-alive connections each worker process holds open to an appserver
+DIRECTOR_APPSERVER_POOL_SIZE: Final = 10
+
+DIRECTOR_APPSERVER_TIMEOUTS: dict[str, tuple[float, float]] = {
+    "ping": (2, 2),
+    "default": (5, 60),
+    # service updates wait for the new container to be healthy
+    "deploy": (5, 3 * 60),
+    "build": (5, 30 * 60),
+}
+"""The ``(connect, read)`` timeouts in seconds for each class of appserver endpoint."""
+
+# The health of the appservers is tracked in a shared registry in the cache.
+# Seconds between the background pings of all appservers
+DIRECTOR_APPSERVER_PING_INTERVAL: Final = 10
+# Seconds a ping result is trusted for. If no pings are recorded for this long
+# (e.g. celery beat is down), workers fall back to pinging the appservers themselves.
+DIRECTOR_APPSERVER_HEALTH_TTL: Final = 60
+# Number of consecutive failed pings before a healthy appserver is marked as down
+DIRECTOR_APPSERVER_HEALTH_FALL: Final = 2
+# Number of consecutive successful pings before a down appserver is marked as healthy
+DIRECTOR_APPSERVER_HEALTH_RISE: Final = 2
+
+# Appservers not in DIRECTOR_APPSERVER_HOSTS can register themselves by sending heartbeats.
+# They are forgotten if they stop sending heartbeats for DIRECTOR_APPSERVER_HEARTBEAT_TTL seconds.
+DIRECTOR_APPSERVER_HEARTBEAT_TTL: Final = 60
+DIRECTOR_APPSERVER_HEARTBEAT_TOKEN: str | None = None
+"""The shared secret appservers must send heartbeats with.
+
+Dynamic registration is disabled if this is ``None``.
+"""
+
+# How the appserver for each action is chosen.
+# Must be the import path of a director.apps.sites.selection.SelectionPolicy.
+DIRECTOR_APPSERVER_SELECTION_POLICY = "director.apps.sites.selection.LoadScorePolicy"
+# Seconds the load reported by each appserver is cached for
+DIRECTOR_APPSERVER_LOAD_TTL: Final = 5
+# Whether to build each site's images on the same appserver every time (if it's up),
+# so Docker can reuse the layers cached from previous builds.
+DIRECTOR_BUILD_AFFINITY: Final = True
+
+# Seconds between pulls of the marketplace templates' base images onto every appserver,
+# so sites created from a template don't wait for its image to download
+DIRECTOR_TEMPLATE_WARM_INTERVAL: Final = 30 * 60
+
+CELERY_BEAT_SCHEDULE = {
+    "ping-appservers": {
+        "task": "director.apps.sites.tasks.ping_appservers",
+        "schedule": DIRECTOR_APPSERVER_PING_INTERVAL,
+        "options": {"expires": DIRECTOR_APPSERVER_PING_INTERVAL},
+    },
+    "warm-template-images": {
+        "task": "director.apps.marketplace.tasks.warm_template_images",
+        "schedule": DIRECTOR_TEMPLATE_WARM_INTERVAL,
+        "options": {"expires": DIRECTOR_TEMPLATE_WARM_INTERVAL},
+    },
+}
+
+# Progress messages from actions are saved in batches, once this many seconds have
+# passed since the last save or this many characters are waiting to be saved.
+DIRECTOR_ACTION_PROGRESS_FLUSH_INTERVAL: Final = 2.0
+DIRECTOR_ACTION_PROGRESS_FLUSH_SIZE: Final = 16 * 1024
+
+# The maximum number of independent actions in an operation that can run at the same time
+DIRECTOR_OPERATION_MAX_PARALLEL_ACTIONS: Final = 4
+
+# Operations on a site run one at a time, in the order they were queued. An operation
+# waiting on an earlier one is checked again after this many seconds.
+DIRECTOR_OPERATION_QUEUE_RETRY_DELAY: Final = 5
+# An operation that has waited this many times fails, instead of holding up the operations
+# queued after it.
+DIRECTOR_OPERATION_QUEUE_MAX_RETRIES: Final = 3 * 60 * 60 // DIRECTOR_OPERATION_QUEUE_RETRY_DELAY
+# An operation that started this many seconds ago, and still hasn't finished, is assumed to
+# have been lost with its worker. It can be claimed again (if its task is redelivered), and
+# fails once another operation on the site is waiting on it.
+DIRECTOR_OPERATION_CLAIM_TIMEOUT: Final = 2 * 60 * 60
+
+# Operations that build an image run on DIRECTOR_BUILD_QUEUE, so they don't hold up the
+# quick operations (e.g. restarting a site) on DIRECTOR_OPERATION_QUEUE. Other tasks run on
+# the default "celery" queue. Workers for the build queue should only take one message
+# at a time (--prefetch-multiplier=1), so builds aren't stuck behind a busy worker.
+DIRECTOR_OPERATION_QUEUE: Final = "operations"
+DIRECTOR_BUILD_QUEUE: Final = "builds"
+# Message priorities, where 0 is the highest. Operations that users are waiting on
+# take priority over bulk operations (see director.apps.sites.fleet).
+DIRECTOR_OPERATION_PRIORITY_INTERACTIVE: Final = 0
+DIRECTOR_OPERATION_PRIORITY_BACKGROUND: Final = 6
+
+CELERY_TASK_DEFAULT_PRIORITY = DIRECTOR_OPERATION_PRIORITY_BACKGROUND
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
+}
+
+# Fleet operations (applying an operation to many sites at once) keep at most this many
+# operations in flight, and at most DIRECTOR_FLEET_MAX_PER_APPSERVER per healthy appserver.
+DIRECTOR_FLEET_MAX_CONCURRENT: Final = 8
+DIRECTOR_FLEET_MAX_PER_APPSERVER: Final = 2
+# Seconds between checks for finished operations in a fleet operation
+DIRECTOR_FLEET_POLL_INTERVAL: Final = 5
+# Fleet operations that only update the sites' Docker services (like restarting them)
+# send this many sites to an appserver in one request
+DIRECTOR_FLEET_BATCH_SIZE: Final = 50
+
+DIRECTOR_METRICS_TOKEN: str | None = None
+"""The bearer token Prometheus must send to scrape the metrics endpoint.
+
+If this is ``None``, only staff can see the metrics (e.g. in a browser). When running
+several processes (e.g. Celery workers), set the ``PROMETHEUS_MULTIPROC_DIR``
+environment variable to a directory shared by all of them, so the metrics from every
+process are exported.
+"""
+
 # These options control what is removed when a site is deleted.
 # If SITE_DELETION_REMOVE_FILES is True, all of the site's files are removed. (It
 # may make sense to set this to False so users' files can be recovered later, though
@@ -116,7 +116,119 @@ Director.UI.Snackbar = class {
 	static INFO = "info";
 };
 
+Director.Sites = class {
+	// every site watched on the page shares a single connection
+	static #socket = null;
+	static #handlers = new Map();
+
+	/**
+	 * Subscribes to the live events of a site's operations.
+	 *
+	 * Events are deltas about the site, e.g.
+	 * `{"type": "action.progress", "site_id": 1, "action_id": 1, "message": "..."}`.
+	 * All of the sites watched on a page share one connection, which is opened on the
+	 * first call, and re-established if it drops.
+	 *
+	 * @returns a function that unsubscribes
+	 */
+	static watch(siteId, onEvent) {
+		if (!Director.Sites.#handlers.has(siteId)) Director.Sites.#handlers.set(siteId, new Set());
+		Director.Sites.#handlers.get(siteId).add(onEvent);
+
+		const socket = Director.Sites.#socket;
+		if (socket === null) {
+			Director.Sites.#connect();
+		} else if (socket.readyState === WebSocket.OPEN) {
+			socket.send(JSON.stringify({ subscribe: [siteId] }));
+		}
+		// otherwise, every site is subscribed once the connection opens
+
+		return () => {
+			const handlers = Director.Sites.#handlers.get(siteId);
+			handlers.delete(onEvent);
+			if (handlers.size === 0) Director.Sites.#handlers.delete(siteId);
+			if (Director.Sites.#handlers.size === 0 && Director.Sites.#socket !== null) {
+				const socket = Director.Sites.#socket;
+				Director.Sites.#socket = null;
+				socket.close();
+			}
+		};
+	}
+
+	static #connect() {
+		const protocol = window.location.protocol === "https:" ? "wss" : "ws";
+		const socket = new WebSocket(`${protocol}://${window.location.host}/ws/sites/`);
+		Director.Sites.#socket = socket;
+
+		socket.addEventListener("open", () => {
+			socket.send(JSON.stringify({ subscribe: [...Director.Sites.#handlers.keys()] }));
+		});
+		socket.addEventListener("message", (message) => {
+			const event = JSON.parse(message.data);
+			for (const onEvent of Director.Sites.#handlers.get(event.site_id) ?? []) onEvent(event);
+		});
+		socket.addEventListener("close", () => {
+			// unless it was closed because nothing is watched anymore
+			if (Director.Sites.#socket === socket) {
+				setTimeout(() => {
+					if (Director.Sites.#socket === socket) Director.Sites.#connect();
+				}, 5000);
+			}
+		});
+	}
+
+	/**
+	 * Describes a site's current operation (as sent in `operation.updated` events).
+	 */
+	static describeOperation(operation) {
+		if (operation === null) return "No operations";
+
+		let description = operation.has_started ? operation.name : `${operation.name} (waiting)`;
+		if (operation.queued > 0) description += ` +${operation.queued} queued`;
+		return description;
+	}
+};
+
 document.addEventListener("alpine:init", () => {
+	// The status of a site, kept up to date as its operations run
+	Alpine.data("siteStatus", (siteId, operation) => ({
+		operation: Director.Sites.describeOperation(operation),
+		// whether the site's image is being built, so the build can be cancelled
+		building: operation?.building ?? false,
+		progress: "",
+		unwatch: null,
+
+		init() {
+			this.unwatch = Director.Sites.watch(siteId, (event) => this.onEvent(event));
+		},
+
+		destroy() {
+			this.unwatch();
+		},
+
+		onEvent(event) {
+			switch (event.type) {
+				case "operation.updated":
+					this.operation = Director.Sites.describeOperation(event.operation);
+					this.building = event.operation?.building ?? false;
+					if (event.operation === null || !event.operation.has_started) this.progress = "";
+					break;
+				case "action.started":
+					this.progress = event.action.name;
+					break;
+				case "action.progress": {
+					// only sent to superusers
+					const lines = event.message.trim().split("\n");
+					this.progress = lines[lines.length - 1];
+					break;
+				}
+				case "action.finished":
+					if (!event.result) this.progress = event.user_message || "Failed";
+					break;
+			}
+		},
+	}));
+
 	Alpine.directive("tooltip", (el, { expression }, { evaluateLater, effect }) => {
 		const getTooltipMessage = evaluateLater(expression);
 
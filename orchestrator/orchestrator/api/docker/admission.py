@@ -0,0 +1,135 @@
+"""Limits the resources used by the image builds running on this node.
+
+The node also serves live sites, so a burst of builds shouldn't be able to starve
+them (or run the node out of memory). Each build reserves its CPU and memory limits
+from a node-wide budget (see ``settings.BUILD_MAX_CONCURRENT``,
+``settings.BUILD_CPU_BUDGET`` and ``settings.BUILD_MEMORY_BUDGET``). Builds that don't
+fit wait for up to ``settings.BUILD_ADMISSION_TIMEOUT`` seconds, and are rejected if
+they still don't fit.
+
+Builds are also pinned to the cores they reserved (see ``settings.BUILD_CPUS``), so
+the CPU budget is enforced rather than only accounted for.
+"""
+
+import contextlib
+import math
+import threading
+from collections.abc import Iterator
+
+from orchestrator import settings
+
+
+class BuildRejectedError(Exception):
+    """Raised when a build can't be admitted because the node is busy."""
+
+
+class BuildAdmission:
+    """A budget of concurrent builds, CPUs and memory that builds reserve from.
+
+    Args:
+        max_concurrent: the maximum number of builds running at once
+        cpus: the number of CPUs builds can reserve in total
+        memory: the memory (in bytes) builds can reserve in total
+        max_queued: the maximum number of builds waiting for resources at once
+        cores: the cores builds are pinned to, or none to not pin them
+    """
+
+    def __init__(
+        self,
+        *,
+        max_concurrent: int,
+        cpus: float,
+        memory: int,
+        max_queued: int,
+        cores: list[int] | None = None,
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.cpus = cpus
+        self.memory = memory
+        self.max_queued = max_queued
+        # how much of each core is reserved
+        self._core_loads = dict.fromkeys(cores or (), 0.0)
+
+        self._condition = threading.Condition()
+        self._running = 0
+        self._queued = 0
+        self._reserved_cpus = 0.0
+        self._reserved_memory = 0
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _fits(self, cpus: float, memory: int) -> bool:
+        if self._running == 0:
+            # a build larger than the whole budget could otherwise never run
+            return True
+        return (
+            self._running < self.max_concurrent
+            and self._reserved_cpus + cpus <= self.cpus
+            and self._reserved_memory + memory <= self.memory
+        )
+
+    @contextlib.contextmanager
+    def admit(self, cpus: float, memory: int, *, timeout: float) -> Iterator[str]:
+        """Reserves resources for a build for the duration of the with statement.
+
+        Args:
+            cpus: the number of CPUs the build may use
+            memory: the memory (in bytes) the build may use
+            timeout: how long to wait for the resources to be available
+
+        Yields:
+            The cores to pin the build to, as Docker's ``cpusetcpus`` (or ``""`` if
+            builds aren't pinned). These are the least reserved cores.
+
+        Raises:
+            BuildRejectedError: if the resources were not available in time, or too
+                many builds are already waiting.
+        """
+        with self._condition:
+            if not self._fits(cpus, memory):
+                if self._queued >= self.max_queued:
+                    raise BuildRejectedError("Too many builds are waiting")
+                self._queued += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self._fits(cpus, memory), timeout=timeout
+                    )
+                finally:
+                    self._queued -= 1
+                if not admitted:
+                    raise BuildRejectedError("Timed out waiting for build resources")
+
+            self._running += 1
+            self._reserved_cpus += cpus
+            self._reserved_memory += memory
+            cores = sorted(self._core_loads, key=self._core_loads.__getitem__)
+            cores = sorted(cores[: math.ceil(cpus)])
+            for core in cores:
+                self._core_loads[core] += cpus / len(cores)
+
+        try:
+            yield ",".join(map(str, cores))
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._reserved_cpus -= cpus
+                self._reserved_memory -= memory
+                for core in cores:
+                    self._core_loads[core] -= cpus / len(cores)
+                self._condition.notify_all()
+
+
+build_admission = BuildAdmission(
+    max_concurrent=settings.BUILD_MAX_CONCURRENT,
+    cpus=settings.BUILD_CPU_BUDGET,
+    memory=settings.BUILD_MEMORY_BUDGET,
+    max_queued=settings.BUILD_MAX_QUEUED,
+    cores=settings.BUILD_CPUS,
+)
+"""The build budget of this node."""
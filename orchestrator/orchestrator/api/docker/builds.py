@@ -0,0 +1,465 @@
+"""Image builds that run in the background.
+
+Submitting a build returns a job right away. The build log is written to a file in
+``settings.BUILD_LOG_DIR`` as it is produced, so it can be streamed to the Manager
+while the build runs, without keeping the whole log in memory.
+
+Only one build of a site runs at a time, so builds don't race to tag its image.
+A build submitted while an identical one (with the same inputs, see :mod:`.context`)
+is in progress attaches to that job instead of starting another.
+
+Jobs are kept in memory, so the orchestrator must run in a single process.
+Finished jobs (and their logs) are forgotten after ``settings.BUILD_JOB_TTL`` seconds.
+
+Builds are cancelled if they run for longer than ``settings.BUILD_TIMEOUT`` seconds,
+or don't produce any output for ``settings.BUILD_IDLE_TIMEOUT`` seconds. They can
+also be cancelled through the API (see :meth:`BuildJob.cancel`).
+"""
+
+import contextlib
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Literal
+
+import docker
+import docker.errors
+import requests
+import urllib3.exceptions
+
+from orchestrator import settings
+from orchestrator.status import running_builds
+
+from . import cache, context, packages
+from .admission import BuildRejectedError, build_admission
+from .client import docker_client
+from .schema import BuildJobInfo, BuildLimits, SiteInfo
+
+TEMPLATE_DIR = Path(__file__).parent / "templates"
+
+GENERATED_DOCKERFILE_HEADER = "# Generated by Director. Remove this line to customize it.\n"
+
+BuildState = Literal["queued", "running", "succeeded", "failed", "cancelled"]
+"""The state of a build.
+
+Builds are queued while they wait for resources (see :mod:`.admission`).
+"""
+
+# the container a step of the build runs in
+_RUNNING_IN = re.compile(r"^ ---> Running in ([0-9a-f]+)$")
+
+_site_locks: dict[str, threading.Lock] = {}
+_site_locks_lock = threading.Lock()
+
+
+def _site_lock(site_name: str) -> threading.Lock:
+    """Returns the lock for the files of a site's builds (its Dockerfile and build index)."""
+    with _site_locks_lock:
+        return _site_locks.setdefault(site_name, threading.Lock())
+
+
+class BuildFailedError(Exception):
+    """Raised when Docker reports an error in the middle of a build."""
+
+
+class BuildCancelledError(Exception):
+    """Raised when a build is cancelled, or times out."""
+
+
+@dataclass(slots=True)
+class BuildJob:
+    """An image build running in the background.
+
+    Args:
+        site: the site whose image is built
+        limits: the resources the build may use
+        force: whether to build the image even if it is up to date, pulling the
+            newest version of the base image
+    """
+
+    site: SiteInfo
+    limits: BuildLimits
+    force: bool = False
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    state: BuildState = "queued"
+    up_to_date: bool = False
+    context_size: int | None = None
+    context_upload_seconds: float | None = None
+    cache_hit_ratio: float | None = None
+    error: dict[str, Any] | None = None
+    retry_after: int | None = None
+    finished_at: float | None = None
+    cancel_reason: str | None = None
+    build_hash: str | None = None
+    _previous: "BuildJob | None" = field(default=None, init=False, repr=False)
+    # the number of submissions waiting on the build (see BuildJobs.submit)
+    _waiters: int = field(default=1, init=False, repr=False)
+    _done: threading.Event = field(default_factory=threading.Event, init=False, repr=False)
+    _container: str | None = field(default=None, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    @property
+    def log_path(self) -> Path:
+        return settings.BUILD_LOG_DIR / f"{self.id}.log"
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state in ("succeeded", "failed", "cancelled")
+
+    def attach(self) -> bool:
+        """Adds a submission that waits on the build, unless it was cancelled.
+
+        Returns:
+            Whether the submission was attached.
+        """
+        with self._lock:
+            if self.is_finished or self.cancel_reason is not None:
+                return False
+            self._waiters += 1
+            return True
+
+    def withdraw(self, reason: str) -> bool:
+        """Gives up on the build for one of the submissions waiting on it.
+
+        The build is cancelled (see :meth:`cancel`) once no submissions are left.
+
+        Returns:
+            Whether the build was cancelled.
+        """
+        with self._lock:
+            self._waiters = max(0, self._waiters - 1)
+            if self._waiters:
+                return False
+        return self.cancel(reason)
+
+    def cancel(self, reason: str) -> bool:
+        """Stops the build, killing the step that is running.
+
+        The layers created by the build are removed once it stops.
+
+        Args:
+            reason: why the build was cancelled, which is shown to the user
+
+        Returns:
+            Whether the build was still in progress.
+        """
+        with self._lock:
+            if self.is_finished:
+                return False
+            if self.cancel_reason is None:
+                self.cancel_reason = reason
+            container = self._container
+        if container is not None:
+            # the container is removed once the step fails (see forcerm)
+            with contextlib.suppress(docker.errors.APIError):
+                docker_client.get().api.kill(container)
+        return True
+
+    def info(self) -> BuildJobInfo:
+        return BuildJobInfo.model_validate(
+            {
+                "id": self.id,
+                "state": self.state,
+                "up_to_date": self.up_to_date,
+                "context_size": self.context_size,
+                "context_upload_seconds": self.context_upload_seconds,
+                "cache_hit_ratio": self.cache_hit_ratio,
+                "error": self.error,
+                "retry_after": self.retry_after,
+            }
+        )
+
+    def hash_inputs(self) -> str:
+        """Hashes the inputs of the build, making sure the Dockerfile is up to date first."""
+        site_dir = self.site.directory_path()
+        # another build of the site may be rehashing them
+        with _site_lock(str(self.site)):
+            dockerfile_path = self._ensure_dockerfile(site_dir)
+            self.build_hash = context.build_hash(
+                site_dir, dockerfile_path, context.build_index_path(str(self.site))
+            )
+        return self.build_hash
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Waits for the build to finish, returning whether it did."""
+        return self._done.wait(timeout)
+
+    def run(self) -> None:
+        """Waits for resources to be available, then builds the image.
+
+        The build is skipped if the inputs of the build haven't changed since the
+        image was built (see :mod:`.context`).
+        """
+        try:
+            self._run()
+        finally:
+            self.finished_at = time.monotonic()
+            self._done.set()
+
+    def _run(self) -> None:
+        if self._previous is not None:
+            # the previous build of the site has to finish tagging its image first
+            self._previous.wait()
+            self._previous = None
+            # the inputs may have changed in the meantime
+            self.build_hash = None
+        try:
+            build_hash = self.build_hash or self.hash_inputs()
+            site_dir = self.site.directory_path()
+            dockerfile_path = site_dir / "Dockerfile"
+            if not self.force and self._image_build_hash() == build_hash:
+                with self.log_path.open("a") as log:
+                    log.write("Image is up to date, skipping build\n")
+                self.up_to_date = True
+            else:
+                with build_admission.admit(
+                    self.limits.cpus, self.limits.memory, timeout=settings.BUILD_ADMISSION_TIMEOUT
+                ) as cpuset:
+                    self._run_build(site_dir, dockerfile_path, build_hash, cpuset)
+        except BuildCancelledError as e:
+            self._fail("Build cancelled", str(e), user_error=True)
+            self.state = "cancelled"
+        except BuildRejectedError as e:
+            self._fail("Too many builds are running on this appserver", str(e), user_error=False)
+            self.retry_after = settings.BUILD_RETRY_AFTER
+        except BuildFailedError as e:
+            self._fail("Failed to build image", str(e), user_error=True)
+        except docker.errors.APIError as e:
+            self._fail("Failed to build image", str(e.explanation), user_error=True)
+        except Exception as e:  # noqa: BLE001
+            self._fail("Failed to build image", repr(e), user_error=False)
+        else:
+            self.state = "succeeded"
+
+    def _run_build(
+        self, site_dir: Path, dockerfile_path: Path, build_hash: str, cpuset: str
+    ) -> None:
+        """Builds the image, writing the build log to :attr:`log_path`."""
+        if self.cancel_reason is not None:
+            # cancelled while waiting for resources
+            raise BuildCancelledError(self.cancel_reason)
+
+        self.state = "running"
+        deadline = threading.Timer(
+            settings.BUILD_TIMEOUT,
+            self.cancel,
+            args=(f"The build took longer than {settings.BUILD_TIMEOUT} seconds",),
+        )
+        deadline.daemon = True
+        deadline.start()
+        try:
+            with running_builds.track(), self.log_path.open("a") as log:
+                for line in self._build(site_dir, dockerfile_path, build_hash, cpuset):
+                    log.write(line)
+                    log.flush()
+        finally:
+            deadline.cancel()
+
+    def _fail(self, description: str, explanation: str, *, user_error: bool) -> None:
+        self.error = {
+            "description": description,
+            "explanation": explanation,
+            "user_error": user_error,
+        }
+        self.state = "failed"
+
+    def _ensure_dockerfile(self, site_dir: Path) -> Path:
+        """Makes sure a valid Dockerfile exists.
+
+        Dockerfiles generated by Director are kept in sync with the site's template,
+        unless the user removed the header to customize them.
+        """
+        dockerfile_path = site_dir / "Dockerfile"
+        try:
+            current = dockerfile_path.read_text()
+        except FileNotFoundError:
+            current = None
+        if current is not None and not current.startswith(GENERATED_DOCKERFILE_HEADER):
+            return dockerfile_path
+
+        if self.site.docker is not None:
+            # the base image was pulled ahead of time, so this builds almost instantly
+            dockerfile = f"FROM {self.site.docker.base}\n"
+        else:
+            dockerfile = (TEMPLATE_DIR / "Dockerfile").read_text()
+        dockerfile = GENERATED_DOCKERFILE_HEADER + dockerfile
+        if dockerfile != current:
+            dockerfile_path.write_text(dockerfile)
+        return dockerfile_path
+
+    def _image_build_hash(self) -> str | None:
+        """Returns the hash of the inputs the site's current image was built from."""
+        client = docker_client.get()
+        try:
+            image = client.images.get(str(self.site))
+        except docker.errors.ImageNotFound:
+            return None
+        return image.labels.get(context.BUILD_HASH_LABEL)
+
+    def _build(
+        self, site_dir: Path, dockerfile_path: Path, build_hash: str, cpuset: str
+    ) -> Iterator[str]:
+        """Builds the image, yielding the lines of the build log."""
+        client = docker_client.get()
+        build_args = packages.build_args()
+        dockerfile = packages.declare_build_args(dockerfile_path.read_text(), list(build_args))
+        with tempfile.TemporaryFile() as archive:
+            self.context_size = context.create_context(
+                site_dir, dockerfile_path, archive, dockerfile=dockerfile
+            )
+            yield f"Sending build context to Docker daemon ({self.context_size / 2**20:.1f} MiB)\n"
+
+            started = time.monotonic()
+            # the context is uploaded before the build output starts streaming back
+            chunks = client.api.build(
+                fileobj=archive,
+                custom_context=True,
+                dockerfile=dockerfile_path.relative_to(site_dir).as_posix(),
+                # intermediate images are kept as the build cache (see .cache),
+                # but the intermediate containers aren't needed
+                rm=True,
+                forcerm=True,
+                pull=self.force,
+                buildargs=build_args,
+                container_limits=self.limits.container_limits(cpuset),
+                tag=str(self.site),
+                labels={context.BUILD_HASH_LABEL: build_hash},
+                decode=True,
+                # the longest the build can go without any output
+                timeout=settings.BUILD_IDLE_TIMEOUT,
+            )
+            self.context_upload_seconds = time.monotonic() - started
+
+            stats = cache.BuildCacheStats()
+            try:
+                yield from self._follow(chunks, stats)
+            except BuildCancelledError:
+                cache.build_cache.discard(stats.created_layers)
+                raise
+
+        cache.build_cache.record_use(stats.layers)
+        self.cache_hit_ratio = stats.hit_ratio
+
+    def _follow(
+        self, chunks: Iterator[dict[str, Any]], stats: cache.BuildCacheStats
+    ) -> Iterator[str]:
+        """Yields the output of a build, until it finishes or is cancelled."""
+        try:
+            for chunk in chunks:
+                if self.cancel_reason is not None:
+                    raise BuildCancelledError(self.cancel_reason)
+                if "error" in chunk:
+                    raise BuildFailedError(chunk["error"])
+                if stream := chunk.get("stream"):
+                    self._observe(stream, stats)
+                    yield stream
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            # the read timed out (which urllib3 raises as a ReadTimeoutError, since the
+            # response is already being read), so kill the step that stopped producing output
+            self.cancel(f"The build produced no output for {settings.BUILD_IDLE_TIMEOUT} seconds")
+            raise BuildCancelledError(self.cancel_reason) from e
+        except BuildFailedError as e:
+            # killing the running step makes it fail
+            if self.cancel_reason is not None:
+                raise BuildCancelledError(self.cancel_reason) from e
+            raise
+        if self.cancel_reason is not None:
+            raise BuildCancelledError(self.cancel_reason)
+
+    def _observe(self, stream: str, stats: cache.BuildCacheStats) -> None:
+        """Parses the build output, keeping track of the step that is running."""
+        for line in stream.splitlines():
+            stats.observe(line)
+            if match := _RUNNING_IN.match(line):
+                with self._lock:
+                    self._container = match.group(1)
+
+
+class BuildJobs:
+    """The build jobs known to this orchestrator."""
+
+    def __init__(self) -> None:
+        self._jobs: dict[str, BuildJob] = {}
+        # the last build submitted for each site
+        self._latest: dict[str, BuildJob] = {}
+        self._lock = threading.Lock()
+        # builds waiting for resources also need a thread
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.BUILD_MAX_CONCURRENT + settings.BUILD_MAX_QUEUED,
+            thread_name_prefix="build",
+        )
+
+    def submit(self, site: SiteInfo, limits: BuildLimits, *, force: bool = False) -> BuildJob:
+        """Starts building a site's image in the background.
+
+        If the site's image is already being built from the same inputs, the job
+        building it is returned instead, and it's only cancelled once every
+        submission waiting on it withdraws (see :meth:`BuildJob.withdraw`).
+        Otherwise the build starts once the site's previous build finishes.
+
+        Args:
+            site: the site whose image to build
+            limits: the resources the build may use
+            force: whether to build the image even if it is up to date
+
+        Raises:
+            BuildRejectedError: if too many builds are already running or waiting,
+                whether for resources, for a previous build of their site, or for a
+                thread to run on.
+        """
+        self._forget_expired()
+        job = BuildJob(site, limits, force=force)
+        # if this fails, the job reports the error when it runs
+        with contextlib.suppress(Exception):
+            job.hash_inputs()
+
+        with self._lock:
+            previous = self._latest.get(str(site))
+            if previous is not None and not previous.is_finished:
+                if (
+                    job.build_hash is not None
+                    and previous.build_hash == job.build_hash
+                    # a forced build also pulls the base image
+                    and (previous.force or not force)
+                    and previous.attach()
+                ):
+                    return previous
+                job._previous = previous
+
+            unfinished = sum(not other.is_finished for other in self._jobs.values())
+            if unfinished >= settings.BUILD_MAX_CONCURRENT + settings.BUILD_MAX_QUEUED:
+                raise BuildRejectedError("Too many builds are waiting")
+            settings.BUILD_LOG_DIR.mkdir(parents=True, exist_ok=True)
+            job.log_path.touch()
+            self._jobs[job.id] = job
+            self._latest[str(site)] = job
+        self._executor.submit(job.run)
+        return job
+
+    def get(self, job_id: str) -> BuildJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _forget_expired(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                job
+                for job in self._jobs.values()
+                if job.finished_at is not None and now - job.finished_at > settings.BUILD_JOB_TTL
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+                if self._latest.get(str(job.site)) is job:
+                    del self._latest[str(job.site)]
+        for job in expired:
+            job.log_path.unlink(missing_ok=True)
+
+
+build_jobs = BuildJobs()
@@ -0,0 +1,200 @@
+"""The build cache of this node.
+
+The builder caches the result of each step of a Dockerfile as an untagged
+(intermediate) image, which later builds with the same steps reuse. When an image
+is rebuilt or removed, its old layers stay behind as untagged images too. Together
+they make up the build cache, which is kept within ``settings.BUILD_CACHE_BUDGET``
+bytes by evicting the least recently used layers first. Untagged layers that a tagged
+image is built on aren't part of it, since they can't be evicted.
+
+Docker doesn't record when a layer was last used by a build, so the layers each build
+uses are recorded in ``settings.BUILD_CACHE_INDEX``. Layers that were never recorded
+count as last used when they were created.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from typing import Any
+
+import docker
+import docker.errors
+import requests
+
+from orchestrator import settings
+from orchestrator.status import running_builds
+
+from .client import docker_client, image_calls
+from .schema import CachePruneResult
+
+logger = logging.getLogger(__name__)
+
+_STEP = re.compile(r"^Step \d+/\d+ : (\w+)", re.IGNORECASE)
+_LAYER = re.compile(r"^ ---> ([0-9a-f]{12,64})$")
+
+
+def _short_id(image_id: str) -> str:
+    return image_id.removeprefix("sha256:")[:12]
+
+
+@dataclass(slots=True)
+class BuildCacheStats:
+    """How much of a build was served from the build cache, parsed from its output."""
+
+    steps: int = 0
+    cached_steps: int = 0
+    layers: list[str] = field(default_factory=list)
+    """The IDs of the layers the build used or created."""
+    created_layers: list[str] = field(default_factory=list)
+    """The IDs of the layers the build created, rather than taking from the cache."""
+    # whether the current step reused an existing image
+    _reused: bool = field(default=False, init=False, repr=False)
+
+    def observe(self, line: str) -> None:
+        """Parses a line of the build output."""
+        line = line.rstrip()
+        if match := _STEP.match(line):
+            # base images are pulled, not cached
+            self._reused = match.group(1).upper() == "FROM"
+            if not self._reused:
+                self.steps += 1
+        elif line == " ---> Using cache":
+            self.cached_steps += 1
+            self._reused = True
+        elif match := _LAYER.match(line):
+            layer = _short_id(match.group(1))
+            self.layers.append(layer)
+            if not self._reused:
+                self.created_layers.append(layer)
+
+    @property
+    def hit_ratio(self) -> float | None:
+        """The fraction of steps that were cached, or ``None`` if there were no steps."""
+        if not self.steps:
+            return None
+        return self.cached_steps / self.steps
+
+
+class BuildCache:
+    """Records when each layer in the build cache was last used, and evicts them."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def _read_index(self) -> dict[str, float]:
+        try:
+            return json.loads(settings.BUILD_CACHE_INDEX.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_index(self, index: dict[str, float]) -> None:
+        settings.BUILD_CACHE_INDEX.parent.mkdir(parents=True, exist_ok=True)
+        settings.BUILD_CACHE_INDEX.write_text(json.dumps(index))
+
+    def record_use(self, layers: Iterable[str]) -> None:
+        """Marks layers as used by a build just now."""
+        now = time.time()
+        with self._lock:
+            index = self._read_index()
+            index.update(dict.fromkeys(layers, now))
+            self._write_index(index)
+
+    def discard(self, layers: list[str]) -> None:
+        """Removes the layers created by a build that didn't finish.
+
+        Layers that are still used (e.g. by a build that started in the meantime)
+        are left alone.
+        """
+        client = docker_client.get()
+        # layers can only be removed after the layers built on top of them
+        for layer in reversed(layers):
+            try:
+                client.api.remove_image(layer)
+            except docker.errors.APIError:
+                logger.info("Kept layer %s of a cancelled build, since it is in use", layer)
+
+    def prune(self, budget: int) -> CachePruneResult:
+        """Evicts the least recently used layers until the cache fits in ``budget`` bytes."""
+        client = docker_client.get()
+        images: dict[str, dict[str, Any]] = {
+            image["Id"]: image for image in client.api.images(all=True)
+        }
+
+        def size(image: dict[str, Any]) -> int:
+            # an intermediate image includes the size of its parents
+            parent = images.get(image.get("ParentId") or "")
+            return image["Size"] - parent["Size"] if parent is not None else image["Size"]
+
+        # the untagged layers that tagged images are built on can't be removed
+        kept: set[str] = set()
+        for tagged_id, image in images.items():
+            if any(tag != "<none>:<none>" for tag in image.get("RepoTags") or ()):
+                ancestor = tagged_id
+                while ancestor and ancestor not in kept:
+                    kept.add(ancestor)
+                    ancestor = images.get(ancestor, {}).get("ParentId") or ""
+        cached = {
+            image_id: size(image) for image_id, image in images.items() if image_id not in kept
+        }
+        total = sum(cached.values())
+        result = CachePruneResult(cache_size=total, bytes_reclaimed=0, layers_removed=0)
+
+        with self._lock:
+            index = self._read_index()
+            while total > budget:
+                parents = {image.get("ParentId") for image in images.values()}
+                # layers can only be removed after the layers built on top of them
+                leaves = [image_id for image_id in cached if image_id not in parents]
+                if not leaves:
+                    break
+                image_id = min(
+                    leaves,
+                    key=lambda i: index.get(_short_id(i), images[i]["Created"]),
+                )
+                layer_size = cached.pop(image_id)
+                try:
+                    client.api.remove_image(image_id)
+                except docker.errors.APIError:
+                    # e.g. the layer is used by a running container
+                    logger.warning("Failed to evict %s from the build cache", image_id)
+                    continue
+                del images[image_id]
+                index.pop(_short_id(image_id), None)
+                total -= layer_size
+                result.bytes_reclaimed += layer_size
+                result.layers_removed += 1
+            self._write_index(index)
+
+        result.cache_size = total
+        return result
+
+
+build_cache = BuildCache()
+"""The build cache of this node."""
+
+
+async def prune_periodically() -> None:
+    """Prunes the build cache every ``BUILD_CACHE_PRUNE_INTERVAL`` seconds, forever.
+
+    Pruning is skipped while images are being built, since they may be using the
+    layers that would be evicted.
+    """
+    while True:
+        await asyncio.sleep(settings.BUILD_CACHE_PRUNE_INTERVAL)
+        if running_builds.value:
+            continue
+        try:
+            result = await image_calls.run(build_cache.prune, settings.BUILD_CACHE_BUDGET)
+        except (docker.errors.DockerException, requests.RequestException):
+            logger.warning("Failed to prune the build cache", exc_info=True)
+        else:
+            logger.info(
+                "Pruned the build cache: removed %d layers, reclaimed %d bytes",
+                result.layers_removed,
+                result.bytes_reclaimed,
+            )
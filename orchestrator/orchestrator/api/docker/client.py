@@ -0,0 +1,82 @@
+"""The connection to the Docker daemon, shared by everything on this orchestrator.
+
+Creating a Docker client opens a new connection pool (and asks the daemon for its
+API version), so a single client is created on first use and reused until the
+orchestrator shuts down.
+
+The Docker SDK is blocking, so async endpoints run its calls on an executor. Each
+kind of call gets its own executor, sized separately, so a backlog of slow calls
+(like pulling images) can't hold up the others, or the endpoints that don't talk
+to Docker at all. Builds run on their own executor (see :mod:`.builds`).
+"""
+
+import asyncio
+import functools
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import ParamSpec, TypeVar
+
+import docker
+
+from orchestrator import settings
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+class SharedClient:
+    """A Docker client that is created on first use, and shared between threads."""
+
+    def __init__(self) -> None:
+        self._client: docker.DockerClient | None = None
+        self._lock = threading.Lock()
+
+    def get(self) -> docker.DockerClient:
+        """Returns the shared client, connecting to the Docker daemon if needed."""
+        if (client := self._client) is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                self._client = docker.from_env(max_pool_size=settings.DOCKER_MAX_POOL_SIZE)
+            return self._client
+
+    def close(self) -> None:
+        """Closes the client's connections. The next :meth:`get` opens new ones."""
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+
+docker_client = SharedClient()
+"""The Docker client of this orchestrator."""
+
+
+class DockerExecutor:
+    """Runs blocking Docker calls for async code, on a fixed number of threads.
+
+    Args:
+        name: what the calls are for, used to name the threads
+        max_workers: the most calls that run at once
+    """
+
+    def __init__(self, name: str, max_workers: int) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"docker-{name}"
+        )
+
+    async def run(self, func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+        """Calls ``func`` on one of the executor's threads, and waits for the result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+service_calls = DockerExecutor("services", settings.DOCKER_SERVICE_WORKERS)
+"""Creating, updating, and removing services."""
+
+image_calls = DockerExecutor("images", settings.DOCKER_IMAGE_WORKERS)
+"""Submitting builds, and pulling, removing, and pruning images."""
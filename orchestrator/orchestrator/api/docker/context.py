@@ -0,0 +1,196 @@
+"""The inputs of an image build (its "context").
+
+Only the Dockerfile and the files it copies in are sent to the Docker daemon, not
+the whole site directory. The files matched by the site's ``.dockerignore`` (or
+:data:`DEFAULT_DOCKERIGNORE` if it has none) are left out as well.
+
+Each image is labelled with a hash of its build inputs: the Dockerfile, and the
+files in the site directory that the Dockerfile copies in (excluding the files
+matched by the site's ``.dockerignore``). If the hash hasn't changed since the
+image was built, the build can be skipped.
+
+Hashing every file on every build would be slow for large sites, so the digest of
+each file is cached in an index (in ``settings.BUILD_INDEX_DIR``), and only files whose
+modification time or size changed are hashed again.
+"""
+
+import fnmatch
+import hashlib
+import json
+import re
+import shlex
+import tempfile
+from pathlib import Path
+from typing import IO
+
+from docker.utils.build import create_archive, exclude_paths
+
+from orchestrator import settings
+
+BUILD_HASH_LABEL = "director.build-hash"
+"""The image label the hash of the build inputs is stored in."""
+
+# instructions can be continued on the next line with a backslash
+_CONTINUATION = re.compile(r"\\\s*\n")
+_COPY_INSTRUCTION = re.compile(r"^\s*(?:COPY|ADD)\s+(.+)$", re.IGNORECASE | re.MULTILINE)
+
+
+DEFAULT_DOCKERIGNORE = (
+    # mounted into the container at runtime
+    ".home",
+    "public",
+    # dependencies and caches that are recreated inside the image
+    "**/node_modules",
+    "**/.venv",
+    "**/venv",
+    "**/__pycache__",
+    ".git",
+)
+"""The patterns excluded from the build context of sites without a ``.dockerignore``."""
+
+
+def read_dockerignore(site_dir: Path) -> list[str]:
+    """Returns the patterns in the site's ``.dockerignore``, or the default patterns."""
+    try:
+        lines = (site_dir / ".dockerignore").read_text().splitlines()
+    except FileNotFoundError:
+        return list(DEFAULT_DOCKERIGNORE)
+    return [line.strip() for line in lines if line.strip() and not line.startswith("#")]
+
+
+def copied_sources(dockerfile: str) -> list[str]:
+    """Returns the sources of the ``COPY`` and ``ADD`` instructions in a Dockerfile.
+
+    Instructions that copy from another build stage or image (``--from``) are ignored,
+    since they don't read from the build context.
+    """
+    sources = []
+    for match in _COPY_INSTRUCTION.finditer(_CONTINUATION.sub(" ", dockerfile)):
+        arguments = match.group(1).strip()
+        try:
+            # the exec form is JSON, but Docker falls back to the shell form if it's invalid
+            args = json.loads(arguments) if arguments.startswith("[") else shlex.split(arguments)
+        except ValueError:
+            args = arguments.split()
+        if any(arg.startswith("--from") for arg in args):
+            continue
+        paths = [arg for arg in args if not arg.startswith("--")]
+        sources.extend(paths[:-1])
+    return sources
+
+
+def _is_copied(path: str, sources: list[str]) -> bool:
+    parts = path.split("/")
+    prefixes = ["/".join(parts[: i + 1]) for i in range(len(parts))]
+    for source in sources:
+        pattern = source.strip("/").removeprefix("./").rstrip("/")
+        if pattern in ("", "."):
+            return True
+        # the path, or a directory it is in, matches the source
+        if any(fnmatch.fnmatchcase(prefix, pattern) for prefix in prefixes):
+            return True
+    return False
+
+
+def context_files(site_dir: Path, dockerfile_path: Path) -> list[str]:
+    """Returns the paths (relative to the site directory) that make up the build context.
+
+    These are the Dockerfile and the files and directories it copies in, excluding
+    the ones that are ignored.
+    """
+    sources = copied_sources(dockerfile_path.read_text())
+    dockerfile_name = dockerfile_path.relative_to(site_dir).as_posix()
+    return [
+        name
+        for name in sorted(
+            exclude_paths(str(site_dir), read_dockerignore(site_dir), dockerfile_name)
+        )
+        if name == dockerfile_name or _is_copied(name, sources)
+    ]
+
+
+def create_context(
+    site_dir: Path, dockerfile_path: Path, fileobj: IO[bytes], *, dockerfile: str | None = None
+) -> int:
+    """Writes the build context as a tar archive to ``fileobj``.
+
+    Args:
+        site_dir: the site directory
+        dockerfile_path: the Dockerfile, in the site directory
+        fileobj: the file to write the archive to
+        dockerfile: if given, used as the contents of the Dockerfile instead of
+            the file's contents
+
+    Returns:
+        The size of the archive, in bytes. ``fileobj`` is rewound to the start.
+    """
+    extra_files = []
+    if dockerfile is not None:
+        extra_files.append((dockerfile_path.relative_to(site_dir).as_posix(), dockerfile))
+    create_archive(
+        str(site_dir),
+        context_files(site_dir, dockerfile_path),
+        fileobj,
+        extra_files=extra_files,
+    )
+    size = fileobj.seek(0, 2)
+    fileobj.seek(0)
+    return size
+
+
+def _file_digest(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def build_hash(site_dir: Path, dockerfile_path: Path, index_path: Path) -> str:
+    """Computes the hash of the inputs of a build.
+
+    Args:
+        site_dir: the build context
+        dockerfile_path: the Dockerfile, in the build context
+        index_path: where to cache the digests of the files in the build context
+    """
+    dockerfile = dockerfile_path.read_text()
+    dockerfile_name = dockerfile_path.relative_to(site_dir).as_posix()
+
+    try:
+        index = json.loads(index_path.read_text())
+    except (FileNotFoundError, ValueError):
+        index = {}
+    new_index: dict[str, list[int | str]] = {}
+
+    digest = hashlib.sha256(dockerfile.encode())
+    for name in context_files(site_dir, dockerfile_path):
+        path = site_dir / name
+        if not path.is_file() or name == dockerfile_name:
+            continue
+        stat = path.stat()
+        key = [stat.st_mtime_ns, stat.st_size]
+        cached = index.get(name)
+        file_digest = cached[2] if cached and cached[:2] == key else _file_digest(path)
+        new_index[name] = [*key, file_digest]
+        # COPY keeps the permissions of files
+        digest.update(f"{name}\0{stat.st_mode & 0o777:o}\0{file_digest}\0".encode())
+
+    _write_atomically(index_path, json.dumps(new_index))
+    return digest.hexdigest()
+
+
+def _write_atomically(path: Path, text: str) -> None:
+    """Writes a file, so that readers see either the old or the new contents."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as f:
+        f.write(text)
+    try:
+        Path(f.name).replace(path)
+    except OSError:
+        Path(f.name).unlink(missing_ok=True)
+        raise
+
+
+def build_index_path(site_name: str) -> Path:
+    """Returns where the file digests of a site's build context are cached."""
+    return settings.BUILD_INDEX_DIR / f"{site_name}.json"
@@ -0,0 +1,50 @@
+"""Shares downloaded packages between the image builds on this node.
+
+Each node can run a caching proxy for the package indexes (see
+``dev/docker/package-cache``), at ``settings.BUILD_PACKAGE_CACHE_URL``. Builds are
+pointed at it through the environment variables pip and npm read their index from,
+so a package is only downloaded from the internet once per node, no matter how many
+sites install it.
+
+The variables are declared as build arguments after each ``FROM`` in the Dockerfile
+sent to the Docker daemon, so they are visible to ``RUN`` instructions without
+being stored in the image (or changing the site's Dockerfile).
+"""
+
+import re
+from urllib.parse import urlsplit
+
+from orchestrator import settings
+
+_FROM_INSTRUCTION = re.compile(r"^(\s*FROM\s.*)$", re.IGNORECASE | re.MULTILINE)
+
+
+def build_args() -> dict[str, str]:
+    """Returns the build arguments that point package managers at the package cache."""
+    if not settings.BUILD_PACKAGE_CACHE_URL:
+        return {}
+    url = settings.BUILD_PACKAGE_CACHE_URL.rstrip("/")
+    args = {
+        "PIP_INDEX_URL": f"{url}/pypi/simple/",
+        "UV_DEFAULT_INDEX": f"{url}/pypi/simple/",
+        "NPM_CONFIG_REGISTRY": f"{url}/npm/",
+    }
+    split = urlsplit(url)
+    if split.scheme == "http" and split.hostname is not None:
+        # the cache is only reachable from this node, so it doesn't need TLS
+        args["PIP_TRUSTED_HOST"] = split.hostname
+        args["UV_INSECURE_HOST"] = split.hostname
+    return args
+
+
+def declare_build_args(dockerfile: str, names: list[str]) -> str:
+    """Declares build arguments in every stage of a Dockerfile.
+
+    Args:
+        dockerfile: the contents of the Dockerfile
+        names: the names of the build arguments
+    """
+    if not names:
+        return dockerfile
+    declarations = "".join(f"\nARG {name}" for name in names)
+    return _FROM_INSTRUCTION.sub(lambda match: match.group(1) + declarations, dockerfile)
@@ -1,95 +1,182 @@
+import asyncio
 import contextlib
-import shutil
 import traceback
-from pathlib import Path
-from typing import Any
+from collections.abc import AsyncIterator, Callable
+from typing import Annotated
 
-import docker
 import docker.errors
-from fastapi import APIRouter, HTTPException
+from docker.utils import parse_repository_tag
+from fastapi import APIRouter, Body, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from orchestrator import settings
 
 from . import services
-from .schema import ContainerLimits, ExceptionInfo, SiteInfo
+from .admission import BuildRejectedError
+from .builds import BuildJob, build_jobs
+from .cache import build_cache
+from .client import docker_client, image_calls, service_calls
+from .schema import (
+    BatchServiceResult,
+    BuildJobInfo,
+    BuildLimits,
+    CachePruneResult,
+    ExceptionInfo,
+    ImageInfo,
+    ServiceUpdateResult,
+    SiteInfo,
+)
 
 router = APIRouter()
 
-TEMPLATE_DIR = Path(__file__).parent / "templates"
-
 
 @router.post(
-    "/image/build",
+    "/image/builds",
+    status_code=202,
     responses={
-        "500": {"model": ExceptionInfo},
+        "429": {"model": ExceptionInfo},
     },
 )
-def build_image(
+async def submit_build(
     site: SiteInfo,
-    resource_limits: ContainerLimits | None = None,
-) -> dict[str, Any]:
-    client = docker.from_env()
-
-    site_dir = site.directory_path()
-    dockerfile_path = site_dir / "Dockerfile"
-    # make sure a valid dockerfile always exists
-    if not dockerfile_path.exists():
-        default_dockerfile = TEMPLATE_DIR / "Dockerfile"
-        shutil.copy(default_dockerfile, dockerfile_path)
-
-    # caching or storing intermediate images takes up a
-    # ton of space.
+    build_limits: BuildLimits | None = None,
+    *,
+    force: Annotated[bool, Body()] = False,
+) -> BuildJobInfo:
+    """Starts building the Docker image of a site in the background.
+
+    The build is skipped if its inputs haven't changed since the image was last built,
+    unless ``force`` is set.
+
+    The build reserves ``build_limits`` from the node's build budget, waiting for
+    them to be available if necessary (see :mod:`.admission`). If too many builds are
+    already waiting, it is rejected with a 429, and a ``Retry-After`` header.
+
+    Use :func:`get_build` to check on the build, and :func:`stream_build_log` to
+    follow its output.
+    """
     try:
-        _image, log = client.images.build(
-            path=str(site_dir),
-            dockerfile=str(dockerfile_path),
-            rm=True,
-            container_limits=resource_limits,  # type: ignore[assignment]
-            tag=str(site),
+        # hashing the inputs of the build reads the site's files
+        job = await image_calls.run(
+            build_jobs.submit, site, build_limits or BuildLimits(), force=force
         )
-    except docker.errors.BuildError as e:
+    except BuildRejectedError as e:
         raise HTTPException(
-            status_code=500,
+            status_code=429,
             detail={
-                "user_error": True,
-                "description": "Failed to build image",
-                "explanation": e.msg,
-                "traceback": tuple(e.build_log),
+                "user_error": False,
+                "description": "Too many builds are running on this appserver",
+                "explanation": str(e),
             },
+            headers={"Retry-After": str(settings.BUILD_RETRY_AFTER)},
         ) from e
+    return job.info()
+
+
+def _get_job(job_id: str) -> BuildJob:
+    job = build_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown build")
+    return job
+
+
+@router.get("/image/builds/{job_id}")
+async def get_build(job_id: str) -> BuildJobInfo:
+    """Reports the state of a build, and why it failed (if it did)."""
+    return _get_job(job_id).info()
+
+
+@router.post("/image/builds/{job_id}/cancel")
+async def cancel_build(job_id: str) -> BuildJobInfo:
+    """Cancels a build, killing the step that is running and removing the layers it built.
+
+    If other submissions are waiting on the same build, it carries on for them.
+    Cancelling a build that has already finished does nothing.
+    """
+    job = _get_job(job_id)
+    await image_calls.run(job.withdraw, "The build was cancelled")
+    return job.info()
+
+
+@router.get("/image/builds/{job_id}/log", response_class=StreamingResponse)
+async def stream_build_log(job_id: str, start: Annotated[int, Query(ge=0)] = 0):
+    """Streams the output of a build as it is produced, until the build finishes.
+
+    Args:
+        job_id: the id of the build
+        start: the offset (in bytes) in the log to start from, for resuming
+    """
+    job = _get_job(job_id)
+    return StreamingResponse(_follow_log(job, start), media_type="text/plain")
+
+
+async def _follow_log(job: BuildJob, start: int) -> AsyncIterator[bytes]:
+    with job.log_path.open("rb") as log:
+        log.seek(start)
+        while True:
+            # checked before reading, so output written just before it finished isn't missed
+            finished = job.is_finished
+            if chunk := log.read(settings.BUILD_LOG_CHUNK_SIZE):
+                yield chunk
+            elif finished:
+                return
+            else:
+                await asyncio.sleep(settings.BUILD_LOG_POLL_INTERVAL)
+
+
+@router.post("/image/delete")
+async def delete_image(site: SiteInfo):
+    await image_calls.run(_remove_image, str(site))
+    return {}
+
+
+def _remove_image(name: str) -> None:
+    with contextlib.suppress(docker.errors.ImageNotFound, docker.errors.APIError):
+        docker_client.get().images.remove(name)
+
+
+@router.post("/image/pull")
+async def pull_image(image: ImageInfo):
+    """Pulls an image, so sites built from it don't have to wait for it to download."""
+    repository, tag = parse_repository_tag(image.image)
+    try:
+        await image_calls.run(_pull_image, repository, tag or "latest")
     except docker.errors.APIError as e:
         raise HTTPException(
             status_code=500,
             detail={
-                "user_error": True,
-                "description": "Failed to build image",
-                "explanation": e.explanation,
+                "description": "Failed to pull image",
+                "traceback": traceback.format_exc(),
             },
         ) from e
+    return {}
 
-    return {"build_stdout": tuple(log)}
 
+def _pull_image(repository: str, tag: str) -> None:
+    docker_client.get().images.pull(repository, tag=tag)
 
-@router.post("/image/delete")
-def delete_image(site: SiteInfo):
-    client = docker.from_env()
-    with contextlib.suppress(docker.errors.ImageNotFound, docker.errors.APIError):
-        client.images.remove(str(site))
-    return {}
+
+@router.post("/image/cache/prune")
+async def prune_build_cache(budget: int = settings.BUILD_CACHE_BUDGET) -> CachePruneResult:
+    """Evicts the least recently used layers from the build cache until it fits in ``budget``.
+
+    The build cache is also pruned periodically (see ``BUILD_CACHE_PRUNE_INTERVAL``).
+    """
+    return await image_calls.run(build_cache.prune, budget)
 
 
 @router.post("/service/update")
-def update_docker_service(site_info: SiteInfo):
+async def update_docker_service(
+    site_info: SiteInfo, *, restart: Annotated[bool, Query()] = False
+) -> ServiceUpdateResult:
     """Creates, or updates the Docker service running the site.
 
+    The update is skipped if the service wouldn't change, unless ``restart`` is set,
+    in which case the site's container is always replaced.
     Note that this expects that a docker image exists with the correct tag.
     """
-    params = services.create_service_params(site_info)
-    client = docker.from_env()
-    service = services.find_service_by_name(client, str(site_info))
     try:
-        if service is None:
-            client.services.create(**params)
-        else:
-            service.update(**params)
+        return await service_calls.run(_update_service, site_info, restart=restart)
     except docker.errors.APIError as e:
         raise HTTPException(
             status_code=500,
@@ -98,14 +185,87 @@ def update_docker_service(site_info: SiteInfo):
                 "traceback": traceback.format_exc(),
             },
         ) from e
-    return {}
+
+
+def _update_service(site_info: SiteInfo, *, restart: bool = False) -> ServiceUpdateResult:
+    return services.update_service(docker_client.get(), site_info, restart=restart)
 
 
 @router.post("/service/remove")
-def remove_docker_service(site: SiteInfo):
-    client = docker.from_env()
-    service = services.find_service_by_name(client, str(site))
+async def remove_docker_service(site: SiteInfo):
+    await service_calls.run(_remove_service, str(site))
+    return {}
+
+
+def _remove_service(name: str) -> None:
+    client = docker_client.get()
+    service = services.find_service_by_name(client, name)
     if service is not None:
         with contextlib.suppress(docker.errors.APIError):
             service.remove()
-    return {}
+            services.service_index.discard(name, service.id)
+
+
+@router.post("/service/update-many", response_class=StreamingResponse)
+async def update_docker_services(
+    sites: list[SiteInfo],
+    concurrency: Annotated[int | None, Query(ge=1)] = None,
+    *,
+    restart: Annotated[bool, Query()] = False,
+):
+    """Creates or updates the Docker services of many sites (see :func:`update_docker_service`).
+
+    Up to ``concurrency`` services are updated at once, and never more than
+    ``SERVICE_BATCH_CONCURRENCY``. The result for each site is streamed as a line of
+    JSON (a :class:`.BatchServiceResult`) as soon as it is done, so the results aren't
+    in the same order as the sites.
+    """
+    return StreamingResponse(
+        _apply_many(sites, lambda site: _update_service(site, restart=restart), concurrency),
+        media_type="application/x-ndjson",
+    )
+
+
+@router.post("/service/remove-many", response_class=StreamingResponse)
+async def remove_docker_services(
+    sites: list[SiteInfo], concurrency: Annotated[int | None, Query(ge=1)] = None
+):
+    """Removes the Docker services of many sites.
+
+    The results are streamed like :func:`update_docker_services`.
+    """
+    return StreamingResponse(
+        _apply_many(sites, lambda site: _remove_service(str(site)), concurrency),
+        media_type="application/x-ndjson",
+    )
+
+
+async def _apply_many(
+    sites: list[SiteInfo],
+    apply: Callable[[SiteInfo], ServiceUpdateResult | None],
+    concurrency: int | None,
+) -> AsyncIterator[bytes]:
+    # fill the index first, so the sites' services aren't each looked up by listing
+    await service_calls.run(_ensure_service_index)
+    semaphore = asyncio.Semaphore(
+        min(concurrency or settings.SERVICE_BATCH_CONCURRENCY, settings.SERVICE_BATCH_CONCURRENCY)
+    )
+
+    async def apply_one(site: SiteInfo) -> BatchServiceResult:
+        async with semaphore:
+            try:
+                result = await service_calls.run(apply, site)
+            except docker.errors.APIError as e:
+                return BatchServiceResult(site=site.pk, error=str(e.explanation))
+            except Exception as e:  # noqa: BLE001
+                return BatchServiceResult(site=site.pk, error=repr(e))
+        return BatchServiceResult(site=site.pk, result=result)
+
+    for done in asyncio.as_completed([apply_one(site) for site in sites]):
+        result = await done
+        yield (result.model_dump_json() + "\n").encode()
+
+
+def _ensure_service_index() -> None:
+    if not services.service_index.ready:
+        services.service_index.resync()
@@ -19,18 +19,20 @@ from .conversions import convert_memory_limit, cpu_to_nano_cpus
 
 
 class ContainerLimits(TypedDict, total=False):
-    """The resource limits for building a container.
+    """The resource limits for building a container, as passed to Docker.
 
     Args:
         memory: the memory limit for building the container
         memswap: the memory+swap limit (or -1 to disable)
-        cpu_shares: the CPU shares (relative weight)
-        cpu_set_cpus: the CPUs in which to allow execution.
+        cpushares: the CPU shares (relative weight)
+        cpusetcpus: the CPUs in which to allow execution.
             Comma separated or hyphen-separated ranges.
     """
 
     memory: int
     memswap: int
+    cpushares: int
+    cpusetcpus: str
 
 
 class ExceptionInfo(BaseModel):
@@ -39,6 +41,59 @@ class ExceptionInfo(BaseModel):
     user_error: bool
 
 
+class BuildJobInfo(BaseModel):
+    """The status of an image build running in the background.
+
+    See :mod:`.builds`.
+    """
+
+    id: str
+    state: Literal["queued", "running", "succeeded", "failed", "cancelled"]
+    up_to_date: bool = False
+    """Whether the build was skipped, since its inputs haven't changed since the last build."""
+    context_size: int | None = None
+    """The size of the build context sent to the Docker daemon, in bytes."""
+    context_upload_seconds: float | None = None
+    """How long it took to send the build context to the Docker daemon."""
+    cache_hit_ratio: float | None = None
+    """The fraction of the build steps that were served from the build cache."""
+    error: ExceptionInfo | None = None
+    retry_after: int | None = None
+    """If the build failed because the appserver was busy, when to try again (in seconds)."""
+
+
+class CachePruneResult(BaseModel):
+    """The result of pruning the build cache (see :mod:`.cache`)."""
+
+    cache_size: int
+    """The size of the build cache after pruning, in bytes."""
+    bytes_reclaimed: int
+    layers_removed: int
+
+
+class ServiceUpdateResult(BaseModel):
+    """What updating a site's service did (see :func:`.services.update_service`)."""
+
+    status: Literal["created", "updated", "restarted", "unchanged"]
+    changed: list[str]
+    """The parameters of the service that changed."""
+    startup_seconds: float | None = None
+    """How long the new container took to become healthy, if it was replaced."""
+    rolled_back: bool = False
+    """Whether the update was rolled back, because the new container was unhealthy."""
+
+
+class BatchServiceResult(BaseModel):
+    """What updating or removing one site's service in a batch did."""
+
+    site: int
+    """The ID of the site."""
+    result: ServiceUpdateResult | None = None
+    """The result of updating the service, if it was updated."""
+    error: str | None = None
+    """Why updating or removing the service failed, if it did."""
+
+
 def convert_memory_limit_validator(
     v: object,
     handler: ValidatorFunctionWrapHandler,
@@ -56,6 +111,34 @@ class ResourceLimits(BaseModel):
     max_request_body_size: int
 
 
+class BuildLimits(BaseModel):
+    """The resources a build may use, which are reserved from the node's build budget.
+
+    See :mod:`.admission`.
+    """
+
+    cpus: Annotated[float, Field(gt=0)] = settings.BUILD_DEFAULT_CPUS
+    memory: Annotated[int, WrapValidator(convert_memory_limit_validator)] = (
+        settings.BUILD_DEFAULT_MEMORY
+    )
+
+    def container_limits(self, cpuset: str = "") -> ContainerLimits:
+        """The limits to pass to Docker for the build.
+
+        Args:
+            cpuset: the cores to pin the build to (see :meth:`.BuildAdmission.admit`)
+        """
+        limits: ContainerLimits = {
+            "memory": self.memory,
+            # no swap, so a build that runs out of memory fails instead of thrashing
+            "memswap": self.memory,
+            "cpushares": settings.BUILD_CPU_SHARES,
+        }
+        if cpuset:
+            limits["cpusetcpus"] = cpuset
+        return limits
+
+
 _db_url_validator = UrlConstraints(host_required=True, default_port=5432)
 
 
@@ -104,6 +187,22 @@ class DatabaseInfo(BaseModel):
 DOMAIN_REGEX = r"^[a-zA-Z0-9][a-zA-Z0-9~.-]*[a-zA-Z0-9]$"
 
 
+IMAGE_REGEX = r"^[a-z0-9][a-z0-9._/:@-]*$"
+
+
+class DockerInfo(BaseModel):
+    base: Annotated[str, Field(pattern=IMAGE_REGEX)]
+    """The image to build the site from, if it doesn't have its own Dockerfile.
+
+    These are the prebuilt images of the templates in the marketplace, which are
+    pulled onto every appserver ahead of time.
+    """
+
+
+class ImageInfo(BaseModel):
+    image: Annotated[str, Field(pattern=IMAGE_REGEX)]
+
+
 class SiteInfo(BaseModel):
     pk: int
     hosts: list[Annotated[str, Field(pattern=DOMAIN_REGEX)]]
@@ -112,6 +211,7 @@ class SiteInfo(BaseModel):
     resource_limits: ResourceLimits
     runfile: Annotated[str, Field(pattern=r"[/\-.a-zA-Z0-9]+")] | None = None
     db: DatabaseInfo | None = None
+    docker: DockerInfo | None = None
 
     def container_env(self) -> dict[str, Any]:
         env: dict[str, Any] = {
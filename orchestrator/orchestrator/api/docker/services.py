@@ -1,22 +1,210 @@
-"""A module for working with Docker services to run on nodes."""
+"""A module for working with Docker services to run on nodes.
 
+Services are looked up by name in :data:`service_index`, which maps the name of
+every service in the swarm to its ID. It is filled when the orchestrator starts, and
+kept current by following the Docker events for services (see
+:func:`follow_service_events`). In case an event is missed, it is also rebuilt every
+``settings.SERVICE_INDEX_RESYNC_INTERVAL`` seconds.
+
+Each service is labeled with digests of the parameters it was created from, so
+updates that wouldn't change anything are skipped (see :func:`update_service`).
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
 import string
+import threading
+import time
 from pathlib import Path
 from typing import Any
 
 import docker
+import docker.errors
+import requests
 from docker.models.services import Service as DockerService
-from docker.types import EndpointSpec, Mount, Resources, RestartPolicy, ServiceMode, UpdateConfig
+from docker.types import (
+    EndpointSpec,
+    Healthcheck,
+    Mount,
+    Resources,
+    RestartPolicy,
+    RollbackConfig,
+    ServiceMode,
+    UpdateConfig,
+)
 
 from orchestrator import settings
 
-from .schema import SiteInfo
+from .client import docker_client, service_calls
+from .schema import ServiceUpdateResult, SiteInfo
 
 TEMPLATE_DIR = Path(__file__).parent / "templates"
 
+logger = logging.getLogger(__name__)
+
+SPEC_DIGEST_LABEL = "director.spec-digest"
+"""The label with the digest of all the parameters a service was created from."""
+SPEC_PARTS_LABEL = "director.spec-parts"
+"""The label with the digest of each parameter a service was created from, as JSON."""
+
+# where run-site.sh records the PID of the site's run.sh, for the health check
+SITE_PID_FILE = "/run/director-site.pid"
+
+# parameters that the Docker SDK only accepts together
+_UPDATED_TOGETHER = ({"log_driver", "log_driver_options"},)
+
+# updates are merged into the current spec, so parameters that are only set for some
+# sites have to be reset explicitly when they are no longer set (e.g. the command of
+# a dynamic site that becomes static)
+_RESET_PARAMS: dict[str, Any] = {"command": []}
+
+
+class ServiceIndex:
+    """The IDs of the services in the swarm, by name."""
+
+    def __init__(self) -> None:
+        self._ids: dict[str, str] = {}
+        self._ready = False
+        self._lock = threading.Lock()
+        self._events: Any = None
+        # the changes made while each running resync lists the services
+        self._journals: list[list[tuple[str, str | None, str | None]]] = []
+
+    @property
+    def ready(self) -> bool:
+        """Whether the index has been filled, so services missing from it don't exist."""
+        return self._ready
+
+    def get(self, name: str) -> str | None:
+        """Returns the ID of the service with a name, if there is one."""
+        return self._ids.get(name)
+
+    def add(self, service: DockerService) -> None:
+        with self._lock:
+            self._change(service.name, service.id, None)
+
+    def discard(self, name: str, service_id: str | None = None) -> None:
+        """Removes a service from the index.
+
+        Args:
+            name: the name of the service
+            service_id: if given, the service is only removed if it has this ID
+        """
+        with self._lock:
+            self._change(name, None, service_id)
+
+    def resync(self) -> None:
+        """Rebuilds the index from the list of services in the swarm.
+
+        Services added or removed while they are listed are applied on top of the
+        listing, since it may or may not include them.
+        """
+        journal: list[tuple[str, str | None, str | None]] = []
+        with self._lock:
+            self._journals.append(journal)
+        try:
+            services = docker_client.get().services.list()
+        finally:
+            with self._lock:
+                self._journals.remove(journal)
+        ids = {service.name: service.id for service in services}
+        with self._lock:
+            for change in journal:
+                _apply_change(ids, *change)
+            self._ids = ids
+            self._ready = True
+
+    def _change(self, name: str, service_id: str | None, removed_id: str | None) -> None:
+        # called with the lock held
+        _apply_change(self._ids, name, service_id, removed_id)
+        for journal in self._journals:
+            journal.append((name, service_id, removed_id))
+
+    def follow(self) -> None:
+        """Keeps the index current with the Docker events for services.
+
+        Returns once the event stream ends (see :meth:`stop`).
+        """
+        client = docker_client.get()
+        # subscribed before the index is filled, so no changes are missed in between
+        events = self._events = client.events(decode=True, filters={"type": "service"})
+        try:
+            self.resync()
+            for event in events:
+                self._apply(event)
+        finally:
+            events.close()
+
+    def stop(self) -> None:
+        """Stops following the Docker events."""
+        if self._events is not None:
+            self._events.close()
+
+    def _apply(self, event: dict[str, Any]) -> None:
+        actor = event.get("Actor", {})
+        name = actor.get("Attributes", {}).get("name")
+        if name is None:
+            return
+        with self._lock:
+            if event.get("Action") == "remove":
+                self._change(name, None, actor["ID"])
+            else:
+                self._change(name, actor["ID"], None)
+
+
+def _apply_change(
+    ids: dict[str, str], name: str, service_id: str | None, removed_id: str | None
+) -> None:
+    """Adds a service to ``ids`` if ``service_id`` is set, or else removes it.
+
+    If ``removed_id`` is set, the service is only removed if it has that ID.
+    """
+    if service_id is not None:
+        ids[name] = service_id
+    elif removed_id is None or ids.get(name) == removed_id:
+        ids.pop(name, None)
+
+
+service_index = ServiceIndex()
+"""The services in the swarm."""
+
+
+async def follow_service_events() -> None:
+    """Keeps :data:`service_index` current, reconnecting if the event stream breaks."""
+    while True:
+        try:
+            await asyncio.to_thread(service_index.follow)
+        except (docker.errors.DockerException, requests.RequestException):
+            logger.warning("Lost the Docker event stream", exc_info=True)
+        await asyncio.sleep(settings.SERVICE_INDEX_RETRY_DELAY)
+
+
+async def resync_periodically() -> None:
+    """Rebuilds :data:`service_index` every ``SERVICE_INDEX_RESYNC_INTERVAL`` seconds."""
+    while True:
+        await asyncio.sleep(settings.SERVICE_INDEX_RESYNC_INTERVAL)
+        try:
+            await service_calls.run(service_index.resync)
+        except (docker.errors.DockerException, requests.RequestException):
+            logger.warning("Failed to resync the service index", exc_info=True)
+
 
 def find_service_by_name(client: docker.DockerClient, service_name: str) -> DockerService | None:
     """Get a docker swarm service by its name."""
+    if service_index.ready:
+        service_id = service_index.get(service_name)
+        if service_id is None:
+            return None
+        try:
+            return client.services.get(service_id)
+        except docker.errors.NotFound:
+            # removed, and the event hasn't arrived yet
+            service_index.discard(service_name, service_id)
+            return None
+
     filtered: list[DockerService] = [
         service
         # this does a service.name.startswith(service_name) instead of an exact match
@@ -111,7 +299,13 @@ def create_service_params(site_info: SiteInfo) -> dict[str, Any]:
 
     shell_cmd_template = string.Template((TEMPLATE_DIR / "run-site.sh").read_text())
     # note that the regex on the runfile should prevent injections
-    shell_cmd = shell_cmd_template.safe_substitute(SEARCH_PATH=site_info.runfile)
+    shell_cmd = shell_cmd_template.safe_substitute(
+        SEARCH_PATH=site_info.runfile, PID_FILE=SITE_PID_FILE
+    )
+    healthcheck_template = string.Template((TEMPLATE_DIR / "healthcheck.sh").read_text())
+    healthcheck = healthcheck_template.safe_substitute(
+        PID_FILE=SITE_PID_FILE if site_info.type_ == "dynamic" else ""
+    )
 
     port = "80"
     extra_envs = {"PORT": port, "HOST": "0.0.0.0"}
@@ -165,14 +359,150 @@ def create_service_params(site_info: SiteInfo) -> dict[str, Any]:
         # don't replicate the service if it's not supposed to be served
         "mode": ServiceMode(mode="replicated", replicas=int(site_info.is_served)),
         "restart_policy": RestartPolicy(condition="any", delay=5, max_attempts=5, window=0),
+        # durations are in nanoseconds (1e9 seconds)
+        "healthcheck": Healthcheck(
+            test=["CMD-SHELL", healthcheck],
+            interval=int(settings.SERVICE_HEALTH_INTERVAL * 1e9),
+            timeout=int(settings.SERVICE_HEALTH_TIMEOUT * 1e9),
+            retries=settings.SERVICE_HEALTH_RETRIES,
+            # failed checks don't count while the site starts up
+            start_period=int(settings.SERVICE_HEALTH_START_PERIOD * 1e9),
+        ),
+        # the new container serves the site as soon as it's healthy, and the old
+        # one is stopped after that
         "update_config": UpdateConfig(
             parallelism=1,
-            order="stop-first",
+            order="start-first",
             failure_action="rollback",
             max_failure_ratio=0,
-            # delay and monitor are in nanoseconds (1e9 seconds)
             delay=int(5 * 1e9),
             monitor=int(5 * 1e9),
         ),
+        "rollback_config": RollbackConfig(
+            parallelism=1,
+            order="start-first",
+            max_failure_ratio=0,
+        ),
     }
     return params
+
+
+def _digest(value: Any) -> str:
+    # the Docker SDK's types (Mount, Resources, ...) are dicts
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+def spec_digests(client: docker.DockerClient, params: dict[str, Any]) -> dict[str, str]:
+    """Returns a digest of each of the parameters for creating a service.
+
+    Sites are rebuilt under the same tag, so the digest of the image is the digest
+    of the image's ID.
+    """
+    digests = {key: _digest(value) for key, value in params.items()}
+    with contextlib.suppress(docker.errors.ImageNotFound):
+        digests["image"] = _digest(client.images.get(params["image"]).id)
+    return digests
+
+
+def update_service(
+    client: docker.DockerClient, site_info: SiteInfo, *, restart: bool = False
+) -> ServiceUpdateResult:
+    """Creates or updates the Docker service running a site, if anything changed.
+
+    Only the parameters that changed are sent to Swarm, so e.g. changing the labels
+    (like the site's domains) or scaling the service doesn't restart its container.
+    If the container is replaced, this waits for the new one to be healthy (see
+    :func:`wait_for_rollout`).
+
+    Args:
+        client: the Docker client
+        site_info: the site
+        restart: whether to replace the container even if nothing changed
+    """
+    params = create_service_params(site_info)
+    parts = spec_digests(client, params)
+    digest = _digest(parts)
+    params["labels"] = params["labels"] | {
+        SPEC_DIGEST_LABEL: digest,
+        SPEC_PARTS_LABEL: json.dumps(parts, sort_keys=True, separators=(",", ":")),
+    }
+
+    service = find_service_by_name(client, str(site_info))
+    if service is None:
+        service = client.services.create(**params)
+        # indexed right away, in case the site is updated before the event arrives
+        service_index.add(service)
+        result = ServiceUpdateResult(status="created", changed=sorted(parts))
+        previous_tasks: set[str] = set()
+    else:
+        labels = service.attrs["Spec"].get("Labels") or {}
+        if labels.get(SPEC_DIGEST_LABEL) == digest and not restart:
+            return ServiceUpdateResult(status="unchanged", changed=[])
+        previous_tasks = {task["ID"] for task in service.tasks()}
+        result = _update(service, params, parts, labels, restart=restart)
+
+    # labels are applied without replacing the container
+    if site_info.is_served and (restart or set(result.changed) - {"labels"}):
+        result.startup_seconds, result.rolled_back = wait_for_rollout(service, previous_tasks)
+        if result.startup_seconds is not None:
+            logger.info("%s started in %.1f seconds", site_info, result.startup_seconds)
+    return result
+
+
+def _update(
+    service: DockerService,
+    params: dict[str, Any],
+    parts: dict[str, str],
+    labels: dict[str, str],
+    *,
+    restart: bool,
+) -> ServiceUpdateResult:
+    try:
+        current_parts = json.loads(labels[SPEC_PARTS_LABEL])
+    except (KeyError, ValueError):
+        # created before the digests were recorded
+        service.update(**(_RESET_PARAMS | params), force_update=restart)
+        return ServiceUpdateResult(status="updated", changed=sorted(parts))
+
+    changed = {key for key, value in parts.items() if current_parts.get(key) != value}
+    # and the parameters that are no longer set
+    changed |= current_parts.keys() - parts.keys()
+    for keys in _UPDATED_TOGETHER:
+        if changed & keys:
+            changed |= keys
+    update = {key: params.get(key, _RESET_PARAMS.get(key)) for key in changed} | {
+        "labels": params["labels"]
+    }
+    if restart or "image" in changed:
+        # the tag is the same, so Swarm has to be told to replace the container
+        update["force_update"] = True
+    service.update(**update)
+    if restart and not changed:
+        return ServiceUpdateResult(status="restarted", changed=[])
+    return ServiceUpdateResult(status="updated", changed=sorted(changed))
+
+
+def wait_for_rollout(service: DockerService, previous_tasks: set[str]) -> tuple[float | None, bool]:
+    """Waits for a new container of a service to be running, which means it's healthy.
+
+    Args:
+        service: the service that was created or updated
+        previous_tasks: the IDs of the service's tasks before it was updated
+
+    Returns:
+        How long the new container took to start (or ``None`` if it didn't start
+        within ``SERVICE_ROLLOUT_TIMEOUT`` seconds), and whether the update was
+        rolled back because the new container was unhealthy.
+    """
+    started = time.monotonic()
+    while time.monotonic() - started < settings.SERVICE_ROLLOUT_TIMEOUT:
+        service.reload()
+        update_status = service.attrs.get("UpdateStatus") or {}
+        if update_status.get("State", "").startswith("rollback"):
+            return None, True
+        for task in service.tasks():
+            if task["ID"] not in previous_tasks and task["Status"]["State"] == "running":
+                return time.monotonic() - started, False
+        time.sleep(settings.SERVICE_ROLLOUT_POLL_INTERVAL)
+    return None, False
@@ -0,0 +1,32 @@
+# This is the health check of a site's container, which Docker runs periodically.
+# Updates start the new container first, and only stop the old one once the new
+# one is healthy, so the site is served throughout the update.
+
+# This is filled in by the orchestrator, and is empty for containers that
+# don't use run-site.sh
+pid_file="$PID_FILE"
+
+if [ -n "$pid_file" ]; then
+    # run-site.sh hasn't started the site yet
+    read -r pid 2>/dev/null < "$pid_file" || exit 1
+    # there is no run.sh, so there is nothing to wait for
+    [ "$pid" = none ] && exit 0
+    kill -0 "$pid" 2>/dev/null || exit 1
+fi
+
+url="http://127.0.0.1:$PORT/"
+if command -v curl >/dev/null; then
+    # any response means the site is serving, even an error page
+    exec curl -s -o /dev/null --max-time 2 "$url"
+elif command -v wget >/dev/null; then
+    output=$(wget -q -O /dev/null -T 2 "$url" 2>&1)
+    status=$?
+    # GNU wget exits with 8 on error responses, busybox's says so instead
+    [ "$status" -eq 0 ] || [ "$status" -eq 8 ] && exit 0
+    case "$output" in
+        *"server returned error"*) exit 0 ;;
+        *) exit 1 ;;
+    esac
+fi
+# without an HTTP client in the image, run.sh still running is the best we can check
+exit 0
@@ -16,10 +16,13 @@ for path in $SEARCH_PATH; do
 
         "$path" &
         child="$!"
+        # for the health check
+        echo "$child" > "$PID_FILE"
 
         while ! wait; do true; done
         exec date +'DIRECTOR: Stopped server at %Y-%m-%d %H:%M:%S %Z'
     fi
 done
 echo 'DIRECTOR: No run.sh file found -- if it exists, make sure it is set as executable'
+echo none > "$PID_FILE"
 exec sleep infinity
@@ -0,0 +1,31 @@
+"""Registers the orchestrator with the Manager by periodically sending heartbeats."""
+
+import asyncio
+import logging
+
+import requests
+
+from orchestrator import settings
+
+logger = logging.getLogger(__name__)
+
+
+def send_heartbeat() -> None:
+    """Tells the Manager that this appserver is alive."""
+    response = requests.post(
+        f"{settings.MANAGER_URL}/appservers/heartbeat",
+        json={"host": settings.ADVERTISED_HOST},
+        headers={"Authorization": f"Bearer {settings.HEARTBEAT_TOKEN}"},
+        timeout=5,
+    )
+    response.raise_for_status()
+
+
+async def send_heartbeats() -> None:
+    """Sends a heartbeat to the Manager every ``HEARTBEAT_INTERVAL`` seconds, forever."""
+    while True:
+        try:
+            await asyncio.to_thread(send_heartbeat)
+        except requests.RequestException:
+            logger.warning("Failed to send a heartbeat to the Manager", exc_info=True)
+        await asyncio.sleep(settings.HEARTBEAT_INTERVAL)
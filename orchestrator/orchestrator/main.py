@@ -1,13 +1,41 @@
+import asyncio
+import contextlib
 import traceback
+from collections.abc import AsyncIterator
 
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
+from . import heartbeat, settings, status
+from .api.docker import cache, client, services
 from .api.router import main_router
 
+
+@contextlib.asynccontextmanager
+async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
+    """Runs the background tasks of the orchestrator, and cleans up after them."""
+    background_tasks = [
+        asyncio.create_task(cache.prune_periodically()),
+        asyncio.create_task(services.follow_service_events()),
+        asyncio.create_task(services.resync_periodically()),
+    ]
+    if settings.MANAGER_URL is not None:
+        background_tasks.append(asyncio.create_task(heartbeat.send_heartbeats()))
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    services.service_index.stop()
+    client.service_calls.shutdown()
+    client.image_calls.shutdown()
+    client.docker_client.close()
+
+
 app = FastAPI(
     name="orchestrator",
     contact={"name": "Sysadmins", "email": "director@tjhsst.edu"},
+    lifespan=lifespan,
 )
 
 
@@ -17,6 +45,7 @@ async def root(message: str = "pong"):
     return {"message": message}
 
 
+app.include_router(status.router, prefix="/status", tags=["status"])
 app.include_router(main_router, prefix="/api")
 
 
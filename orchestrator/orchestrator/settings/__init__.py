@@ -9,7 +9,10 @@ Usage:
         True
 """
 
+import math
 import os
+import socket
+import tempfile
 from pathlib import Path
 
 DEBUG = True
@@ -41,3 +44,98 @@ else:
 # Docker service configuration
 TMP_TMPFS_SIZE = 10 * 1000 * 1000  # 10 MB
 RUN_TMPFS_SIZE = 10 * 1000 * 100  # 10 MB
+
+# Blocking Docker calls made by the API run on separate thread pools, so slow calls
+# of one kind can't hold up the others (see orchestrator.api.docker.client).
+DOCKER_SERVICE_WORKERS = int(os.environ.get("DIRECTOR_DOCKER_SERVICE_WORKERS", "8"))
+DOCKER_IMAGE_WORKERS = int(os.environ.get("DIRECTOR_DOCKER_IMAGE_WORKERS", "4"))
+
+# Site containers are checked every SERVICE_HEALTH_INTERVAL seconds, and are unhealthy
+# after SERVICE_HEALTH_RETRIES failed checks (not counting the first
+# SERVICE_HEALTH_START_PERIOD seconds). Updates replace a container once the new one
+# is healthy, rolling back if it isn't; the orchestrator waits up to
+# SERVICE_ROLLOUT_TIMEOUT seconds for that to report how long the site took to start.
+SERVICE_HEALTH_INTERVAL = 5  # seconds
+SERVICE_HEALTH_TIMEOUT = 3  # seconds
+SERVICE_HEALTH_RETRIES = 3
+SERVICE_HEALTH_START_PERIOD = 60  # seconds
+SERVICE_ROLLOUT_TIMEOUT = 120  # seconds
+SERVICE_ROLLOUT_POLL_INTERVAL = 0.5  # seconds
+
+# The most services of a batch (see /api/docker/service/update-many) updated at once,
+# so batches leave room on the service executor for other requests
+SERVICE_BATCH_CONCURRENCY = int(os.environ.get("DIRECTOR_SERVICE_BATCH_CONCURRENCY", "4"))
+
+# Services are looked up in an index kept current by the Docker event stream. It is
+# rebuilt every SERVICE_INDEX_RESYNC_INTERVAL seconds in case events were missed, and
+# the event stream is reopened SERVICE_INDEX_RETRY_DELAY seconds after it breaks.
+SERVICE_INDEX_RESYNC_INTERVAL = 10 * 60
+SERVICE_INDEX_RETRY_DELAY = 5
+
+# Image builds share a node-wide budget, so they can't starve the sites served from
+# this node. Builds that don't fit in the budget wait for up to BUILD_ADMISSION_TIMEOUT
+# seconds, and are then rejected with a 429 that asks the Manager to retry after
+# BUILD_RETRY_AFTER seconds. Builds are also rejected right away once
+# BUILD_MAX_CONCURRENT + BUILD_MAX_QUEUED of them haven't finished.
+BUILD_MAX_CONCURRENT = int(os.environ.get("DIRECTOR_BUILD_MAX_CONCURRENT", "2"))
+BUILD_CPU_BUDGET = float(os.environ.get("DIRECTOR_BUILD_CPU_BUDGET", (os.cpu_count() or 2) / 2))
+# The cores builds run on (comma separated), which defaults to the last BUILD_CPU_BUDGET
+# cores (rounded up). Each build is pinned to as many of them as the CPUs it reserved
+# (rounded up), so builds can't use every core of the node, alone or together.
+_CPU_COUNT = os.cpu_count() or 2
+BUILD_CPUS = [
+    int(cpu)
+    for cpu in os.environ.get(
+        "DIRECTOR_BUILD_CPUS",
+        ",".join(map(str, range(max(0, _CPU_COUNT - math.ceil(BUILD_CPU_BUDGET)), _CPU_COUNT))),
+    ).split(",")
+    if cpu
+]
+# 2 GB
+BUILD_MEMORY_BUDGET = int(os.environ.get("DIRECTOR_BUILD_MEMORY_BUDGET", "2000000000"))
+BUILD_MAX_QUEUED = 8
+BUILD_ADMISSION_TIMEOUT = 30  # seconds
+BUILD_RETRY_AFTER = 30  # seconds
+# The limits of a build, if the Manager doesn't send any
+BUILD_DEFAULT_CPUS = 1.0
+BUILD_DEFAULT_MEMORY = 1000 * 1000 * 1000  # 1 GB
+# Builds run in the background, and their logs are kept in BUILD_LOG_DIR
+# until BUILD_JOB_TTL seconds after they finish.
+BUILD_LOG_DIR = Path(tempfile.gettempdir()) / "director-builds"
+BUILD_JOB_TTL = 60 * 60
+# How often the log of a running build is checked for new output while it's streamed
+BUILD_LOG_POLL_INTERVAL = 0.25  # seconds
+BUILD_LOG_CHUNK_SIZE = 64 * 1024
+# Builds are cancelled if they take longer than BUILD_TIMEOUT seconds, or go
+# BUILD_IDLE_TIMEOUT seconds without any output (e.g. a step is waiting for input).
+BUILD_TIMEOUT = 30 * 60
+BUILD_IDLE_TIMEOUT = 10 * 60
+# Where the digests of the files in each site's build context are cached, so
+# unchanged sites can skip building their images.
+BUILD_INDEX_DIR = SITES_DIR.parent / "build-index"
+# Layers cached by previous builds are kept within BUILD_CACHE_BUDGET bytes, evicting
+# the least recently used first. BUILD_CACHE_INDEX records when each was last used.
+BUILD_CACHE_BUDGET = int(os.environ.get("DIRECTOR_BUILD_CACHE_BUDGET", "10000000000"))  # 10 GB
+BUILD_CACHE_INDEX = SITES_DIR.parent / "build-cache.json"
+BUILD_CACHE_PRUNE_INTERVAL = 60 * 60  # seconds
+# A caching proxy for package indexes shared by the builds on this node (see
+# dev/docker/package-cache). It must be reachable from build containers, e.g.
+# through the address of the docker0 bridge.
+BUILD_PACKAGE_CACHE_URL = os.environ.get("DIRECTOR_BUILD_PACKAGE_CACHE_URL")
+# The relative CPU weight of builds (site containers have 1024), so the sites
+# served from this node stay responsive during builds
+BUILD_CPU_SHARES = 512
+
+# The connections kept open to the Docker daemon, enough for every thread that
+# makes Docker calls (plus the background tasks)
+DOCKER_MAX_POOL_SIZE = (
+    DOCKER_SERVICE_WORKERS + DOCKER_IMAGE_WORKERS + BUILD_MAX_CONCURRENT + BUILD_MAX_QUEUED + 2
+)
+
+# Dynamic registration with the Manager. If MANAGER_URL is unset,
+# the Manager must list this appserver in DIRECTOR_APPSERVER_HOSTS instead.
+MANAGER_URL = os.environ.get("DIRECTOR_MANAGER_URL")
+HEARTBEAT_TOKEN = os.environ.get("DIRECTOR_HEARTBEAT_TOKEN", "")
+# The host:port the Manager should use to reach this appserver
+ADVERTISED_HOST = os.environ.get("DIRECTOR_ADVERTISED_HOST", f"{socket.gethostname()}:8080")
+HEARTBEAT_INTERVAL = 20  # seconds
@@ -0,0 +1,74 @@
+"""Reports how busy the appserver is, so the Manager can spread work between appservers."""
+
+import contextlib
+import os
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+
+from fastapi import APIRouter
+from pydantic import BaseModel
+
+router = APIRouter()
+
+
+class Counter:
+    """A thread-safe counter of running tasks."""
+
+    def __init__(self) -> None:
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    @contextlib.contextmanager
+    def track(self) -> Iterator[None]:
+        """Counts the task as running for the duration of the with statement."""
+        with self._lock:
+            self._value += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._value -= 1
+
+
+running_builds = Counter()
+"""The number of Docker images currently being built."""
+
+
+class Load(BaseModel):
+    running_builds: int
+    """The number of Docker images currently being built."""
+
+    cpu: float
+    """The 1-minute load average, divided by the number of CPUs."""
+
+    memory: float
+    """The fraction of memory in use (from 0 to 1)."""
+
+
+def memory_usage(meminfo: Path = Path("/proc/meminfo")) -> float:
+    """Returns the fraction of memory that is unavailable for new processes.
+
+    Returns 0 if the memory usage cannot be determined.
+    """
+    try:
+        fields = dict(line.split(":", maxsplit=1) for line in meminfo.read_text().splitlines())
+        total = int(fields["MemTotal"].split()[0])
+        available = int(fields["MemAvailable"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return 0.0
+    return 1 - available / total
+
+
+@router.get("/load")
+async def load() -> Load:
+    """Report how busy this appserver is."""
+    return Load(
+        running_builds=running_builds.value,
+        cpu=os.getloadavg()[0] / (os.cpu_count() or 1),
+        memory=memory_usage(),
+    )
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from orchestrator.api.docker.admission import BuildAdmission, BuildRejectedError
+
+
+def test_builds_within_budget_are_admitted() -> None:
+    admission = BuildAdmission(max_concurrent=2, cpus=2, memory=2000, max_queued=1)
+    with admission.admit(1, 1000, timeout=0), admission.admit(1, 1000, timeout=0):
+        assert admission.running == 2
+    assert admission.running == 0
+
+
+@pytest.mark.parametrize(
+    ("max_concurrent", "cpus", "memory"),
+    ((1, 1, 1000), (2, 2, 100), (2, 0.5, 2000)),
+    ids=["concurrency", "cpus", "memory"],
+)
+def test_builds_over_budget_are_rejected(max_concurrent: int, cpus: float, memory: int) -> None:
+    admission = BuildAdmission(max_concurrent=max_concurrent, cpus=2, memory=2000, max_queued=1)
+    with admission.admit(1, 1000, timeout=0), pytest.raises(BuildRejectedError):
+        with admission.admit(cpus, memory, timeout=0):
+            pass
+    assert admission.running == 0
+
+
+def test_large_build_runs_on_idle_node() -> None:
+    admission = BuildAdmission(max_concurrent=1, cpus=1, memory=1000, max_queued=1)
+    with admission.admit(4, 8000, timeout=0):
+        assert admission.running == 1
+
+
+def test_queued_build_starts_when_resources_free_up() -> None:
+    admission = BuildAdmission(max_concurrent=1, cpus=1, memory=1000, max_queued=1)
+    admitted = threading.Event()
+
+    def build() -> None:
+        with admission.admit(1, 1000, timeout=5):
+            admitted.set()
+
+    with admission.admit(1, 1000, timeout=0):
+        thread = threading.Thread(target=build)
+        thread.start()
+        assert not admitted.wait(0.1)
+        assert admission.queued == 1
+
+        # the queue is full
+        with pytest.raises(BuildRejectedError), admission.admit(1, 1000, timeout=0):
+            pass
+
+    thread.join()
+    assert admitted.is_set()
+
+
+def test_builds_are_pinned_to_the_least_reserved_cores() -> None:
+    admission = BuildAdmission(max_concurrent=3, cpus=4, memory=3000, max_queued=1, cores=[4, 5, 6])
+    with admission.admit(2, 1000, timeout=0) as first:
+        assert first == "4,5"
+        with admission.admit(0.5, 1000, timeout=0) as second:
+            assert second == "6"
+            with admission.admit(1.5, 1000, timeout=0) as third:
+                # shares the cores that are reserved the least
+                assert third == "4,6"
+    with admission.admit(1, 1000, timeout=0) as cpuset:
+        assert cpuset == "4"
+
+
+def test_builds_are_not_pinned_without_cores() -> None:
+    admission = BuildAdmission(max_concurrent=1, cpus=1, memory=1000, max_queued=1)
+    with admission.admit(1, 1000, timeout=0) as cpuset:
+        assert cpuset == ""
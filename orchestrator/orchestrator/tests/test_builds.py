@@ -0,0 +1,334 @@
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+import urllib3
+import urllib3.exceptions
+from fastapi.testclient import TestClient
+
+from orchestrator import settings
+from orchestrator.api.docker import builds
+from orchestrator.api.docker.admission import BuildRejectedError
+from orchestrator.api.docker.client import docker_client
+from orchestrator.api.docker.schema import BuildLimits, DockerInfo, SiteInfo
+
+
+@pytest.fixture(autouse=True)
+def build_dirs(monkeypatch, tmp_path: Path) -> None:
+    monkeypatch.setattr(settings, "BUILD_LOG_DIR", tmp_path / "logs")
+    monkeypatch.setattr(settings, "BUILD_INDEX_DIR", tmp_path / "index")
+    monkeypatch.setattr(settings, "SITES_DIR", tmp_path / "sites")
+    monkeypatch.setattr(settings, "BUILD_CACHE_INDEX", tmp_path / "build-cache.json")
+
+
+def mock_docker(monkeypatch, chunks: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Mocks the Docker client, returning the arguments of each build."""
+    calls: list[dict[str, Any]] = []
+    labels: dict[str, str] = {}
+
+    def build(**kwargs: Any) -> Iterator[dict[str, Any]]:
+        calls.append(kwargs)
+        yield from chunks
+        labels.update(kwargs["labels"])
+
+    def get_image(_name: str) -> SimpleNamespace:
+        if not labels:
+            raise builds.docker.errors.ImageNotFound("No such image")
+        return SimpleNamespace(labels=labels)
+
+    client = SimpleNamespace(
+        api=SimpleNamespace(build=build), images=SimpleNamespace(get=get_image)
+    )
+    monkeypatch.setattr(docker_client, "get", lambda: client)
+    return calls
+
+
+def submit(client: TestClient, site_info: SiteInfo, *, force: bool = False) -> str:
+    response = client.post(
+        "/api/docker/image/builds",
+        json={
+            "site": site_info.model_dump(),
+            "build_limits": {"cpus": 1, "memory": "1MiB"},
+            "force": force,
+        },
+    )
+    assert response.status_code == 202
+    return response.json()["id"]
+
+
+def test_build_log_is_streamed(monkeypatch, client: TestClient, site_info: SiteInfo) -> None:
+    mock_docker(
+        monkeypatch,
+        [
+            {"stream": "Step 1/2 : FROM alpine\n"},
+            {"aux": {}},
+            {"stream": "Step 2/2 : RUN true\n ---> Using cache\n ---> 0123456789ab\n"},
+        ],
+    )
+    job_id = submit(client, site_info)
+
+    response = client.get(f"/api/docker/image/builds/{job_id}/log")
+    sending, log = response.text.split("\n", 1)
+    assert sending.startswith("Sending build context to Docker daemon")
+    assert log.startswith("Step 1/2 : FROM alpine\nStep 2/2 : RUN true\n")
+    # resuming from an offset
+    offset = len(response.content) - len(b" ---> 0123456789ab\n")
+    response = client.get(f"/api/docker/image/builds/{job_id}/log", params={"start": offset})
+    assert response.text == " ---> 0123456789ab\n"
+
+    job = client.get(f"/api/docker/image/builds/{job_id}").json()
+    assert job["state"] == "succeeded"
+    assert job["context_size"] > 0
+    assert job["context_upload_seconds"] is not None
+    assert job["cache_hit_ratio"] == 1
+
+
+def test_build_error(monkeypatch, client: TestClient, site_info: SiteInfo) -> None:
+    mock_docker(monkeypatch, [{"stream": "Step 1/2\n"}, {"error": "RUN exited with 1"}])
+    job_id = submit(client, site_info)
+
+    client.get(f"/api/docker/image/builds/{job_id}/log")
+    job = client.get(f"/api/docker/image/builds/{job_id}").json()
+    assert job["state"] == "failed"
+    assert job["error"]["user_error"]
+    assert job["error"]["explanation"] == "RUN exited with 1"
+
+
+def test_unchanged_build_is_skipped(monkeypatch, client: TestClient, site_info: SiteInfo) -> None:
+    calls = mock_docker(monkeypatch, [{"stream": "Step 1/1\n"}])
+    site_dir = site_info.directory_path()
+    (site_dir / "Dockerfile").write_text("FROM python:3.12-alpine\nCOPY app/ /app/\n")
+    (site_dir / "app").mkdir()
+    (site_dir / "app" / "main.py").write_text("print('hello')")
+
+    def build(*, force: bool = False) -> dict[str, Any]:
+        job_id = submit(client, site_info, force=force)
+        client.get(f"/api/docker/image/builds/{job_id}/log")
+        return client.get(f"/api/docker/image/builds/{job_id}").json()
+
+    assert not build()["up_to_date"]
+    # files that aren't copied into the image don't matter
+    (site_dir / "notes.txt").write_text("notes")
+    job = build()
+    assert job["state"] == "succeeded"
+    assert job["up_to_date"]
+    assert len(calls) == 1
+
+    (site_dir / "app" / "main.py").write_text("print('goodbye')")
+    assert not build()["up_to_date"]
+    assert not build(force=True)["up_to_date"]
+    assert [call["pull"] for call in calls] == [False, False, True]
+
+
+def test_backlog_is_bounded(monkeypatch, site_info: SiteInfo) -> None:
+    monkeypatch.setattr(settings, "BUILD_MAX_CONCURRENT", 1)
+    monkeypatch.setattr(settings, "BUILD_MAX_QUEUED", 1)
+    jobs = builds.BuildJobs()
+    # the jobs never get a thread to run on
+    monkeypatch.setattr(jobs, "_executor", SimpleNamespace(submit=lambda _fn: None))
+
+    limits = BuildLimits()
+    jobs.submit(site_info, limits)
+    jobs.submit(site_info.model_copy(update={"pk": 1}), limits)
+    with pytest.raises(BuildRejectedError):
+        jobs.submit(site_info.model_copy(update={"pk": 2}), limits)
+
+
+def test_unknown_build(client: TestClient) -> None:
+    assert client.get("/api/docker/image/builds/missing").status_code == 404
+
+
+def test_template_site_is_built_from_base_image(
+    monkeypatch, client: TestClient, site_info: SiteInfo
+) -> None:
+    mock_docker(monkeypatch, [])
+    dockerfile = site_info.directory_path() / "Dockerfile"
+
+    def build(base: str) -> None:
+        site_info.docker = DockerInfo(base=base)
+        job_id = submit(client, site_info)
+        client.get(f"/api/docker/image/builds/{job_id}/log")
+
+    build("director/django:5.1")
+    assert dockerfile.read_text() == (
+        builds.GENERATED_DOCKERFILE_HEADER + "FROM director/django:5.1\n"
+    )
+    # the generated Dockerfile follows the template
+    build("director/django:5.2")
+    assert dockerfile.read_text().endswith("FROM director/django:5.2\n")
+    # but customized Dockerfiles are left alone
+    dockerfile.write_text("FROM director/django:5.2\nRUN pip install celery\n")
+    build("director/node:22")
+    assert dockerfile.read_text() == "FROM director/django:5.2\nRUN pip install celery\n"
+
+
+def test_pull_image(monkeypatch, client: TestClient) -> None:
+    pulled: list[tuple[str, str]] = []
+    images = SimpleNamespace(pull=lambda repository, tag: pulled.append((repository, tag)))
+    monkeypatch.setattr(docker_client, "get", lambda: SimpleNamespace(images=images))
+
+    for image in ("registry.example.com:5000/director/node:22", "alpine"):
+        response = client.post("/api/docker/image/pull", json={"image": image})
+        assert response.status_code == 200
+    assert pulled == [("registry.example.com:5000/director/node", "22"), ("alpine", "latest")]
+
+
+class HangingBuild:
+    """A build whose last step hangs until its container is killed."""
+
+    def __init__(self, monkeypatch, *, error: Exception | None = None) -> None:
+        self.killed: list[str] = []
+        self.removed: list[str] = []
+        self._killed = threading.Event()
+        self._error = error
+        client = SimpleNamespace(
+            api=SimpleNamespace(build=self.build, kill=self.kill, remove_image=self.removed.append),
+            images=SimpleNamespace(get=self.get_image),
+        )
+        monkeypatch.setattr(docker_client, "get", lambda: client)
+
+    def build(self, **_kwargs: Any) -> Iterator[dict[str, Any]]:
+        yield {"stream": "Step 1/3 : FROM alpine\n ---> 0123456789ab\n"}
+        yield {"stream": "Step 2/3 : RUN apk add git\n ---> Running in aaaaaaaaaaaa\n"}
+        yield {"stream": " ---> 111111111111\n"}
+        yield {"stream": "Step 3/3 : RUN read line\n ---> Running in bbbbbbbbbbbb\n"}
+        if self._error is not None:
+            raise self._error
+        assert self._killed.wait(5)
+        yield {"error": "The command '/bin/sh -c read line' returned a non-zero code: 137"}
+
+    def kill(self, container: str) -> None:
+        self.killed.append(container)
+        self._killed.set()
+
+    @staticmethod
+    def get_image(_name: str) -> None:
+        raise builds.docker.errors.ImageNotFound("No such image")
+
+
+def wait_for_job(client: TestClient, job_id: str) -> dict[str, Any]:
+    client.get(f"/api/docker/image/builds/{job_id}/log")
+    return client.get(f"/api/docker/image/builds/{job_id}").json()
+
+
+def test_cancel_build(monkeypatch, client: TestClient, site_info: SiteInfo) -> None:
+    build = HangingBuild(monkeypatch)
+    job_id = submit(client, site_info)
+    job = builds.build_jobs.get(job_id)
+    assert job is not None
+    # wait for the last step to start
+    for _ in range(500):
+        if job._container == "bbbbbbbbbbbb":
+            break
+        threading.Event().wait(0.01)
+
+    response = client.post(f"/api/docker/image/builds/{job_id}/cancel")
+    assert response.status_code == 200
+
+    job_info = wait_for_job(client, job_id)
+    assert job_info["state"] == "cancelled"
+    assert job_info["error"]["explanation"] == "The build was cancelled"
+    assert build.killed == ["bbbbbbbbbbbb"]
+    # the layers it created are removed, but not the base image
+    assert build.removed == ["111111111111"]
+
+
+def test_build_timeout(monkeypatch, client: TestClient, site_info: SiteInfo) -> None:
+    monkeypatch.setattr(settings, "BUILD_TIMEOUT", 0.1)
+    build = HangingBuild(monkeypatch)
+
+    job_info = wait_for_job(client, submit(client, site_info))
+    assert job_info["state"] == "cancelled"
+    assert "longer than" in job_info["error"]["explanation"]
+    assert build.killed == ["bbbbbbbbbbbb"]
+
+
+def test_build_idle_timeout(monkeypatch, client: TestClient, site_info: SiteInfo) -> None:
+    pool = urllib3.HTTPConnectionPool("localhost")
+    error = urllib3.exceptions.ReadTimeoutError(pool, "/build", "Read timed out.")
+    build = HangingBuild(monkeypatch, error=error)
+
+    job_info = wait_for_job(client, submit(client, site_info))
+    assert job_info["state"] == "cancelled"
+    assert "no output" in job_info["error"]["explanation"]
+    assert build.killed == ["bbbbbbbbbbbb"]
+
+
+def test_identical_builds_are_deduplicated(
+    monkeypatch, client: TestClient, site_info: SiteInfo
+) -> None:
+    build = HangingBuild(monkeypatch)
+    calls: list[dict[str, Any]] = []
+    hanging = build.build
+
+    def record(**kwargs: Any) -> Iterator[dict[str, Any]]:
+        calls.append(kwargs)
+        return hanging(**kwargs)
+
+    docker_client.get().api.build = record
+    job_id = submit(client, site_info)
+    # a retry attaches to the build in progress
+    assert submit(client, site_info) == job_id
+    # but a forced build also pulls the base image
+    forced_id = submit(client, site_info, force=True)
+    assert forced_id != job_id
+
+    # the step is killed, so the builds fail
+    build.kill("bbbbbbbbbbbb")
+    assert wait_for_job(client, job_id)["state"] == "failed"
+    assert wait_for_job(client, forced_id)["state"] == "failed"
+    assert [call["pull"] for call in calls] == [False, True]
+
+
+def test_attached_builds_are_cancelled_by_the_last_waiter(
+    monkeypatch, client: TestClient, site_info: SiteInfo
+) -> None:
+    build = HangingBuild(monkeypatch)
+    job_id = submit(client, site_info)
+    assert submit(client, site_info) == job_id
+
+    # the other submission still needs it
+    response = client.post(f"/api/docker/image/builds/{job_id}/cancel")
+    assert response.json()["state"] in ("queued", "running")
+    assert not build.killed
+
+    client.post(f"/api/docker/image/builds/{job_id}/cancel")
+    assert wait_for_job(client, job_id)["state"] == "cancelled"
+    # a cancelled build isn't attached to
+    assert submit(client, site_info) != job_id
+
+
+def test_builds_of_a_site_run_one_at_a_time(
+    monkeypatch, client: TestClient, site_info: SiteInfo
+) -> None:
+    started = threading.Event()
+    finish = threading.Event()
+    running = []
+
+    def build(**_kwargs: Any) -> Iterator[dict[str, Any]]:
+        running.append(True)
+        assert len(running) == 1
+        started.set()
+        assert finish.wait(5)
+        yield {"stream": "Step 1/1 : RUN true\n"}
+        running.pop()
+
+    client_mock = SimpleNamespace(
+        api=SimpleNamespace(build=build),
+        images=SimpleNamespace(get=HangingBuild.get_image),
+    )
+    monkeypatch.setattr(docker_client, "get", lambda: client_mock)
+
+    first_id = submit(client, site_info)
+    assert started.wait(5)
+    (site_info.directory_path() / "Dockerfile").write_text("FROM alpine\n")
+    second_id = submit(client, site_info)
+    assert second_id != first_id
+    assert client.get(f"/api/docker/image/builds/{second_id}").json()["state"] == "queued"
+
+    finish.set()
+    assert wait_for_job(client, first_id)["state"] == "succeeded"
+    assert wait_for_job(client, second_id)["state"] == "succeeded"
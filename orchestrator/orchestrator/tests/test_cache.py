@@ -0,0 +1,114 @@
+import json
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+from orchestrator import settings
+from orchestrator.api.docker import cache
+from orchestrator.api.docker.client import docker_client
+
+MB = 1000 * 1000
+
+
+@pytest.fixture(autouse=True)
+def cache_index(monkeypatch, tmp_path: Path) -> Path:
+    index = tmp_path / "build-cache.json"
+    monkeypatch.setattr(settings, "BUILD_CACHE_INDEX", index)
+    return index
+
+
+def test_build_cache_stats() -> None:
+    stats = cache.BuildCacheStats()
+    for line in (
+        "Step 1/3 : FROM alpine",
+        " ---> 0123456789ab",
+        "Step 2/3 : RUN apk add git",
+        " ---> Using cache",
+        " ---> 123456789abc",
+        "Step 3/3 : COPY . /site",
+        " ---> Running in 23456789abcd",
+        " ---> 3456789abcde",
+    ):
+        stats.observe(line)
+    assert stats.steps == 2
+    assert stats.hit_ratio == 0.5
+    assert stats.layers == ["0123456789ab", "123456789abc", "3456789abcde"]
+
+
+def image(
+    image_id: str,
+    size: int,
+    *,
+    parent: str = "",
+    created: int = 0,
+    tags: list[str] | None = None,
+) -> dict[str, Any]:
+    return {
+        "Id": f"sha256:{image_id * 12}",
+        "ParentId": f"sha256:{parent * 12}" if parent else "",
+        "Size": size * MB,
+        "Created": created,
+        "RepoTags": tags,
+    }
+
+
+def mock_docker(monkeypatch, images: list[dict[str, Any]]) -> list[str]:
+    removed: list[str] = []
+
+    def remove_image(image_id: str) -> None:
+        removed.append(image_id.removeprefix("sha256:")[0])
+        images[:] = [image for image in images if image["Id"] != image_id]
+
+    client = SimpleNamespace(
+        api=SimpleNamespace(images=lambda **_kwargs: images, remove_image=remove_image)
+    )
+    monkeypatch.setattr(docker_client, "get", lambda: client)
+    return removed
+
+
+def test_prune_evicts_least_recently_used_leaves(monkeypatch, cache_index: Path) -> None:
+    removed = mock_docker(
+        monkeypatch,
+        [
+            image("a", 100, tags=["python:3.12"]),
+            # a chain of cached layers on top of the base image
+            image("b", 110, parent="a", created=1),
+            image("c", 130, parent="b", created=2),
+            # a site image, and an old version of it
+            image("d", 150, parent="a", tags=["site_0001:latest"]),
+            image("e", 140, parent="a", created=3),
+        ],
+    )
+    cache.build_cache.record_use(["c" * 12])
+
+    result = cache.build_cache.prune(budget=35 * MB)
+    # e is the least recently used leaf, then b is used before c, but c must go first
+    assert removed == ["e"]
+    assert result.bytes_reclaimed == 40 * MB
+    assert result.cache_size == 30 * MB
+
+    result = cache.build_cache.prune(budget=0)
+    assert removed == ["e", "c", "b"]
+    assert result.cache_size == 0
+    assert json.loads(cache_index.read_text()) == {}
+
+
+def test_prune_keeps_layers_of_tagged_images(monkeypatch) -> None:
+    removed = mock_docker(
+        monkeypatch,
+        [
+            image("a", 100, tags=["python:3.12"]),
+            # a site image is built on top of a cached layer
+            image("b", 110, parent="a", created=1),
+            image("c", 130, parent="b", tags=["site_0001:latest"]),
+            image("d", 120, parent="a", created=2),
+        ],
+    )
+
+    result = cache.build_cache.prune(budget=0)
+    assert removed == ["d"]
+    # b isn't part of the cache, since it can't be evicted
+    assert result.bytes_reclaimed == 20 * MB
+    assert result.cache_size == 0
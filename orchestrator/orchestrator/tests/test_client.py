@@ -0,0 +1,33 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from orchestrator.api.docker import client
+
+
+def test_client_is_shared(monkeypatch) -> None:
+    created: list[SimpleNamespace] = []
+    closed: list[SimpleNamespace] = []
+
+    def from_env(**_kwargs) -> SimpleNamespace:
+        mock = SimpleNamespace()
+        mock.close = lambda: closed.append(mock)
+        created.append(mock)
+        return mock
+
+    monkeypatch.setattr(client.docker, "from_env", from_env)
+    shared = client.SharedClient()
+    assert shared.get() is shared.get()
+    assert len(created) == 1
+
+    shared.close()
+    assert closed == created
+    # a new client is created once the old one is closed
+    assert shared.get() is not created[0]
+
+
+def test_executor_runs_calls_on_its_threads() -> None:
+    executor = client.DockerExecutor("test", 1)
+    name = asyncio.run(executor.run(lambda: threading.current_thread().name))
+    assert name.startswith("docker-test")
+    executor.shutdown()
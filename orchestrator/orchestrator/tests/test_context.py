@@ -0,0 +1,131 @@
+import os
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from orchestrator.api.docker import context
+
+DOCKERFILE = """\
+FROM python:3.12-alpine
+COPY --chown=1000:1000 requirements.txt /site/
+RUN pip install -r /site/requirements.txt
+COPY --from=builder /build /build
+ADD ["app", \\
+     "/site/app"]
+"""
+
+
+@pytest.fixture
+def site_dir(tmp_path: Path) -> Path:
+    site_dir = tmp_path / "site"
+    (site_dir / "app").mkdir(parents=True)
+    (site_dir / "Dockerfile").write_text(DOCKERFILE)
+    (site_dir / "requirements.txt").write_text("django\n")
+    (site_dir / "app" / "main.py").write_text("print('hello')\n")
+    (site_dir / "app" / "main.pyc").write_bytes(b"\0")
+    (site_dir / ".dockerignore").write_text("# compiled files\n**/*.pyc\n")
+    (site_dir / "notes.txt").write_text("notes\n")
+    return site_dir
+
+
+def build_hash(site_dir: Path) -> str:
+    return context.build_hash(
+        site_dir, site_dir / "Dockerfile", site_dir.parent / "index" / "site.json"
+    )
+
+
+def test_copied_sources() -> None:
+    assert context.copied_sources(DOCKERFILE) == ["requirements.txt", "app"]
+    assert context.copied_sources("COPY a b /dest/\nADD https://example.com/x /x") == [
+        "a",
+        "b",
+        "https://example.com/x",
+    ]
+
+
+def test_hash_is_stable(site_dir: Path) -> None:
+    assert build_hash(site_dir) == build_hash(site_dir)
+
+
+@pytest.mark.parametrize(
+    ("path", "changed"),
+    (
+        ("Dockerfile", True),
+        ("requirements.txt", True),
+        ("app/main.py", True),
+        ("app/new.py", True),
+        ("app/main.pyc", False),
+        ("notes.txt", False),
+    ),
+)
+def test_hash_changes_with_copied_files(site_dir: Path, path: str, *, changed: bool) -> None:
+    before = build_hash(site_dir)
+    with (site_dir / path).open("a") as f:
+        f.write("# changed\n")
+    assert (build_hash(site_dir) != before) == changed
+
+
+def test_index_is_reused(site_dir: Path, monkeypatch) -> None:
+    before = build_hash(site_dir)
+
+    hashed: list[Path] = []
+    file_digest = context._file_digest
+
+    def record_digest(path: Path) -> str:
+        hashed.append(path)
+        return file_digest(path)
+
+    monkeypatch.setattr(context, "_file_digest", record_digest)
+    assert build_hash(site_dir) == before
+    assert hashed == []
+
+    # touching a file causes it to be hashed again, but the hash doesn't change
+    os.utime(site_dir / "requirements.txt", ns=(0, 0))
+    assert build_hash(site_dir) == before
+    assert hashed == [site_dir / "requirements.txt"]
+
+
+def test_context_only_has_copied_files(site_dir: Path) -> None:
+    with tempfile.TemporaryFile() as archive:
+        size = context.create_context(site_dir, site_dir / "Dockerfile", archive)
+        assert size > 0
+        with tarfile.open(fileobj=archive) as tar:
+            names = tar.getnames()
+    assert names == ["Dockerfile", "app", "app/main.py", "requirements.txt"]
+
+
+def test_context_with_replaced_dockerfile(site_dir: Path) -> None:
+    with tempfile.TemporaryFile() as archive:
+        context.create_context(
+            site_dir, site_dir / "Dockerfile", archive, dockerfile="FROM alpine\n"
+        )
+        with tarfile.open(fileobj=archive) as tar:
+            dockerfile = tar.extractfile("Dockerfile")
+            assert dockerfile is not None
+            assert dockerfile.read() == b"FROM alpine\n"
+
+
+def test_default_dockerignore(tmp_path: Path) -> None:
+    (tmp_path / "Dockerfile").write_text("FROM alpine\nCOPY . /site/\n")
+    for directory in (".home", "public", "node_modules", "src/__pycache__"):
+        (tmp_path / directory).mkdir(parents=True)
+        (tmp_path / directory / "file").write_text("")
+    (tmp_path / "src" / "main.py").write_text("")
+
+    assert context.context_files(tmp_path, tmp_path / "Dockerfile") == [
+        "Dockerfile",
+        "src",
+        "src/main.py",
+    ]
+
+
+def test_index_is_replaced_atomically(site_dir: Path) -> None:
+    index_path = site_dir.parent / "index" / "site.json"
+    # concurrent builds of a site see a whole index, or none
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        hashes = set(pool.map(lambda _: build_hash(site_dir), range(20)))
+    assert len(hashes) == 1
+    assert list(index_path.parent.iterdir()) == [index_path]
@@ -5,3 +5,12 @@ def test_ping(client: TestClient) -> None:
     response = client.get("/ping")
     assert response.status_code == 200
     assert response.json() == {"message": "pong"}
+
+
+def test_load(client: TestClient) -> None:
+    response = client.get("/status/load")
+    assert response.status_code == 200
+    load = response.json()
+    assert load["running_builds"] == 0
+    assert load["cpu"] >= 0
+    assert 0 <= load["memory"] <= 1
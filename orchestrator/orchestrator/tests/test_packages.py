@@ -0,0 +1,23 @@
+from orchestrator import settings
+from orchestrator.api.docker import packages
+
+
+def test_no_build_args_without_cache(monkeypatch) -> None:
+    monkeypatch.setattr(settings, "BUILD_PACKAGE_CACHE_URL", None)
+    assert packages.build_args() == {}
+
+
+def test_build_args(monkeypatch) -> None:
+    monkeypatch.setattr(settings, "BUILD_PACKAGE_CACHE_URL", "http://172.17.0.1:3141/")
+    args = packages.build_args()
+    assert args["PIP_INDEX_URL"] == "http://172.17.0.1:3141/pypi/simple/"
+    assert args["PIP_TRUSTED_HOST"] == "172.17.0.1"
+    assert args["NPM_CONFIG_REGISTRY"] == "http://172.17.0.1:3141/npm/"
+
+
+def test_build_args_are_declared_in_every_stage() -> None:
+    dockerfile = "FROM node:22 AS assets\nRUN npm ci\n\nfrom python:3.12\nRUN pip install django\n"
+    assert packages.declare_build_args(dockerfile, ["PIP_INDEX_URL", "NPM_CONFIG_REGISTRY"]) == (
+        "FROM node:22 AS assets\nARG PIP_INDEX_URL\nARG NPM_CONFIG_REGISTRY\nRUN npm ci\n\n"
+        "from python:3.12\nARG PIP_INDEX_URL\nARG NPM_CONFIG_REGISTRY\nRUN pip install django\n"
+    )
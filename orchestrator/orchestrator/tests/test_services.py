@@ -1,5 +1,20 @@
+import json
+import string
+import subprocess
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import docker.errors
+import pytest
+from fastapi.testclient import TestClient
+
 from orchestrator import settings
 from orchestrator.api.docker import services
+from orchestrator.api.docker.client import docker_client
 from orchestrator.api.docker.schema import SiteInfo
 
 
@@ -53,3 +68,348 @@ def test_update_service_params(site_info: SiteInfo):
         "traefik.swarm.network": "director-sites",
     }
     assert traefik_labels.items() <= params["labels"].items()
+
+
+class MockEvents:
+    def __init__(self, events: list[dict[str, Any]]) -> None:
+        self._events = events
+        self.closed = False
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        return iter(self._events)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def service_event(action: str, service_id: str, name: str) -> dict[str, Any]:
+    return {
+        "Type": "service",
+        "Action": action,
+        "Actor": {"ID": service_id, "Attributes": {"name": name}},
+    }
+
+
+def test_service_index(monkeypatch) -> None:
+    listed = [SimpleNamespace(name="site_0001", id="a"), SimpleNamespace(name="site_0002", id="b")]
+    events = MockEvents(
+        [
+            service_event("create", "c", "site_0003"),
+            service_event("update", "a", "site_0001"),
+            service_event("remove", "b", "site_0002"),
+        ]
+    )
+    fetched: list[str] = []
+
+    def get_service(service_id: str) -> SimpleNamespace:
+        fetched.append(service_id)
+        return SimpleNamespace(id=service_id)
+
+    client = SimpleNamespace(
+        services=SimpleNamespace(list=lambda: listed, get=get_service),
+        events=lambda **_kwargs: events,
+    )
+    monkeypatch.setattr(docker_client, "get", lambda: client)
+    index = services.ServiceIndex()
+    monkeypatch.setattr(services, "service_index", index)
+
+    index.follow()
+    assert index.ready
+    assert events.closed
+
+    service = services.find_service_by_name(client, "site_0003")
+    assert service is not None
+    assert service.id == "c"
+    assert services.find_service_by_name(client, "site_0002") is None
+    # names are matched exactly, without listing the services
+    assert services.find_service_by_name(client, "site_000") is None
+    assert fetched == ["c"]
+
+
+def test_resync_keeps_changes_made_while_listing(monkeypatch) -> None:
+    index = services.ServiceIndex()
+
+    def list_services() -> list[SimpleNamespace]:
+        listed = [
+            SimpleNamespace(name="site_0001", id="a"),
+            SimpleNamespace(name="site_0002", id="b"),
+        ]
+        # created and removed after the listing was taken
+        index.add(SimpleNamespace(name="site_0003", id="c"))
+        index.discard("site_0002", "b")
+        return listed
+
+    client = SimpleNamespace(services=SimpleNamespace(list=list_services))
+    monkeypatch.setattr(docker_client, "get", lambda: client)
+
+    index.resync()
+    assert (index.get("site_0001"), index.get("site_0002"), index.get("site_0003")) == (
+        "a",
+        None,
+        "c",
+    )
+
+
+def test_removed_service_is_dropped_from_index(monkeypatch) -> None:
+    def get_service(_service_id: str) -> None:
+        raise docker.errors.NotFound("No such service")
+
+    client = SimpleNamespace(
+        services=SimpleNamespace(
+            list=lambda: [SimpleNamespace(name="site_0001", id="a")], get=get_service
+        )
+    )
+    monkeypatch.setattr(docker_client, "get", lambda: client)
+    index = services.ServiceIndex()
+    monkeypatch.setattr(services, "service_index", index)
+    index.resync()
+
+    assert services.find_service_by_name(client, "site_0001") is None
+    assert index.get("site_0001") is None
+
+
+class MockService:
+    def __init__(self, params: dict[str, Any]) -> None:
+        self.name = params["name"]
+        self.id = f"{self.name}-id"
+        self.attrs: dict[str, Any] = {"Spec": {"Labels": params["labels"]}}
+        self.updates: list[dict[str, Any]] = []
+        self.healthy = True
+        self.removed = False
+
+    def update(self, **kwargs: Any) -> None:
+        self.updates.append(kwargs)
+        self.attrs["Spec"]["Labels"] = kwargs["labels"]
+
+    def remove(self) -> None:
+        self.removed = True
+
+    def reload(self) -> None:
+        if not self.healthy:
+            self.attrs["UpdateStatus"] = {"State": "rollback_completed"}
+
+    def tasks(self) -> list[dict[str, Any]]:
+        # every update replaces the task
+        state = "running" if self.healthy else "starting"
+        return [{"ID": f"task-{len(self.updates)}", "Status": {"State": state}}]
+
+
+def test_update_service_skips_unchanged(monkeypatch, site_info: SiteInfo) -> None:
+    created: list[MockService] = []
+    image = SimpleNamespace(id="sha256:1")
+
+    def create(**params: Any) -> MockService:
+        created.append(MockService(params))
+        return created[-1]
+
+    client = SimpleNamespace(
+        services=SimpleNamespace(list=list, create=create, get=lambda _id: created[0]),
+        images=SimpleNamespace(get=lambda _name: image),
+    )
+    index = services.ServiceIndex()
+    monkeypatch.setattr(services, "service_index", index)
+    monkeypatch.setattr(docker_client, "get", lambda: client)
+    index.resync()
+
+    result = services.update_service(client, site_info)
+    assert result.status == "created"
+    assert result.startup_seconds is not None
+    result = services.update_service(client, site_info)
+    assert result.status == "unchanged"
+    service = created[0]
+    assert not service.updates
+
+    # changing the domains only changes the labels, which doesn't restart the container
+    site_info.hosts = ["other.localhost.com"]
+    result = services.update_service(client, site_info)
+    assert (result.status, result.changed) == ("updated", ["labels"])
+    assert service.updates[-1].keys() == {"labels"}
+    assert result.startup_seconds is None
+
+    site_info.is_served = False
+    assert services.update_service(client, site_info).changed == ["mode"]
+
+    # a rebuilt image has the same tag, so the service is forced to update
+    image.id = "sha256:2"
+    result = services.update_service(client, site_info)
+    assert result.changed == ["image"]
+    assert service.updates[-1]["force_update"]
+    assert services.update_service(client, site_info).status == "unchanged"
+
+
+def test_update_service_resets_removed_params(monkeypatch, site_info: SiteInfo) -> None:
+    created: list[MockService] = []
+
+    def create(**params: Any) -> MockService:
+        created.append(MockService(params))
+        return created[-1]
+
+    client = SimpleNamespace(
+        services=SimpleNamespace(list=list, create=create, get=lambda _id: created[0]),
+        images=SimpleNamespace(get=lambda _name: SimpleNamespace(id="sha256:1")),
+    )
+    index = services.ServiceIndex()
+    monkeypatch.setattr(services, "service_index", index)
+    monkeypatch.setattr(docker_client, "get", lambda: client)
+    index.resync()
+
+    site_info.type_ = "dynamic"
+    services.update_service(client, site_info)
+    # static sites run the image's own command
+    site_info.type_ = "static"
+    result = services.update_service(client, site_info)
+    assert "command" in result.changed
+    assert created[0].updates[-1]["command"] == []
+    assert services.update_service(client, site_info).status == "unchanged"
+
+
+def test_restart_replaces_unchanged_service(
+    monkeypatch, client: TestClient, site_info: SiteInfo
+) -> None:
+    service = MockService(services.create_service_params(site_info))
+    mock = SimpleNamespace(
+        services=SimpleNamespace(list=lambda: [service], get=lambda _id: service),
+        images=SimpleNamespace(get=lambda _name: SimpleNamespace(id="sha256:1")),
+    )
+    index = services.ServiceIndex()
+    monkeypatch.setattr(services, "service_index", index)
+    monkeypatch.setattr(docker_client, "get", lambda: mock)
+    index.resync()
+
+    def update(path: str) -> dict[str, Any]:
+        response = client.post(path, json=site_info.model_dump())
+        assert response.status_code == 200
+        return response.json()
+
+    assert update("/api/docker/service/update")["status"] == "updated"
+    assert update("/api/docker/service/update")["status"] == "unchanged"
+    assert len(service.updates) == 1
+
+    result = update("/api/docker/service/update?restart=true")
+    assert (result["status"], result["changed"]) == ("restarted", [])
+    # it waits for the new container
+    assert result["startup_seconds"] is not None
+    assert len(service.updates) == 2
+    assert service.updates[-1]["force_update"]
+
+
+def test_unhealthy_update_is_rolled_back(monkeypatch, site_info: SiteInfo) -> None:
+    service = MockService(services.create_service_params(site_info))
+    service.healthy = False
+    client = SimpleNamespace(
+        services=SimpleNamespace(list=lambda: [service], get=lambda _id: service),
+        images=SimpleNamespace(get=lambda _name: SimpleNamespace(id="sha256:1")),
+    )
+    index = services.ServiceIndex()
+    monkeypatch.setattr(services, "service_index", index)
+    monkeypatch.setattr(docker_client, "get", lambda: client)
+    index.resync()
+
+    # created before the digests were recorded, so everything is updated
+    result = services.update_service(client, site_info)
+    assert result.rolled_back
+    assert result.startup_seconds is None
+
+
+def test_service_params_health_check(site_info: SiteInfo) -> None:
+    site_info.type_ = "dynamic"
+    params = services.create_service_params(site_info)
+    assert params["update_config"]["Order"] == "start-first"
+    assert params["update_config"]["FailureAction"] == "rollback"
+    test = params["healthcheck"]["Test"]
+    assert test[0] == "CMD-SHELL"
+    assert services.SITE_PID_FILE in test[1]
+    assert any(services.SITE_PID_FILE in part for part in params["command"])
+
+
+@pytest.mark.parametrize(
+    ("pid", "healthy"),
+    (
+        # there is no run.sh to wait for
+        ("none", True),
+        # run.sh exited
+        ("999999999", False),
+        # run-site.sh hasn't started run.sh yet
+        (None, False),
+    ),
+)
+def test_health_check_liveness(tmp_path: Path, pid: str | None, *, healthy: bool) -> None:
+    pid_file = tmp_path / "site.pid"
+    if pid is not None:
+        pid_file.write_text(f"{pid}\n")
+    template = string.Template((services.TEMPLATE_DIR / "healthcheck.sh").read_text())
+    script = template.safe_substitute(PID_FILE=pid_file)
+    # without curl or wget on the PATH, only the liveness of run.sh is checked
+    process = subprocess.run(["/bin/sh", "-c", script], env={"PORT": "1", "PATH": ""}, check=False)
+    assert (process.returncode == 0) == healthy
+
+
+def test_update_many(monkeypatch, client: TestClient, site_info: SiteInfo) -> None:
+    created: dict[str, MockService] = {}
+    listings = []
+
+    def create(**params: Any) -> MockService:
+        if params["name"] == "site_0002":
+            raise docker.errors.APIError("No such image", explanation="No such image")
+        created[params["name"]] = MockService(params)
+        return created[params["name"]]
+
+    def list_services() -> list[MockService]:
+        listings.append(True)
+        return list(created.values())
+
+    mock = SimpleNamespace(
+        services=SimpleNamespace(
+            list=list_services,
+            create=create,
+            get=lambda service_id: created[service_id.removesuffix("-id")],
+        ),
+        images=SimpleNamespace(get=lambda _name: SimpleNamespace(id="sha256:1")),
+    )
+    monkeypatch.setattr(docker_client, "get", lambda: mock)
+    monkeypatch.setattr(services, "service_index", services.ServiceIndex())
+
+    sites = [site_info.model_copy(update={"pk": pk}).model_dump() for pk in (1, 2, 3)]
+    response = client.post("/api/docker/service/update-many", json=sites)
+    assert response.status_code == 200
+    results = {line["site"]: line for line in map(json.loads, response.text.splitlines())}
+    assert results[1]["result"]["status"] == results[3]["result"]["status"] == "created"
+    assert results[2]["error"] == "No such image"
+    assert created.keys() == {"site_0001", "site_0003"}
+    # the services are looked up in a single listing
+    assert len(listings) == 1
+
+    response = client.post("/api/docker/service/remove-many", json=sites)
+    removals = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(removal["site"] for removal in removals) == [1, 2, 3]
+    assert not any(removal["error"] for removal in removals)
+    assert all(service.removed for service in created.values())
+
+
+def test_update_many_concurrency(monkeypatch, client: TestClient, site_info: SiteInfo) -> None:
+    lock = threading.Lock()
+    in_flight = []
+    most_in_flight = 0
+
+    def create(**params: Any) -> MockService:
+        nonlocal most_in_flight
+        with lock:
+            in_flight.append(params["name"])
+            most_in_flight = max(most_in_flight, len(in_flight))
+        time.sleep(0.05)
+        with lock:
+            in_flight.remove(params["name"])
+        return MockService(params)
+
+    mock = SimpleNamespace(
+        services=SimpleNamespace(list=lambda: [], create=create),
+        images=SimpleNamespace(get=lambda _name: SimpleNamespace(id="sha256:1")),
+    )
+    monkeypatch.setattr(docker_client, "get", lambda: mock)
+    monkeypatch.setattr(services, "service_index", services.ServiceIndex())
+
+    sites = [site_info.model_copy(update={"pk": pk}).model_dump() for pk in (1, 2, 3)]
+    response = client.post("/api/docker/service/update-many?concurrency=1", json=sites)
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 3
+    assert most_in_flight == 1